@@ -1,5 +1,6 @@
 # api/convert.py
 import os
+import sys
 import base64
 import json
 import email
@@ -8,45 +9,1036 @@ import requests
 import time
 import re
 import tempfile
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import asyncio
+import multiprocessing
+from multiprocessing import forkserver
+import sqlite3
+import uuid
+import hashlib
+import threading
+import signal
+import importlib.metadata
+import binascii
+import zipfile
+import hmac
+import collections
+import itertools
+import math
+import contextvars
+from contextlib import closing, contextmanager, nullcontext, suppress
 from email import policy
+from email.header import Header
+from email.utils import formataddr, formatdate, make_msgid, parseaddr
+from urllib.parse import quote
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from fastapi import FastAPI, Request, Response, Form, File, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import PlainTextResponse, JSONResponse
 from pdf2docx import Converter
+import fitz
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
 from datetime import datetime
 from io import BytesIO
 
+from common import (
+    DOCX_OPTIMIZE, ConversionCache, ProfileStore, convert_pdf_to_docx_text_only, docx_optimization_tag,
+    optimize_docx, sample_page_numbers
+)
+
 # --- CONFIGURACIÓN INICIAL ---
 GMAIL_EMAIL = os.environ.get("GMAIL_EMAIL")
 GMAIL_APP_PASSWORD = os.environ.get("GMAIL_APP_PASSWORD")
 
+# Servidor SMTP de salida (Gmail por defecto; configurable para pruebas locales)
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_MAX_CONNECTIONS = int(os.environ.get("SMTP_MAX_CONNECTIONS", "3"))  # Conexiones abiertas a la vez como máximo
+SMTP_NOOP_AFTER_SECONDS = 30  # Conexiones ociosas más tiempo que esto se comprueban con NOOP
+SMTP_MAX_IDLE_SECONDS = 240  # Gmail cierra las conexiones ociosas a los pocos minutos
+SMTP_TIMEOUT_SECONDS = 60
+
+# Pool de procesos para las conversiones (pdf2docx es CPU intensivo y bloquearía el event loop)
+CONVERSION_WORKERS = int(os.environ.get("CONVERSION_WORKERS", str(os.cpu_count() or 1)))
+CONVERSION_QUEUE_MAX = int(os.environ.get("CONVERSION_QUEUE_MAX", "10"))  # Conversiones en espera antes de rechazar
+CONVERSION_BUSY_RETRY_SECONDS = 2  # Con el pool lleno, cada PDF espera esto y lo vuelve a intentar
+# Planificador del pool: los PDFs cortos van por un carril rápido y los largos por uno
+# limitado, para que un manual de 300 páginas no retenga a los de una página
+SCHEDULER_SHORT_MAX_SECONDS = float(os.environ.get("SCHEDULER_SHORT_MAX_SECONDS", "45"))  # Coste máximo del carril rápido
+SCHEDULER_LONG_LANE_SLOTS = int(os.environ.get(  # Huecos del pool que pueden ocupar a la vez los PDFs largos
+    "SCHEDULER_LONG_LANE_SLOTS", str(max(1, CONVERSION_WORKERS - 1))
+))
+SCHEDULER_AGING_RATE = float(os.environ.get("SCHEDULER_AGING_RATE", "4"))  # Segundos de coste que compensa cada segundo de espera
+SCHEDULER_SECONDS_PER_PAGE = 1.5  # Coste estimado por página con pdf2docx
+SCHEDULER_TEXT_COST_FACTOR = 0.1  # El modo de solo texto es un orden de magnitud más rápido
+
+# Conversión por páginas en paralelo para PDFs largos (0 o 1 la desactiva); cada conversión
+# usa como mucho su parte de los núcleos entre las que están en marcha
+PAGE_PARALLEL_WORKERS = int(os.environ.get("PAGE_PARALLEL_WORKERS", str(os.cpu_count() or 1)))
+PAGE_PARALLEL_MIN_PAGES = int(os.environ.get("PAGE_PARALLEL_MIN_PAGES", "20"))
+
+# Cola persistente de trabajos (emails recibidos pendientes de convertir). Tiene que sobrevivir
+# a los redeploys: por defecto va en el volumen de Railway (RAILWAY_VOLUME_MOUNT_PATH) o en /data
+DATA_DIR = os.environ.get("DATA_DIR") or os.environ.get("RAILWAY_VOLUME_MOUNT_PATH") or "/data"
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(DATA_DIR, "file2word_jobs"))
+JOBS_DB_PATH = os.path.join(JOBS_DIR, "jobs.db")
+JOBS_SPOOL_DIR = os.path.join(JOBS_DIR, "spool")
+JOB_WORKERS = int(os.environ.get(  # Trabajos procesados a la vez; el doble que huecos de conversión
+    "JOB_WORKERS", str(2 * CONVERSION_WORKERS)  # para que el planificador del pool tenga dónde elegir
+))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))  # Intentos antes de pasar a la cola de muertos
+JOB_RETRY_BASE_SECONDS = int(os.environ.get("JOB_RETRY_BASE_SECONDS", "30"))  # Backoff: 30s, 60s, 120s...
+JOB_LEASE_SECONDS = 120  # Tiempo tras el que un trabajo 'running' huérfano se vuelve a procesar
+JOB_LEASE_RENEW_SECONDS = 30  # Mientras el trabajo sigue en marcha su reserva se renueva cada tanto
+JOB_POLL_INTERVAL = 5  # Segundos entre comprobaciones de reintentos programados
+# Admisión: cubo de tokens por remitente y límite global de trabajos en curso. Los
+# trabajos de un remitente sin tokens se aplazan en la cola, no se rechazan
+ADMISSION_SENDER_RATE_PER_MINUTE = float(os.environ.get("ADMISSION_SENDER_RATE_PER_MINUTE", "6"))  # 0 sin límite
+ADMISSION_SENDER_BURST = int(os.environ.get("ADMISSION_SENDER_BURST", "10"))  # Trabajos seguidos antes de frenar
+ADMISSION_MAX_RUNNING_JOBS = int(  # Trabajos en curso entre todos los workers de uvicorn
+    os.environ.get("ADMISSION_MAX_RUNNING_JOBS", str(JOB_WORKERS))
+)
+ADMISSION_SCAN_LIMIT = 50  # Trabajos pendientes mirados por reserva en busca de un remitente con tokens
+MAX_EMAIL_ATTACHMENT_MB = float(os.environ.get("MAX_EMAIL_ATTACHMENT_MB", "25"))  # Por encima se envía un ZIP
+EMAIL_FORM_FIELDS = ('email', 'message', 'raw_message')  # Campos donde SendGrid puede mandar el email
+MIME_LINE_LIMIT = 64 * 1024  # Bytes máximos leídos de una vez al parsear el email
+MIME_MAX_HEADER_BYTES = 256 * 1024  # Las cabeceras que superen esto se descartan
+
+# Caché de conversiones por hash del PDF
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(tempfile.gettempdir(), "file2word_cache"))
+CACHE_MAX_MB = float(os.environ.get("CACHE_MAX_MB", "500"))
+
+# Triaje previo a la conversión
+TRIAGE_SAMPLE_PAGES = int(os.environ.get("TRIAGE_SAMPLE_PAGES", "5"))  # Páginas inspeccionadas por PDF
+TRIAGE_MAX_PAGES = int(os.environ.get("TRIAGE_MAX_PAGES", "2000"))  # PDFs más largos se rechazan
+TRIAGE_LOG_PATH = os.environ.get("TRIAGE_LOG_PATH", os.path.join(JOBS_DIR, "triage.jsonl"))  # Decisiones de enrutado
+TRIAGE_TIMEOUT_SECONDS = int(os.environ.get("TRIAGE_TIMEOUT_SECONDS", "15"))  # PDFs que tardan más en analizarse se rechazan
+# Modo rápido (solo texto): se pide con "word rapido" en el asunto; con TRIAGE_AUTO_FAST
+# también se usa para los PDFs que el triaje ve como texto puro
+FAST_MODE_KEYWORDS = ('rapido', 'rápido')
+TRIAGE_AUTO_FAST = os.environ.get("TRIAGE_AUTO_FAST", "false").lower() == "true"
+
+# Timeouts aprendidos: cada conversión guarda su duración y el timeout de las siguientes
+# sale de un percentil alto de las parecidas (motor, tipo de contenido, nº de páginas)
+TIMING_DB_PATH = os.path.join(JOBS_DIR, "conversion_times.db")
+TIMING_PERCENTILE = float(os.environ.get("TIMING_PERCENTILE", "0.95"))
+TIMING_MARGIN = float(os.environ.get("TIMING_MARGIN", "1.5"))  # Multiplicador sobre el percentil
+TIMING_MIN_SAMPLES = int(os.environ.get("TIMING_MIN_SAMPLES", "20"))  # Con menos se usan los tramos de tamaño
+TIMING_WINDOW = 500  # Conversiones parecidas más recientes que se tienen en cuenta
+TIMING_MAX_ROWS = 20000  # Historial conservado
+TIMING_MIN_TIMEOUT_SECONDS = int(os.environ.get("TIMING_MIN_TIMEOUT_SECONDS", "15"))
+TIMING_MAX_TIMEOUT_SECONDS = int(os.environ.get("TIMING_MAX_TIMEOUT_SECONDS", "600"))
+
+# Optimización del DOCX convertido: DOCX_OPTIMIZE, DOCX_DEFLATE_LEVEL, DOCX_IMAGE_TARGET_DPI
+# y DOCX_JPEG_QUALITY se leen en common/docx_utils.py, igual para las dos apps
+
+# Métricas de Prometheus en /metrics; con varios workers de uvicorn hay que apuntar
+# PROMETHEUS_MULTIPROC_DIR a un directorio vacío para que se sumen los de todos
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# Trazas de cada trabajo (un span por etapa) en JSONL; vacío las desactiva
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", os.path.join(JOBS_DIR, "traces.jsonl"))
+
+# Perfiles de las conversiones lentas (opcional): se muestrea la pila de cada
+# conversión y se guarda el perfil de las que superan el umbral
+PROFILE_SLOW_CONVERSIONS = os.environ.get("PROFILE_SLOW_CONVERSIONS", "false").lower() == "true"
+PROFILE_THRESHOLD_SECONDS = float(os.environ.get("PROFILE_THRESHOLD_SECONDS", "20"))
+PROFILE_SAMPLE_INTERVAL_MS = int(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "20"))
+PROFILE_FLUSH_SECONDS = 5  # Mientras la conversión sigue, el perfil se reescribe cada tanto
+PROFILES_DIR = os.path.join(JOBS_DIR, "profiles")
+PROFILES_MAX_FILES = int(os.environ.get("PROFILES_MAX_FILES", "200"))  # Se borran los más antiguos
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")  # Clave (cabecera X-API-Key) de /admin/*; sin ella responden 403
+
 # Crear la aplicación FastAPI
 app = FastAPI()
 
+# --- MÉTRICAS ---
+# Un histograma por etapa del procesado de un email, contadores por resultado y
+# gauges del estado de la cola y del pool, para ver dónde se va el tiempo.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+MIME_PARSE_SECONDS = Histogram(
+    "pdf2word_mime_parse_seconds", "Parseo del email MIME y decodificación de los PDFs adjuntos",
+    buckets=STAGE_BUCKETS
+)
+TEMP_WRITE_SECONDS = Histogram(
+    "pdf2word_temp_write_seconds", "Volcado a disco del email recibido en el webhook", buckets=STAGE_BUCKETS
+)
+CONVERSION_SECONDS = Histogram(
+    "pdf2word_conversion_seconds", "Conversión de un PDF en el pool (sin contar aciertos de caché)",
+    ["engine"], buckets=STAGE_BUCKETS
+)
+DOCX_VALIDATION_SECONDS = Histogram(
+    "pdf2word_docx_validation_seconds", "Validación del DOCX generado", buckets=STAGE_BUCKETS
+)
+SMTP_SEND_SECONDS = Histogram(
+    "pdf2word_smtp_send_seconds", "Generación y envío por SMTP de un email de respuesta", buckets=STAGE_BUCKETS
+)
+
+WEBHOOK_REQUESTS = Counter("pdf2word_webhook_requests_total", "Peticiones al webhook por resultado", ["outcome"])
+JOBS_FINISHED = Counter("pdf2word_jobs_total", "Intentos de procesar un trabajo por resultado", ["outcome"])
+TRIAGE_DECISIONS = Counter("pdf2word_triage_decisions_total", "Decisiones del triaje por ruta", ["route"])
+CONVERSIONS = Counter("pdf2word_conversions_total", "Conversiones por motor y resultado", ["engine", "outcome"])
+EMAILS_SENT = Counter("pdf2word_emails_total", "Emails de respuesta por resultado", ["outcome"])
+ADMISSION_DEFERRED = Counter(
+    "pdf2word_admission_deferred_total", "Trabajos aplazados porque su remitente no tenía tokens"
+)
+
+CONVERSIONS_IN_FLIGHT = Gauge(
+    "pdf2word_conversions_in_flight", "Conversiones ejecutándose en el pool", multiprocess_mode="livesum"
+)
+CONVERSIONS_QUEUED = Gauge(
+    "pdf2word_conversions_queued", "Conversiones esperando un hueco en el pool", multiprocess_mode="livesum"
+)
+CONVERSION_QUEUE_WAIT_SECONDS = Histogram(
+    "pdf2word_conversion_queue_wait_seconds", "Espera en la cola del pool hasta tener hueco, por carril",
+    ["lane"], buckets=STAGE_BUCKETS
+)
+
+
+class JobQueueCollector:
+    """Profundidad de la cola de trabajos; se lee de SQLite en cada scrape porque la comparten todos los workers"""
+
+    def _family(self):
+        return GaugeMetricFamily("pdf2word_job_queue_depth", "Trabajos en la cola por estado", labels=["status"])
+
+    def describe(self):
+        return [self._family()]
+
+    def collect(self):
+        family = self._family()
+        try:
+            stats = job_queue_stats()
+        except sqlite3.Error as e:
+            print(f"Error leyendo la cola de trabajos para las métricas: {e}")
+            return
+        for status in ('pending', 'running', 'dead'):
+            family.add_metric([status], stats[status])
+        yield family
+
+
+job_queue_collector = JobQueueCollector()
+if not PROMETHEUS_MULTIPROC_DIR:
+    REGISTRY.register(job_queue_collector)
+
+
+def metrics_registry():
+    """Registro a exportar: el del proceso o, en modo multiproceso, el agregado de todos los workers"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(job_queue_collector)
+    return registry
+
+
+@app.get("/metrics")
+async def metrics():
+    data = await run_in_threadpool(generate_latest, metrics_registry())
+    return Response(data, media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("shutdown")
+async def mark_metrics_process_dead():
+    # Los gauges 'livesum' de este worker dejan de contar al terminar
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+# --- TRAZAS ---
+# Cada trabajo es una traza cuyo id es el id del trabajo: el webhook abre el span
+# raíz y cada intento de procesarlo cuelga de él, con un span por etapa (parseo
+# MIME, triaje, conversión, validación, envío SMTP...). Los spans se añaden a
+# TRACE_LOG_PATH con los campos de OpenTelemetry (ids en hex, tiempos en ns), así
+# que se pueden filtrar por id de trabajo o hacer que un colector lea el fichero.
+TRACE_SERVICE_NAME = "pdf2word-api"
+_trace_context = contextvars.ContextVar("trace_context", default=None)  # (trace_id, span_id) del span actual
+
+
+class Span:
+    def __init__(self, name, trace_id, span_id, parent_span_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_span_id = parent_span_id
+        self.attributes = {}
+        self.set_attributes(attributes)
+        self.start_ns = time.time_ns()
+        self.status = "OK"
+        self.status_message = None
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def set_error(self, message):
+        self.status = "ERROR"
+        self.status_message = message
+
+
+def export_span(span, end_ns):
+    if not TRACE_LOG_PATH:
+        return
+    record = {
+        "trace_id": span.trace_id,
+        "span_id": span.span_id,
+        "parent_span_id": span.parent_span_id,
+        "name": span.name,
+        "service": TRACE_SERVICE_NAME,
+        "start_time_unix_nano": span.start_ns,
+        "end_time_unix_nano": end_ns,
+        "duration_ms": round((end_ns - span.start_ns) / 1e6, 3),
+        "status": span.status,
+        "status_message": span.status_message,
+        "attributes": span.attributes,
+        "pid": os.getpid()
+    }
+    line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+    try:
+        os.makedirs(os.path.dirname(TRACE_LOG_PATH), exist_ok=True)
+        # Una sola escritura en modo append: los procesos de conversión escriben en el mismo fichero
+        fd = os.open(TRACE_LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"No se pudo registrar el span {span.name}: {e}")
+
+
+@contextmanager
+def trace_span(name, attributes=None, trace_id=None, span_id=None, parent_span_id=None):
+    """
+    Abre un span hijo del actual, o el primero de la traza trace_id si se indica.
+    Fuera de una traza (p. ej. en el benchmark) el span no se registra.
+    """
+    parent = _trace_context.get()
+    if trace_id is None and parent is not None:
+        trace_id, parent_span_id = parent
+    span = Span(name, trace_id, span_id or os.urandom(8).hex(), parent_span_id, attributes or {})
+    token = _trace_context.set((trace_id, span.span_id)) if trace_id else None
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        if token is not None:
+            _trace_context.reset(token)
+            export_span(span, time.time_ns())
+
+
+# --- PERFILES DE CONVERSIONES LENTAS ---
+# Con PROFILE_SLOW_CONVERSIONS cada proceso de conversión lleva un hilo que apunta
+# la pila del hilo principal cada PROFILE_SAMPLE_INTERVAL_MS. Si la conversión
+# supera PROFILE_THRESHOLD_SECONDS, el perfil (pilas agregadas en el formato
+# "collapsed" de los flame graphs y las funciones más vistas) se guarda en
+# PROFILES_DIR con el id del trabajo, y se reescribe mientras la conversión siga
+# para que quede aunque el pool mate el proceso por timeout. En la conversión por
+# páginas en paralelo el trabajo lo hacen los procesos de pdf2docx y aquí solo se
+# ve la espera.
+PROFILE_SUMMARY_FIELDS = ('id', 'created_at', 'status', 'engine', 'job_id', 'filename', 'pages', 'wall_s', 'cpu_s', 'samples')
+profile_store = ProfileStore(PROFILES_DIR, PROFILES_MAX_FILES, PROFILE_SUMMARY_FIELDS)
+
+
+def mark_profile_interrupted(profile_id, status):
+    """El pool mató el proceso de conversión: su último perfil guardado deja de estar 'running'"""
+    profile = profile_store.load(profile_id)
+    if profile is not None and profile['status'] == 'running':
+        profile['status'] = status
+        profile_store.save(profile)
+
+
+def new_profile_metadata(engine, pdf_attachment, pages):
+    trace = _trace_context.get()
+    return {
+        "id": uuid.uuid4().hex[:16],
+        "engine": engine,
+        "job_id": trace[0] if trace else None,
+        "filename": pdf_attachment['filename'],
+        "sha256": pdf_attachment['sha256'],
+        "pdf_bytes": pdf_attachment['size'],
+        "pages": pages
+    }
+
+
+class SlowConversionProfiler:
+    """Perfilador por muestreo del hilo principal del proceso de conversión"""
+
+    def __init__(self, metadata):
+        self.profile = dict(metadata)
+        self.thread_id = threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.start_time = time.time()
+        self.start_cpu = time.process_time()
+
+    def start(self):
+        self.thread.start()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if functions:
+            self.stacks[";".join(reversed(functions))] += 1
+            self.samples += 1
+
+    def _run(self):
+        next_save = self.start_time + PROFILE_THRESHOLD_SECONDS
+        while not self.stop_event.wait(PROFILE_SAMPLE_INTERVAL_MS / 1000):
+            self._sample()
+            if time.time() >= next_save:
+                self._save("running")
+                next_save = time.time() + PROFILE_FLUSH_SECONDS
+
+    def _save(self, status):
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+        self.profile.update({
+            "status": status,
+            "created_at": datetime.fromtimestamp(self.start_time).isoformat(),
+            "threshold_s": PROFILE_THRESHOLD_SECONDS,
+            "wall_s": round(time.time() - self.start_time, 3),
+            "cpu_s": round(time.process_time() - self.start_cpu, 3),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL_MS,
+            "samples": self.samples,
+            "top_functions": [
+                {"function": function, "self_samples": count, "total_samples": total[function]}
+                for function, count in own.most_common(30)
+            ],
+            "stacks": dict(self.stacks)
+        })
+        try:
+            profile_store.save(self.profile)
+        except OSError as e:
+            print(f"No se pudo guardar el perfil {self.profile['id']}: {e}")
+
+    def stop(self, status):
+        self.stop_event.set()
+        self.thread.join()
+        if time.time() - self.start_time >= PROFILE_THRESHOLD_SECONDS:
+            self._save(status)
+            profile_store.prune()
+            print(f"Perfil de conversión lenta guardado: {self.profile['id']} "
+                  f"({self.profile['wall_s']}s, {self.samples} muestras)")
+
+
+# --- POOL DE CONVERSIÓN ---
+class ConversionPoolBusy(Exception):
+    """No quedan huecos libres en la cola del pool de conversión"""
+
+
+class ConversionTimeout(Exception):
+    """La conversión superó su tiempo máximo y se mató el proceso"""
+
+
+_page_workers_budget = contextvars.ContextVar("page_workers_budget", default=None)  # Núcleos para esta conversión
+
+
+def _conversion_process_main(conn, func, args, trace_context=None, profile=None, page_workers=None):
+    """Punto de entrada del proceso hijo: ejecuta la conversión y devuelve el resultado por el pipe"""
+    # Grupo de procesos propio para poder matar también los subprocesos de pdf2docx
+    os.setpgid(0, 0)
+    # Los spans del hijo cuelgan del span de conversión del padre
+    _trace_context.set(trace_context)
+    _page_workers_budget.set(page_workers)
+    profiler = SlowConversionProfiler(profile) if profile else None
+    if profiler:
+        profiler.start()
+    try:
+        result = func(*args)
+        if profiler:
+            profiler.stop("ok")
+        conn.send(("ok", result))
+    except Exception as e:
+        if profiler:
+            profiler.profile["error"] = str(e)
+            profiler.stop("error")
+        conn.send(("error", str(e)))
+    finally:
+        conn.close()
+
+
+class ConversionPool:
+    """
+    Ejecuta cada conversión en su propio proceso con un número máximo de
+    conversiones en paralelo y una cola acotada. Cuando la cola está llena se
+    rechaza el trabajo en vez de acumularlo en memoria, y cuando una conversión
+    supera su timeout se mata el proceso para liberar CPU y memoria.
+
+    La cola no es FIFO: cada conversión trae un coste estimado en segundos y va
+    al carril rápido ('short') o al largo ('long'), que nunca ocupa más de
+    long_slots huecos. Al quedar un hueco libre entra la espera de menor rango,
+    llegada + coste / aging_rate, así que los PDFs cortos adelantan a los largos
+    pero un PDF largo que lleva tiempo esperando acaba pasando delante.
+    """
+
+    def __init__(self, workers, queue_max, short_max_cost=SCHEDULER_SHORT_MAX_SECONDS,
+                 long_slots=SCHEDULER_LONG_LANE_SLOTS, aging_rate=SCHEDULER_AGING_RATE):
+        self.workers = max(1, workers)
+        self.queue_max = queue_max
+        self.short_max_cost = short_max_cost
+        self.long_slots = max(1, min(long_slots, self.workers))
+        self.aging_rate = aging_rate
+        # forkserver y no fork: este proceso tiene hilos (threadpool de FastAPI, pool
+        # SMTP) y un hijo hecho con fork puede heredar un lock cogido y colgarse. Los
+        # hijos salen de un servidor de un solo hilo que ya tiene importado este módulo.
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload([__name__])
+        self.waiters = []  # [rango, orden de llegada, carril, future]
+        self.arrivals = itertools.count()
+        self.processes = set()
+        self.running = 0
+        self.lane_running = {"short": 0, "long": 0}
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def start(self):
+        """Arranca el forkserver para que la primera conversión no espere a que importe el módulo"""
+        forkserver.ensure_running()
+
+    def shutdown(self):
+        for process in list(self.processes):
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                process.kill()
+            process.join()
+        self.processes.clear()
+
+    def room(self):
+        """Conversiones que aún caben entre huecos libres y sitio en la cola"""
+        return max(0, self.workers + self.queue_max - self.running - self.queued)
+
+    def lane_for(self, cost):
+        return "long" if cost is not None and cost > self.short_max_cost else "short"
+
+    def _dispatch(self):
+        """Asigna los huecos libres a las esperas de menor rango cuyo carril tenga sitio"""
+        while self.running < self.workers:
+            eligible = [
+                waiter for waiter in self.waiters
+                if waiter[2] == "short" or self.lane_running["long"] < self.long_slots
+            ]
+            if not eligible:
+                return
+            waiter = min(eligible)
+            self.waiters.remove(waiter)
+            self.running += 1
+            self.lane_running[waiter[2]] += 1
+            waiter[3].set_result(None)
+
+    def _release(self, lane):
+        self.running -= 1
+        self.lane_running[lane] -= 1
+        self._dispatch()
+
+    async def _acquire(self, lane, cost):
+        loop = asyncio.get_running_loop()
+        rank = time.monotonic() + (cost or 0) / self.aging_rate
+        waiter = [rank, next(self.arrivals), lane, loop.create_future()]
+        self.waiters.append(waiter)
+        self._dispatch()
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif not waiter[3].cancelled():
+                # El hueco llegó a asignarse justo al cancelar: se devuelve
+                self._release(lane)
+            raise
+
+    async def run(self, func, *args, timeout=None, profile=None, cost=None, timing=None):
+        """
+        Ejecuta func(*args) en un proceso hijo. Si se pasa el dict timing, se anota
+        en 'run_s' cuánto duró la ejecución sin contar la espera en la cola.
+        """
+        if self.running + self.queued >= self.workers + self.queue_max:
+            self.rejected += 1
+            raise ConversionPoolBusy(
+                f"Pool de conversión lleno ({self.running} en curso, {self.queued} en cola)"
+            )
+
+        lane = self.lane_for(cost)
+        self.queued += 1
+        CONVERSIONS_QUEUED.inc()
+        queued_at = time.monotonic()
+        try:
+            with trace_span("conversion_queue", {"scheduler.lane": lane, "scheduler.cost_s": cost}):
+                await self._acquire(lane, cost)
+        finally:
+            self.queued -= 1
+            CONVERSIONS_QUEUED.dec()
+        CONVERSION_QUEUE_WAIT_SECONDS.labels(lane=lane).observe(time.monotonic() - queued_at)
+
+        CONVERSIONS_IN_FLIGHT.inc()
+        # Los núcleos se reparten entre las conversiones en curso (esta incluida)
+        page_workers = max(1, (os.cpu_count() or 1) // self.running)
+        parent_conn, child_conn = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=_conversion_process_main,
+            args=(child_conn, func, args, _trace_context.get(), profile, page_workers)
+        )
+        started_at = time.monotonic()
+        try:
+            process.start()
+            child_conn.close()
+            self.processes.add(process)
+
+            # Esperar sin bloquear el event loop a que el hijo escriba en el pipe
+            loop = asyncio.get_running_loop()
+            result_ready = asyncio.Event()
+            loop.add_reader(parent_conn.fileno(), result_ready.set)
+            try:
+                await asyncio.wait_for(result_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                print(f"Conversión superó {timeout}s, matando proceso {process.pid}")
+                raise ConversionTimeout(f"La conversión esta tardando mas de {timeout} segundos")
+            finally:
+                loop.remove_reader(parent_conn.fileno())
+
+            try:
+                status, result = parent_conn.recv()
+            except EOFError:
+                process.join(5)
+                raise Exception(f"El proceso de conversión terminó inesperadamente (código {process.exitcode})")
+
+            if status == "error":
+                raise Exception(result)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if process.is_alive():
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    process.kill()
+            process.join()
+            self.processes.discard(process)
+            parent_conn.close()
+            if timing is not None:
+                timing['run_s'] = time.monotonic() - started_at
+            CONVERSIONS_IN_FLIGHT.dec()
+            self._release(lane)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queued": self.queued,
+            "queue_max": self.queue_max,
+            "lanes": {
+                lane: {
+                    "running": running,
+                    "queued": sum(1 for waiter in self.waiters if waiter[2] == lane),
+                    "slots": self.long_slots if lane == "long" else self.workers
+                }
+                for lane, running in self.lane_running.items()
+            },
+            "utilisation": round(self.running / self.workers, 2),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+
+conversion_pool = ConversionPool(CONVERSION_WORKERS, CONVERSION_QUEUE_MAX)
+
+
+@app.on_event("startup")
+async def start_conversion_pool():
+    await run_in_threadpool(conversion_pool.start)
+
+
+@app.on_event("shutdown")
+async def stop_conversion_pool():
+    conversion_pool.shutdown()
+
+
+# --- CACHÉ DE CONVERSIONES ---
+# DOCX convertidos por SHA-256 del PDF, conversor y versión (ConversionCache, en common/cache.py)
+conversion_cache = ConversionCache(CACHE_DIR, CACHE_MAX_MB)
+PDF2DOCX_VERSION = importlib.metadata.version("pdf2docx")
+PYMUPDF_VERSION = fitz.VersionBind
+
+
+# --- MODELO DE TIEMPOS DE CONVERSIÓN ---
+class ConversionTimeModel:
+    """
+    Historial en SQLite de cuánto tarda cada conversión según motor, páginas,
+    tamaño y proporción de imagen. El timeout de un PDF es un percentil alto de
+    los segundos por página de las conversiones parecidas más recientes (mismo
+    motor y tipo de contenido, entre la mitad y el doble de páginas) por sus
+    páginas y un margen; el ETA sale de la mediana. Las conversiones que agotan
+    el timeout cuentan con su timeout como duración, así que un tipo de PDF que
+    no cabe va subiendo su límite. Sin bastantes muestras se usan los tramos de
+    tamaño de calculate_timeout.
+    """
+
+    def __init__(self, db_path, percentile, margin, min_samples, window, min_timeout, max_timeout):
+        self.db_path = db_path
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.window = window
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.recorded = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversion_times (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    engine TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    pages INTEGER NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    image_ratio REAL NOT NULL,
+                    duration_s REAL NOT NULL,
+                    timed_out INTEGER NOT NULL DEFAULT 0,
+                    recorded_at REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS conversion_times_similar ON conversion_times (engine, content, pages)"
+            )
+
+    @staticmethod
+    def content_class(image_ratio):
+        if image_ratio > 0.5:
+            return "scanned"
+        return "mixed" if image_ratio > 0.1 else "text"
+
+    def record(self, engine, size_bytes, pages, image_ratio, duration, timed_out=False):
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "INSERT INTO conversion_times (engine, content, pages, size_bytes, image_ratio, duration_s, "
+                "timed_out, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (engine, self.content_class(image_ratio), max(pages, 1), size_bytes, image_ratio,
+                 duration, int(timed_out), time.time())
+            )
+            if cursor.lastrowid % 100 == 0:
+                conn.execute("DELETE FROM conversion_times WHERE id <= ?", (cursor.lastrowid - TIMING_MAX_ROWS,))
+        self.recorded += 1
+
+    def _seconds_per_page(self, conn, engine, content, pages):
+        """Segundos por página de las conversiones parecidas más recientes"""
+        rows = conn.execute(
+            "SELECT duration_s, pages FROM conversion_times WHERE engine = ? AND content = ? "
+            "AND pages BETWEEN ? AND ? ORDER BY id DESC LIMIT ?",
+            (engine, content, max(pages // 2, 1), pages * 2, self.window)
+        ).fetchall()
+        return sorted(row['duration_s'] / row['pages'] for row in rows)
+
+    @staticmethod
+    def _quantile(values, q):
+        return values[min(len(values) - 1, max(math.ceil(q * len(values)) - 1, 0))]
+
+    def predict(self, engine, size_bytes, pages, image_ratio):
+        """Timeout (s), ETA (s o None) y de dónde salen para una conversión"""
+        pages = max(pages, 1)
+        with closing(self._connect()) as conn:
+            rates = self._seconds_per_page(conn, engine, self.content_class(image_ratio), pages)
+        if len(rates) < self.min_samples:
+            return {"timeout": calculate_timeout_for_size(size_bytes), "eta": None,
+                    "samples": len(rates), "source": "buckets"}
+
+        timeout = math.ceil(self._quantile(rates, self.percentile) * pages * self.margin)
+        return {
+            "timeout": min(max(timeout, self.min_timeout), self.max_timeout),
+            "eta": round(self._quantile(rates, 0.5) * pages, 1),
+            "samples": len(rates),
+            "source": "model"
+        }
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT engine, content, COUNT(*) AS samples, SUM(timed_out) AS timed_out "
+                "FROM conversion_times GROUP BY engine, content"
+            ).fetchall()
+        return {
+            "recorded": self.recorded,
+            "classes": {f"{row['engine']}/{row['content']}": {"samples": row['samples'], "timed_out": row['timed_out']}
+                        for row in rows}
+        }
+
+
+conversion_times = ConversionTimeModel(
+    TIMING_DB_PATH, TIMING_PERCENTILE, TIMING_MARGIN, TIMING_MIN_SAMPLES, TIMING_WINDOW,
+    TIMING_MIN_TIMEOUT_SECONDS, TIMING_MAX_TIMEOUT_SECONDS
+)
+
+
+@app.on_event("startup")
+async def init_conversion_times():
+    await run_in_threadpool(conversion_times.init)
+
+
+# --- POOL DE CONEXIONES SMTP ---
+class SMTPConnectionPool:
+    """
+    Reutiliza conexiones SMTP ya autenticadas entre envíos. Las conexiones ociosas
+    se comprueban con NOOP antes de reutilizarlas y se cierran si llevan demasiado
+    tiempo paradas; si el servidor corta la conexión a mitad de envío se reconecta
+    una vez. El número de conexiones abiertas a la vez está limitado.
+    """
+
+    def __init__(self, host, port, username=None, password=None, starttls=True,
+                 max_connections=3, noop_after=SMTP_NOOP_AFTER_SECONDS, max_idle=SMTP_MAX_IDLE_SECONDS,
+                 timeout=SMTP_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.max_connections = max_connections
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []  # (conexión, momento del último uso)
+        self.in_use = 0
+        self.opened = 0
+        self.reused = 0
+        self.reconnects = 0
+        self.sent = 0
+        self.failed = 0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.username and self.password:
+                server.login(self.username, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        self.opened += 1
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _checkout(self):
+        """Devuelve una conexión ociosa que siga viva o abre una nueva"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                server, last_used = self.idle.pop()
+            idle_for = time.time() - last_used
+            if idle_for > self.max_idle:
+                self._close(server)
+                continue
+            if idle_for > self.noop_after:
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("NOOP rechazado")
+                except Exception:
+                    self._close(server)
+                    continue
+            self.reused += 1
+            return server
+        return self._connect()
+
+    @staticmethod
+    def _send_message(server, from_addr, to_addr, message):
+        """
+        Envía message, que puede ser el texto completo o una función que devuelve
+        un iterador de bloques de bytes ya codificados para transmitirlos sin
+        construir el mensaje entero en memoria.
+        """
+        if not callable(message):
+            server.sendmail(from_addr, to_addr, message)
+            return
+
+        server.ehlo_or_helo_if_needed()
+        code, response = server.mail(from_addr)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, response, from_addr)
+        code, response = server.rcpt(to_addr)
+        if code not in (250, 251):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused({to_addr: (code, response)})
+        code, response = server.docmd("data")
+        if code != 354:
+            server.rset()
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in message():
+            server.send(chunk)
+        server.send(b".\r\n")
+        code, response = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+    def _checkin(self, server):
+        with self.lock:
+            self.idle.append((server, time.time()))
+
+    def sendmail(self, from_addr, to_addrs, message):
+        with self.slots:
+            self.in_use += 1
+            server = None
+            try:
+                server = self._checkout()
+                try:
+                    self._send_message(server, from_addr, to_addrs, message)
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError):
+                    # La conexión reutilizada estaba muerta: una nueva y un segundo intento
+                    self._close(server)
+                    self.reconnects += 1
+                    server = self._connect()
+                    self._send_message(server, from_addr, to_addrs, message)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                # Rechazo del mensaje, no de la conexión: se puede seguir usando
+                self.failed += 1
+                self._checkin(server)
+                raise
+            except Exception:
+                self.failed += 1
+                if server is not None:
+                    self._close(server)
+                raise
+            finally:
+                self.in_use -= 1
+
+            self.sent += 1
+            self._checkin(server)
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server, _ in idle:
+            self._close(server)
+
+    def stats(self):
+        return {
+            "host": f"{self.host}:{self.port}",
+            "max_connections": self.max_connections,
+            "in_use": self.in_use,
+            "idle": len(self.idle),
+            "opened": self.opened,
+            "reused": self.reused,
+            "reconnects": self.reconnects,
+            "sent": self.sent,
+            "failed": self.failed
+        }
+
+
+smtp_pool = SMTPConnectionPool(
+    SMTP_HOST, SMTP_PORT, GMAIL_EMAIL, GMAIL_APP_PASSWORD,
+    starttls=SMTP_STARTTLS, max_connections=SMTP_MAX_CONNECTIONS
+)
+
+
+@app.on_event("shutdown")
+async def close_smtp_pool():
+    await run_in_threadpool(smtp_pool.close_all)
+
+
+# --- VALIDACIÓN DEL DOCX ---
+# La optimización del DOCX (optimize_docx) está en common/docx_utils.py
+def validate_docx(docx_path):
+    """
+    Comprueba que el DOCX es un ZIP legible con las partes mínimas de un documento
+    de Word antes de guardarlo en caché y enviarlo. Solo lee el directorio central
+    del ZIP, no descomprime nada.
+    """
+    try:
+        with zipfile.ZipFile(docx_path) as zf:
+            names = set(zf.namelist())
+    except (zipfile.BadZipFile, OSError) as e:
+        raise Exception(f"El archivo generado no es un DOCX válido: {e}")
+    missing = {'[Content_Types].xml', 'word/document.xml'} - names
+    if missing:
+        raise Exception(f"El archivo generado no es un DOCX válido: faltan {', '.join(sorted(missing))}")
+
+
 # --- LÓGICA DE CONVERSIÓN ---
 def calculate_timeout(pdf_content):
     """Calcula timeout dinámico basado en el tamaño del PDF (optimizado para pdf2docx)"""
-    pdf_size_mb = len(pdf_content) / (1024 * 1024)
-    
+    return calculate_timeout_for_size(len(pdf_content))
+
+def calculate_timeout_for_size(pdf_size):
+    """Igual que calculate_timeout pero a partir del tamaño en bytes, sin cargar el PDF"""
+    timeout, label = size_bucket_timeout(pdf_size)
+    print(f"PDF {label} ({pdf_size / (1024 * 1024):.2f}MB), usando timeout de {timeout} segundos")
+    return timeout
+
+def size_bucket_timeout(pdf_size):
+    """Timeout del tramo de tamaño del PDF y nombre del tramo"""
+    pdf_size_mb = pdf_size / (1024 * 1024)
+
     # Timeout más agresivo ya que pdf2docx es más rápido que LibreOffice
     if pdf_size_mb > 10:
-        timeout = 300  # 5 minutos para PDFs muy grandes (antes 600s)
-        print(f"PDF grande ({pdf_size_mb:.2f}MB), usando timeout de {timeout} segundos")
+        return 300, "grande"  # 5 minutos para PDFs muy grandes (antes 600s)
     elif pdf_size_mb > 5:
-        timeout = 180  # 3 minutos para PDFs medianos (antes 300s)
-        print(f"PDF mediano ({pdf_size_mb:.2f}MB), usando timeout de {timeout} segundos")
+        return 180, "mediano"  # 3 minutos para PDFs medianos (antes 300s)
     elif pdf_size_mb > 2:
-        timeout = 90   # 1.5 minutos para PDFs pequeños (antes 180s)
-        print(f"PDF pequeño ({pdf_size_mb:.2f}MB), usando timeout de {timeout} segundos")
-    else:
-        timeout = 45   # 45 segundos para PDFs muy pequeños (antes 120s)
-        print(f"PDF muy pequeño ({pdf_size_mb:.2f}MB), usando timeout de {timeout} segundos")
-    
-    return timeout
+        return 90, "pequeño"  # 1.5 minutos para PDFs pequeños (antes 180s)
+    return 45, "muy pequeño"  # 45 segundos para PDFs muy pequeños (antes 120s)
+
+def estimate_conversion_cost(pdf_size, pages, engine):
+    """
+    Segundos estimados de conversión para ordenar la cola del pool: el tramo de
+    tamaño de calculate_timeout, o el número de páginas si pesa más (un PDF ligero
+    de 300 páginas no es un trabajo corto)
+    """
+    cost = max(size_bucket_timeout(pdf_size)[0], pages * SCHEDULER_SECONDS_PER_PAGE)
+    if engine == 'text':
+        cost *= SCHEDULER_TEXT_COST_FACTOR
+    return cost
 
 def sanitize_filename(filename):
     """Limpia el nombre de archivo para evitar problemas con caracteres especiales"""
@@ -71,59 +1063,116 @@ def sanitize_filename(filename):
     print(f"Nombre de archivo sanitizado: '{filename}' → '{cleaned_filename}'")
     return cleaned_filename
 
+def iter_mime_message(from_email, to_email, subject, html_content, attachments=None):
+    """
+    Genera el email MIME por bloques. Los adjuntos se codifican en base64 leyendo
+    del disco (clave 'path') o de memoria (clave 'content') de 57 KB en 57 KB, así
+    nunca está el mensaje entero en memoria.
+
+    No hace falta el dot-stuffing de SMTP porque ninguna línea empieza por '.':
+    las cabeceras se pliegan con CRLF y sus líneas de continuación empiezan por
+    espacio, y el resto son nombres de cabecera, delimitadores '--' o base64.
+    """
+    boundary = f"===============_{uuid.uuid4().hex}=="
+    encoded_subject = Header(subject, 'utf-8').encode(linesep='\r\n')
+
+    yield (
+        f"From: {format_address_header(from_email)}\r\n"
+        f"To: {format_address_header(to_email)}\r\n"
+        f"Subject: {encoded_subject}\r\n"
+        f"Date: {formatdate(localtime=True)}\r\n"
+        f"Message-ID: {make_msgid()}\r\n"
+        f"MIME-Version: 1.0\r\n"
+        f"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n"
+        f"\r\n"
+        f"--{boundary}\r\n"
+        f"Content-Type: text/html; charset=\"utf-8\"\r\n"
+        f"Content-Transfer-Encoding: base64\r\n"
+        f"\r\n"
+    ).encode('ascii')
+    yield from _iter_base64_lines(BytesIO(html_content.encode('utf-8')))
+
+    for attachment in attachments or []:
+        filename = attachment['filename']
+        if filename.isascii():
+            # Sin caracteres de control: un salto de línea en el nombre rompería la cabecera
+            safe_name = re.sub(r'[\\"\x00-\x1f\x7f]', '_', filename)
+            disposition = f'attachment; filename="{safe_name}"'
+        else:
+            disposition = f"attachment; filename*=utf-8''{quote(filename)}"
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: application/octet-stream\r\n"
+            f"Content-Transfer-Encoding: base64\r\n"
+            f"Content-Disposition: {disposition}\r\n"
+            f"\r\n"
+        ).encode('ascii')
+        if 'path' in attachment:
+            with open(attachment['path'], 'rb') as f:
+                yield from _iter_base64_lines(f)
+        else:
+            yield from _iter_base64_lines(BytesIO(attachment['content']))
+
+    yield f"--{boundary}--\r\n".encode('ascii')
+
+
+def format_address_header(address):
+    """Dirección lista para una cabecera ASCII: un nombre con acentos va como encoded-word (RFC 2047)"""
+    name, addr = parseaddr(address)
+    if not addr:
+        return Header(address, 'utf-8').encode(linesep='\r\n')
+    return formataddr((name, addr))
+
+
+def _iter_base64_lines(stream, chunk_size=57 * 1024):
+    """Codifica un stream en líneas base64 de 76 caracteres (57 bytes) terminadas en CRLF"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        encoded = base64.b64encode(chunk)
+        yield b"\r\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76)) + b"\r\n"
+
+
 def send_email_with_gmail(to_email, subject, html_content, attachments=None):
     """Envía email usando Gmail SMTP con adjuntos"""
     try:
-        # Crear mensaje
-        msg = MIMEMultipart()
-        msg['From'] = GMAIL_EMAIL
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Adjuntar contenido HTML
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        # Adjuntar archivos si se proporcionan
-        if attachments:
-            for attachment in attachments:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment['content'])
-                encoders.encode_base64(part)
-                part.add_header(
-                    'Content-Disposition',
-                    f'attachment; filename= {attachment["filename"]}',
-                )
-                msg.attach(part)
-        
-        # Conectar con Gmail SMTP
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(GMAIL_EMAIL, GMAIL_APP_PASSWORD)
-        
-        # Enviar email
-        text = msg.as_string()
-        server.sendmail(GMAIL_EMAIL, to_email, text)
-        server.quit()
+        # El mensaje se genera mientras se envía por una conexión del pool de Gmail SMTP
+        with SMTP_SEND_SECONDS.time():
+            smtp_pool.sendmail(
+                GMAIL_EMAIL, to_email,
+                lambda: iter_mime_message(GMAIL_EMAIL, to_email, subject, html_content, attachments)
+            )
         
+        EMAILS_SENT.labels(outcome="sent").inc()
         print(f"Email enviado exitosamente a {to_email}")
         return True
         
     except Exception as e:
+        EMAILS_SENT.labels(outcome="failed").inc()
         print(f"Error enviando email con Gmail: {e}")
         return False
 
-def handle_conversion_timeout(pdf_filename, from_email, timeout_used):
-    """Maneja el caso cuando una conversión tarda demasiado tiempo"""
+def handle_conversion_timeout(pdf_filename, from_email, timeout_used, fast_mode=False):
+    """Avisa de que la conversión se ha detenido por superar su tiempo máximo"""
     try:
-        subject = f"Tu fichero esta tardando mucho: {pdf_filename}"
+        subject = f"No hemos podido convertir tu fichero a tiempo: {pdf_filename}"
+        if fast_mode:
+            suggestion = "1. Divide el PDF en partes más pequeñas y envíalas por separado<br>"
+        else:
+            suggestion = (
+                '1. Si solo necesitas el texto, envíalo de nuevo con <strong>"word rapido"</strong> en el asunto: '
+                "el modo rápido genera un documento de solo texto mucho más deprisa<br>"
+                "2. Divide el PDF en partes más pequeñas y envíalas por separado<br>"
+            )
         html_content = f"""
         <strong>Hola,</strong><br><br>
-        Tu fichero <strong>{pdf_filename}</strong> esta tardando mas tiempo de lo habitual en procesarse.<br><br>
+        La conversión de <strong>{pdf_filename}</strong> ha superado el tiempo máximo y se ha detenido.<br><br>
         
         <strong>Informacion del proceso:</strong><br>
         • Archivo: {pdf_filename}<br>
-        • Tiempo maximo esperado: {timeout_used} segundos<br>
-        • Estado: En proceso (background)<br><br>
+        • Tiempo maximo: {timeout_used} segundos<br>
+        • Estado: Detenido, no se ha generado el documento<br><br>
         
         <strong>Posibles razones:</strong><br>
         • El PDF es muy grande o complejo<br>
@@ -131,11 +1180,8 @@ def handle_conversion_timeout(pdf_filename, from_email, timeout_used):
         • Hay alta demanda en el sistema<br><br>
         
         <strong>Que puedes hacer:</strong><br>
-        1. Espera unos minutos y recibiras un email cuando termine<br>
-        2. Si no recibes nada en 30 minutos, envia el PDF de nuevo<br>
-        3. Para PDFs muy grandes, considera comprimirlos primero<br><br>
-        
-        <small><em>El archivo seguira procesandose en segundo plano. No necesitas hacer nada mas.</em></small>
+        {suggestion}<br>
+        <small><em>No recibirás otro email con este fichero: para convertirlo tienes que enviarlo de nuevo.</em></small>
         """
         
         success = send_email_with_gmail(from_email, subject, html_content)
@@ -145,18 +1191,24 @@ def handle_conversion_timeout(pdf_filename, from_email, timeout_used):
         print(f"Error enviando email de timeout: {e}")
         return False
 
-def convert_pdf_to_docx_with_pdf2docx(pdf_content, pdf_filename, timeout):
+def convert_pdf_to_docx_with_pdf2docx(pdf_content, pdf_filename, timeout, work_dir=None, keep_on_disk=False):
     """
     Convierte PDF a DOCX usando pdf2docx library (más ligero que LibreOffice)
+
+    El timeout lo hace cumplir ConversionPool matando el proceso; por eso el
+    directorio de trabajo puede venir del proceso padre, que lo borra aunque
+    la conversión se haya matado a medias. Con keep_on_disk se devuelve la ruta
+    del DOCX en lugar de su contenido.
     """
     print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Iniciando conversión con pdf2docx")
     
     # Crear directorio temporal
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Guardar PDF en archivo temporal
+    with (tempfile.TemporaryDirectory() if work_dir is None else nullcontext(work_dir)) as temp_dir:
+        # Guardar PDF en archivo temporal (sin contenido, el PDF ya está guardado ahí)
         pdf_path = os.path.join(temp_dir, pdf_filename)
-        with open(pdf_path, 'wb') as f:
-            f.write(pdf_content)
+        if pdf_content is not None:
+            with open(pdf_path, 'wb') as f:
+                f.write(pdf_content)
         
         print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] PDF guardado en: {pdf_path}")
         
@@ -170,26 +1222,63 @@ def convert_pdf_to_docx_with_pdf2docx(pdf_content, pdf_filename, timeout):
         conversion_start = time.time()
         
         try:
-            # Usar pdf2docx para convertir
-            cv = Converter(pdf_path)
-            cv.convert(docx_path, start=0, end=None)
-            cv.close()
+            with trace_span("pdf2docx.convert", {"pdf.bytes": os.path.getsize(pdf_path)}) as span:
+                # Usar pdf2docx para convertir
+                cv = Converter(pdf_path)
+                try:
+                    page_count = len(cv.fitz_doc)
+                    span.set_attribute("pdf.pages", page_count)
+                    workers = min(PAGE_PARALLEL_WORKERS, page_count, _page_workers_budget.get() or PAGE_PARALLEL_WORKERS)
+                    if workers > 1 and page_count >= PAGE_PARALLEL_MIN_PAGES:
+                        # Los ficheros intermedios se escriben en el directorio actual,
+                        # así que se trabaja dentro del directorio temporal de esta conversión.
+                        span.set_attribute("pdf2docx.workers", workers)
+                        print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Conversión en paralelo: "
+                              f"{page_count} páginas en {workers} procesos")
+                        # pdf2docx abre Pool() con os.cpu_count() procesos, pero solo workers
+                        # reciben páginas; el resto se queda sin trabajo.
+                        previous_cwd = os.getcwd()
+                        os.chdir(temp_dir)
+                        try:
+                            cv.convert(docx_path, start=0, end=None, multi_processing=True, cpu_count=workers)
+                        finally:
+                            os.chdir(previous_cwd)
+                    else:
+                        cv.convert(docx_path, start=0, end=None)
+                finally:
+                    cv.close()
+                span.set_attribute("docx.bytes", os.path.getsize(docx_path))
             
             conversion_time = time.time() - conversion_start
             print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Conversión completada en {conversion_time:.2f}s")
             
-            # Leer el archivo DOCX generado
-            with open(docx_path, 'rb') as f:
-                docx_content = f.read()
-            
             # Verificar que sea un DOCX válido
-            if not docx_content.startswith(b'PK'):
-                raise Exception(f"El archivo generado no es un DOCX válido (no empieza con PK)")
+            with open(docx_path, 'rb') as f:
+                if f.read(2) != b'PK':
+                    raise Exception(f"El archivo generado no es un DOCX válido (no empieza con PK)")
             
+            # Reempaquetar el DOCX antes de entregarlo (y de guardarlo en caché)
+            if DOCX_OPTIMIZE:
+                with trace_span("docx.optimize") as span:
+                    stats = optimize_docx(docx_path)
+                    span.set_attributes({
+                        "docx.bytes": stats["optimized_bytes"],
+                        "docx.saved_bytes": stats["saved_bytes"],
+                        "docx.images_downsampled": stats["images_downsampled"],
+                        "docx.media_deduplicated": stats["media_deduplicated"]
+                    })
+
             # Verificar tamaño
-            file_size_mb = len(docx_content) / (1024 * 1024)
+            file_size_mb = os.path.getsize(docx_path) / (1024 * 1024)
             print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Conversión exitosa. Tamaño DOCX: {file_size_mb:.2f} MB")
             
+            if keep_on_disk:
+                return docx_path, None
+
+            # Leer el archivo DOCX generado
+            with open(docx_path, 'rb') as f:
+                docx_content = f.read()
+            
             return docx_content, None
             
         except Exception as e:
@@ -197,170 +1286,1080 @@ def convert_pdf_to_docx_with_pdf2docx(pdf_content, pdf_filename, timeout):
             print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Error en conversión después de {conversion_time:.2f}s: {e}")
             raise Exception(f"Error en la conversión: {e}")
 
-# --- ENDPOINT DE LA API ---
-@app.post("/api/convert")
-async def handler(request: Request):
-    try:
-        print("Recibiendo solicitud de SendGrid...")
-        
-        # SendGrid envía los datos como multipart/form-data con el email MIME
-        form = await request.form()
-        print(f"Campos del formulario: {list(form.keys())}")
-        
-        # El email completo está en el campo 'email' o 'message' dependiendo de la configuración
-        email_content = None
-        for field_name in ['email', 'message', 'raw_message']:
-            if field_name in form:
-                email_content = form[field_name]
-                print(f"Email encontrado en campo: {field_name}")
-                break
-        
-        if not email_content:
-            print("Error: No se encontró el contenido del email en el formulario")
-            return JSONResponse({"error": "No email content found in form data"}, status_code=400)
-        
-        # Parsear el email MIME
-        print("Parseando email MIME...")
-        if isinstance(email_content, str):
-            # Si es string, convertir a bytes
-            email_bytes = email_content.encode('utf-8')
-        else:
-            # Si ya es bytes o UploadFile, leer el contenido
-            if hasattr(email_content, 'read'):
-                email_bytes = await email_content.read()
-            else:
-                email_bytes = email_content
-        
-        # Parsear el mensaje MIME
-        msg = email.message_from_bytes(email_bytes, policy=policy.default)
-        
-        # Extraer información del email
-        from_email = msg.get('From', '').strip()
-        subject = msg.get('Subject', '').lower()
-        
-        print(f"Email de: {from_email}")
-        print(f"Asunto: {subject}")
-        
-        # Validar datos básicos
-        if not from_email:
-            print("Error: No se encontró email remitente")
-            return JSONResponse({"error": "No from email found"}, status_code=400)
-        
-        # Extraer archivos adjuntos
-        pdf_attachments = []
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = part.get('Content-Disposition', '')
-            
-            print(f"Parte encontrada - Content-Type: {content_type}, Content-Disposition: {content_disposition}")
-            
-            # Buscar archivos adjuntos PDF
-            if 'attachment' in content_disposition and 'pdf' in content_type.lower():
-                filename = part.get_filename()
-                if filename and filename.lower().endswith('.pdf'):
-                    file_content = part.get_payload(decode=True)
-                    if file_content:
-                        pdf_attachments.append({
-                            'filename': filename,
-                            'content': file_content,
-                            'content_type': content_type
-                        })
-                        print(f"PDF adjunto encontrado: {filename}, tamaño: {len(file_content)} bytes")
-        
-        if not pdf_attachments:
-            print("Error: No se encontraron archivos PDF adjuntos")
-            return JSONResponse({"error": "No PDF attachments found"}, status_code=400)
-        
-        # Usar el primer PDF encontrado
-        pdf_attachment = pdf_attachments[0]
-        original_filename = pdf_attachment['filename']
-        file_buffer = pdf_attachment['content']
-        
-        # Sanitizar el nombre del archivo para evitar problemas
-        sanitized_filename = sanitize_filename(original_filename)
-        
-        print(f"Procesando archivo: {original_filename}")
-        print(f"Nombre sanitizado: {sanitized_filename}")
+# --- TRIAJE DE PDFs ---
+# Antes de convertir se mira el PDF por encima con PyMuPDF (solo la tabla xref
+# y unas pocas páginas de muestra) para decidir qué hacer con él. Cada decisión
+# se añade a TRIAGE_LOG_PATH para poder ajustar las reglas con datos reales.
+# El PDF aún no se ha validado, así que el triaje corre en el pool de conversión:
+# si se cuelga o revienta se mata su proceso y el PDF se rechaza.
 
-        # 2. VALIDACIÓN
-        is_pdf = original_filename.lower().endswith('.pdf')
-        wants_docx = 'word' in subject or 'docx' in subject
+class PDFRejected(Exception):
+    """El PDF no se puede convertir; el mensaje se muestra al usuario"""
 
-        print(f"Es PDF: {is_pdf}, Quiere DOCX: {wants_docx}")
 
-        if not is_pdf or not wants_docx:
-            print("El fichero no es un PDF o no se pidió conversión a Word. No se hace nada.")
-            return PlainTextResponse("OK", status_code=200)
+def _inspect_pdf(doc, info):
+    if doc.needs_pass:
+        info.update(encrypted=True, route="reject", reason="El PDF está protegido con contraseña")
+        return
+    info["pages"] = doc.page_count
+    # Con contraseña de propietario solamente se abre sin pedir nada, pero sigue cifrado
+    info["encrypted"] = bool(doc.is_encrypted or (doc.metadata or {}).get("encryption"))
+    if doc.page_count == 0:
+        info.update(route="reject", reason="El PDF no tiene páginas")
+        return
+    if doc.page_count > TRIAGE_MAX_PAGES:
+        info.update(route="reject", reason=f"El PDF tiene {doc.page_count} páginas (máximo {TRIAGE_MAX_PAGES})")
+        return
 
-        # 3. CONVERSIÓN
-        print("Iniciando conversión a DOCX con pdf2docx...")
-        
-        # Calcular timeout dinámico
-        timeout = calculate_timeout(file_buffer)
-        print(f"Timeout configurado: {timeout} segundos")
-        
-        # Medir tiempo de conversión
-        conversion_start_time = time.time()
-        
+    coverage = 0.0
+    for page_number in sample_page_numbers(doc.page_count, TRIAGE_SAMPLE_PAGES):
+        page = doc[page_number]
+        page_area = abs(page.rect) or 1
+        chars = len(page.get_text("text").strip())
+        if chars:
+            info["text_pages"] += 1
+            info["text_chars"] += chars
+        image_area = sum(abs(fitz.Rect(image["bbox"]) & page.rect) for image in page.get_image_info())
+        coverage += min(image_area / page_area, 1.0)
+        info["sampled_pages"] += 1
+    info["image_coverage"] = round(coverage / info["sampled_pages"], 3)
+
+
+def _new_triage_info():
+    return {
+        "pages": 0,
+        "encrypted": False,
+        "sampled_pages": 0,
+        "text_pages": 0,
+        "text_chars": 0,
+        "image_coverage": 0.0,
+        "route": "pdf2docx",
+        "reason": None
+    }
+
+
+def triage_pdf(pdf_path):
+    """
+    Lee número de páginas, cifrado, presencia de capa de texto y cobertura de
+    imágenes, y decide si el PDF se puede convertir ('pdf2docx') o no ('reject').
+    """
+    start = time.time()
+    info = _new_triage_info()
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        info.update(route="reject", reason="El archivo no es un PDF válido", error=str(e))
+    else:
+        with doc:
+            _inspect_pdf(doc, info)
+
+    accepted = info["route"] != "reject"
+    info["scanned"] = accepted and info["text_pages"] == 0 and info["image_coverage"] > 0.5
+    info["text_only"] = accepted and info["text_pages"] == info["sampled_pages"] and info["image_coverage"] == 0
+    info["duration_ms"] = round((time.time() - start) * 1000, 1)
+    return info
+
+
+async def run_triage(pdf_path):
+    """triage_pdf en un proceso del pool, con TRIAGE_TIMEOUT_SECONDS como límite"""
+    start = time.time()
+    while True:
         try:
-            docx_buffer, download_info = convert_pdf_to_docx_with_pdf2docx(file_buffer, sanitized_filename, timeout)
-            conversion_end_time = time.time()
-            conversion_duration = conversion_end_time - conversion_start_time
-            
-            print(f"Conversión completada en {conversion_duration:.2f} segundos.")
-            
-            # Log detallado del resultado
-            if docx_buffer:
-                docx_size = len(docx_buffer) / (1024 * 1024)
-                print(f"Resultado: Conversión exitosa - {docx_size:.2f}MB adjunto")
-            else:
-                print("Resultado: Error - No se generó archivo")
+            return await conversion_pool.run(triage_pdf, pdf_path, timeout=TRIAGE_TIMEOUT_SECONDS, cost=0)
+        except ConversionPoolBusy as e:
+            print(f"{e}; el triaje espera {CONVERSION_BUSY_RETRY_SECONDS}s")
+            await asyncio.sleep(CONVERSION_BUSY_RETRY_SECONDS)
+        except ConversionTimeout:
+            reason, error = f"El PDF tarda demasiado en analizarse (más de {TRIAGE_TIMEOUT_SECONDS}s)", None
+            break
         except Exception as e:
-            # Verificar si es un error de timeout
-            error_msg = str(e)
-            if "tardando mas de" in error_msg.lower() or "timeout" in error_msg.lower():
-                print(f"Error de timeout detectado: {error_msg}")
-                
-                # Enviar email informativo de timeout
-                timeout_sent = handle_conversion_timeout(original_filename, from_email, timeout)
-                
-                if timeout_sent:
-                    print("Email de timeout enviado exitosamente")
-                    return PlainTextResponse("Timeout handled", status_code=200)
-                else:
-                    print("Error enviando email de timeout")
-                    return JSONResponse({"error": "Error sending timeout email"}, status_code=500)
+            reason, error = "El archivo no es un PDF válido", str(e)
+            break
+
+    info = _new_triage_info()
+    info.update(route="reject", reason=reason, scanned=False, text_only=False,
+                duration_ms=round((time.time() - start) * 1000, 1))
+    if error:
+        info["error"] = error
+    return info
+
+
+def log_triage_decision(filename, size, sha256, info):
+    print(f"Triaje de {filename}: ruta={info['route']}, {info['pages']} páginas, "
+          f"texto en {info['text_pages']}/{info['sampled_pages']} muestras, "
+          f"imágenes {info['image_coverage']:.0%}, cifrado={info['encrypted']} ({info['duration_ms']} ms)"
+          + (f" - {info['reason']}" if info['reason'] else ""))
+    record = {"time": datetime.now().isoformat(), "filename": filename, "size": size, "sha256": sha256, **info}
+    try:
+        os.makedirs(os.path.dirname(TRIAGE_LOG_PATH), exist_ok=True)
+        with open(TRIAGE_LOG_PATH, 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"No se pudo registrar el triaje: {e}")
+
+
+def handle_rejected_pdfs(rejected, from_email):
+    """Avisa al usuario de que sus PDFs no se pueden convertir y por qué"""
+    try:
+        items = "".join(f"• <strong>{attachment['filename']}</strong>: {reason}<br>" for attachment, reason in rejected)
+        subject = "No hemos podido convertir tu fichero" if len(rejected) == 1 else "No hemos podido convertir tus ficheros"
+        html_content = f"""
+        <strong>Hola,</strong><br><br>
+        No hemos podido convertir los siguientes ficheros:<br><br>
+        {items}<br>
+        Si el PDF tiene contraseña, quítala y envíalo de nuevo.
+        """
+        return send_email_with_gmail(from_email, subject, html_content)
+    except Exception as e:
+        print(f"Error enviando email de PDF rechazado: {e}")
+        return False
+
+
+def choose_route(triage, fast_requested):
+    """Motor final: 'text' (rápido), 'pdf2docx' o 'reject'"""
+    if triage['route'] == 'reject':
+        return 'reject'
+    if fast_requested:
+        if triage['text_pages']:
+            return 'text'
+        # Sin capa de texto el modo rápido devolvería un documento vacío
+        print("Modo rápido pedido, pero el PDF no tiene texto: se convierte con pdf2docx")
+        return 'pdf2docx'
+    if TRIAGE_AUTO_FAST and triage['text_only']:
+        return 'text'
+    return 'pdf2docx'
+
+
+# --- PARSEO MIME EN STREAMING ---
+# El email se lee del spool línea a línea: las partes PDF se decodifican directamente
+# a disco y el resto se salta, así la memoria no depende del tamaño del email.
+def _read_mime_headers(f):
+    """Lee un bloque de cabeceras MIME hasta la línea en blanco"""
+    lines = []
+    total = 0
+    while True:
+        line = f.readline(MIME_LINE_LIMIT)
+        if not line or line in (b'\r\n', b'\n'):
+            break
+        total += len(line)
+        if total <= MIME_MAX_HEADER_BYTES:
+            lines.append(line)
+    return BytesHeaderParser(policy=policy.default).parsebytes(b''.join(lines))
+
+
+def _match_boundary(line, boundaries):
+    """Devuelve (nivel, es_cierre) si la línea es un delimitador de alguno de los multipart abiertos"""
+    if not line.startswith(b'--'):
+        return None
+    stripped = line.rstrip()
+    for level in range(len(boundaries) - 1, -1, -1):
+        delimiter = b'--' + boundaries[level]
+        if stripped == delimiter:
+            return level, False
+        if stripped == delimiter + b'--':
+            return level, True
+    return None
+
+
+def _skip_mime_body(f, boundaries):
+    """Descarta líneas hasta el siguiente delimitador; devuelve el delimitador o None si se acaba el fichero"""
+    while True:
+        line = f.readline(MIME_LINE_LIMIT)
+        if not line:
+            return None
+        match = _match_boundary(line, boundaries)
+        if match is not None:
+            return match
+
+
+def _decode_mime_body_to_file(f, boundaries, encoding, out, sha256):
+    """Decodifica el cuerpo de una parte en out por bloques; devuelve (delimitador, bytes escritos)"""
+    written = 0
+    pending = b''        # base64 sin decodificar (siempre menos de 4 caracteres tras cada bloque)
+    pending_newline = b''  # el salto de línea previo a un delimitador no pertenece al contenido
+
+    def emit(data):
+        nonlocal written
+        if data:
+            out.write(data)
+            sha256.update(data)
+            written += len(data)
+
+    while True:
+        line = f.readline(MIME_LINE_LIMIT)
+        match = _match_boundary(line, boundaries) if line else None
+        if not line or match is not None:
+            break
+        if encoding == 'base64':
+            pending += b''.join(line.split())
+            usable = len(pending) - len(pending) % 4
+            emit(binascii.a2b_base64(pending[:usable]))
+            pending = pending[usable:]
+        elif encoding == 'quoted-printable':
+            emit(pending_newline)
+            body = line.rstrip(b'\r\n')
+            if body.endswith(b'='):
+                # Salto de línea "suave": la línea continúa en la siguiente
+                emit(binascii.a2b_qp(body[:-1]))
+                pending_newline = b''
             else:
-                # Es otro tipo de error, propagarlo
-                print(f"Error de conversión no manejado: {error_msg}")
-                raise e
+                emit(binascii.a2b_qp(body))
+                pending_newline = b'\n' if len(body) < len(line) else b''
+        else:
+            emit(pending_newline)
+            body = line.rstrip(b'\r\n')
+            pending_newline = line[len(body):]
+            emit(body)
 
-        # 4. ENVÍO DEL EMAIL DE RESPUESTA
-        output_filename = f"{original_filename.split('.')[0]}.docx"
-        
-        # Archivo convertido - enviar adjunto directo con Gmail
-        subject = f"Tu fichero convertido: {output_filename}"
-        html_content = f"<strong>Hola,</strong><br>hemos convertido tu fichero <strong>{original_filename}</strong> a formato Word (.docx).<br>Puedes descargarlo adjunto en este correo."
-        
-        attachments = [{
+    if encoding == 'base64' and pending:
+        emit(binascii.a2b_base64(pending + b'=' * (-len(pending) % 4)))
+    return match, written
+
+
+def _is_pdf_attachment(headers):
+    content_disposition = str(headers.get('Content-Disposition', ''))
+    if 'attachment' not in content_disposition or 'pdf' not in headers.get_content_type().lower():
+        return False
+    filename = headers.get_filename()
+    return bool(filename) and filename.lower().endswith('.pdf')
+
+
+def _walk_mime_part(f, headers, boundaries, dest_dir, attachments):
+    """
+    Procesa una parte (recursivamente si es multipart o un email reenviado como
+    adjunto) y devuelve el delimitador que la cierra
+    """
+    content_type = headers.get_content_type()
+    print(f"Parte encontrada - Content-Type: {content_type}, "
+          f"Content-Disposition: {headers.get('Content-Disposition', '')}")
+
+    if content_type == 'message/rfc822':
+        # El cuerpo es otro email completo: sus cabeceras y después sus partes
+        encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+        if encoding in ('7bit', '8bit', 'binary'):
+            return _walk_mime_part(f, _read_mime_headers(f), boundaries, dest_dir, attachments)
+
+    boundary = headers.get_param('boundary') if headers.get_content_maintype() == 'multipart' else None
+    if boundary:
+        boundaries = boundaries + [boundary.encode('latin-1')]
+        level = len(boundaries) - 1
+        # Saltar el preámbulo hasta el primer delimitador
+        match = _skip_mime_body(f, boundaries)
+        while match is not None and match == (level, False):
+            part_headers = _read_mime_headers(f)
+            match = _walk_mime_part(f, part_headers, boundaries, dest_dir, attachments)
+        if match == (level, True):
+            # Epílogo tras el cierre de este multipart
+            match = _skip_mime_body(f, boundaries[:-1])
+        return match
+
+    if not _is_pdf_attachment(headers):
+        return _skip_mime_body(f, boundaries)
+
+    filename = headers.get_filename()
+    encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+    path = os.path.join(dest_dir, f"attachment_{len(attachments)}.pdf")
+    sha256 = hashlib.sha256()
+    with open(path, 'wb') as out:
+        match, size = _decode_mime_body_to_file(f, boundaries, encoding, out, sha256)
+
+    if size:
+        attachments.append({
+            'filename': filename,
+            'path': path,
+            'size': size,
+            'sha256': sha256.hexdigest(),
+            'content_type': content_type
+        })
+        print(f"PDF adjunto encontrado: {filename}, tamaño: {size} bytes")
+    else:
+        os.remove(path)
+    return match
+
+
+def parse_email_streaming(email_path, dest_dir):
+    """
+    Parsea el email guardado en email_path sin cargarlo entero en memoria.
+    Devuelve (cabeceras del mensaje, lista de PDFs adjuntos guardados en dest_dir).
+    """
+    attachments = []
+    with open(email_path, 'rb') as f:
+        headers = _read_mime_headers(f)
+        _walk_mime_part(f, headers, [], dest_dir, attachments)
+    return headers, attachments
+
+
+async def stream_email_field_to_file(request, dest_path):
+    """
+    Lee el multipart/form-data de SendGrid por bloques y vuelca el campo con el email
+    directamente a dest_path. Devuelve (nombre del campo usado o None, campos recibidos).
+    """
+    _, params = parse_options_header(request.headers.get('content-type', ''))
+    boundary = params.get(b'boundary')
+    if not boundary:
+        raise ValueError("Petición multipart sin boundary")
+
+    fields = []
+    state = {'header_field': b'', 'header_value': b'', 'headers': {}, 'writing': False, 'found': None}
+
+    with open(dest_path, 'wb') as out:
+        def on_part_begin():
+            state['headers'] = {}
+
+        def on_header_field(data, start, end):
+            state['header_field'] += data[start:end]
+
+        def on_header_value(data, start, end):
+            state['header_value'] += data[start:end]
+
+        def on_header_end():
+            state['headers'][state['header_field'].lower()] = state['header_value']
+            state['header_field'] = b''
+            state['header_value'] = b''
+
+        def on_headers_finished():
+            _, options = parse_options_header(state['headers'].get(b'content-disposition', b''))
+            name = options.get(b'name', b'').decode('latin-1')
+            fields.append(name)
+            state['writing'] = state['found'] is None and name in EMAIL_FORM_FIELDS
+            if state['writing']:
+                state['found'] = name
+
+        def on_part_data(data, start, end):
+            if state['writing']:
+                out.write(data[start:end])
+
+        def on_part_end():
+            state['writing'] = False
+
+        parser = MultipartParser(boundary, {
+            'on_part_begin': on_part_begin,
+            'on_header_field': on_header_field,
+            'on_header_value': on_header_value,
+            'on_header_end': on_header_end,
+            'on_headers_finished': on_headers_finished,
+            'on_part_data': on_part_data,
+            'on_part_end': on_part_end
+        })
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+
+        out.flush()
+        os.fsync(out.fileno())
+
+    return state['found'], fields
+
+
+# --- COLA DE TRABAJOS ---
+# Los emails recibidos se guardan en disco y se procesan en segundo plano, así el
+# webhook de SendGrid responde al instante y los trabajos sobreviven a reinicios.
+def _jobs_db():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_job_store():
+    """Crea el directorio de spool y la tabla de trabajos si no existen"""
+    os.makedirs(JOBS_SPOOL_DIR, exist_ok=True)
+    with closing(_jobs_db()) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                email_path TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                lease_expires_at REAL,
+                last_error TEXT,
+                sender TEXT,
+                lease_owner TEXT
+            )
+        """)
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'sender' not in columns:
+            # Colas creadas antes de la admisión por remitente
+            conn.execute("ALTER TABLE jobs ADD COLUMN sender TEXT")
+        if 'lease_owner' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_next ON jobs (status, next_attempt_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sender_buckets (
+                sender TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+
+def new_spool_file():
+    """Reserva un id de trabajo y la ruta temporal donde escribir su email"""
+    job_id = uuid.uuid4().hex
+    return job_id, os.path.join(JOBS_SPOOL_DIR, f"{job_id}.eml.part")
+
+
+def read_email_sender(email_path):
+    """Dirección del remitente (en minúsculas) de un email del spool, leyendo solo sus cabeceras"""
+    with open(email_path, 'rb') as f:
+        headers = _read_mime_headers(f)
+    return parseaddr(str(headers.get('From', '')))[1].lower() or None
+
+
+def enqueue_email_job(job_id, partial_path, sender=None):
+    """Publica en el spool el email ya escrito (y sincronizado) en partial_path y registra el trabajo"""
+    # Renombrar al final evita que se procese un email a medio escribir
+    email_path = os.path.join(JOBS_SPOOL_DIR, f"{job_id}.eml")
+    os.replace(partial_path, email_path)
+
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, email_path, created_at, updated_at, next_attempt_at, sender) "
+            "VALUES (?, 'pending', ?, ?, ?, ?, ?)",
+            (job_id, email_path, now, now, now, sender)
+        )
+    return job_id
+
+
+def _take_sender_token(conn, sender, now):
+    """
+    Cubo de tokens del remitente, dentro de la transacción de la reserva para que
+    lo compartan todos los workers. Gasta un token y devuelve 0, o devuelve los
+    segundos que faltan para el siguiente token.
+    """
+    if not sender or ADMISSION_SENDER_RATE_PER_MINUTE <= 0:
+        return 0
+    rate = ADMISSION_SENDER_RATE_PER_MINUTE / 60
+    row = conn.execute("SELECT tokens, updated_at FROM sender_buckets WHERE sender = ?", (sender,)).fetchone()
+    tokens = ADMISSION_SENDER_BURST if row is None else min(
+        ADMISSION_SENDER_BURST, row['tokens'] + (now - row['updated_at']) * rate
+    )
+    if tokens < 1:
+        return (1 - tokens) / rate
+    conn.execute(
+        "INSERT INTO sender_buckets (sender, tokens, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(sender) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+        (sender, tokens - 1, now)
+    )
+    return 0
+
+
+def claim_next_job():
+    """
+    Reserva el siguiente trabajo pendiente. Un trabajo 'running' cuya reserva ha
+    caducado (el proceso murió a mitad) vuelve a estar disponible. Cada reserva
+    lleva un lease_owner propio: solo quien la tiene puede renovarla o cerrar el
+    trabajo.
+
+    Antes pasa por la admisión: no se reserva nada si ya hay ADMISSION_MAX_RUNNING_JOBS
+    en curso, y los trabajos de un remitente sin tokens se reprograman para cuando
+    le toque (sin gastar un intento) y se pasa al siguiente.
+    """
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND lease_expires_at > ?", (now,)
+            ).fetchone()[0]
+            if running >= ADMISSION_MAX_RUNNING_JOBS:
+                conn.execute("COMMIT")
+                return None
+
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "OR (status = 'running' AND lease_expires_at <= ?) "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (now, now, ADMISSION_SCAN_LIMIT)
+            ).fetchall()
+            row = None
+            deferred_by_sender = {}
+            for candidate in rows:
+                wait = _take_sender_token(conn, candidate['sender'], now)
+                if wait == 0:
+                    row = candidate
+                    break
+                # Los trabajos del mismo remitente se escalonan al ritmo de sus tokens
+                queued = deferred_by_sender.get(candidate['sender'], 0)
+                deferred_by_sender[candidate['sender']] = queued + 1
+                retry_at = now + wait + queued * 60 / ADMISSION_SENDER_RATE_PER_MINUTE
+                conn.execute(
+                    "UPDATE jobs SET status = 'pending', next_attempt_at = ?, lease_expires_at = NULL, "
+                    "lease_owner = NULL WHERE id = ?",
+                    (retry_at, candidate['id'])
+                )
+                ADMISSION_DEFERRED.inc()
+            if deferred_by_sender:
+                print(f"Admisión: aplazados {sum(deferred_by_sender.values())} trabajos de "
+                      f"{len(deferred_by_sender)} remitente(s) sin tokens")
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            lease_owner = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                "updated_at = ?, lease_expires_at = ?, lease_owner = ? WHERE id = ?",
+                (now, now + JOB_LEASE_SECONDS, lease_owner, row['id'])
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    job = dict(row)
+    job['attempts'] += 1
+    job['lease_owner'] = lease_owner
+    return job
+
+
+def renew_job_lease(job_id, lease_owner):
+    """Alarga la reserva de un trabajo en curso; False si ya no es de este worker"""
+    with closing(_jobs_db()) as conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+            (time.time() + JOB_LEASE_SECONDS, job_id, lease_owner)
+        )
+    return cursor.rowcount == 1
+
+
+def complete_job(job_id, lease_owner, note=None):
+    """Marca el trabajo como hecho; False si la reserva ya no era de este worker"""
+    with closing(_jobs_db()) as conn:
+        row = conn.execute("SELECT email_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'done', updated_at = ?, lease_expires_at = NULL, lease_owner = NULL, "
+            "last_error = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+            (time.time(), note, job_id, lease_owner)
+        )
+    if cursor.rowcount != 1:
+        return False
+    if row is not None:
+        try:
+            os.remove(row['email_path'])
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def fail_job(job_id, lease_owner, attempts, error):
+    """
+    Reprograma el trabajo con backoff exponencial o lo manda a la cola de muertos.
+    Devuelve el nuevo estado, o 'lost' si la reserva ya no era de este worker.
+    """
+    now = time.time()
+    with closing(_jobs_db()) as conn:
+        if attempts >= JOB_MAX_ATTEMPTS:
+            # El email se conserva en el spool para poder revisarlo a mano
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'dead', updated_at = ?, lease_expires_at = NULL, lease_owner = NULL, "
+                "last_error = ? WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                (now, error, job_id, lease_owner)
+            )
+            return 'dead' if cursor.rowcount == 1 else 'lost'
+        retry_at = now + JOB_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'pending', updated_at = ?, next_attempt_at = ?, "
+            "lease_expires_at = NULL, lease_owner = NULL, last_error = ? "
+            "WHERE id = ? AND status = 'running' AND lease_owner = ?",
+            (now, retry_at, error, job_id, lease_owner)
+        )
+        return 'pending' if cursor.rowcount == 1 else 'lost'
+
+
+def job_queue_stats():
+    with closing(_jobs_db()) as conn:
+        rows = conn.execute("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status").fetchall()
+    stats = {status: 0 for status in ('pending', 'running', 'done', 'dead')}
+    stats.update({row['status']: row['total'] for row in rows})
+    return stats
+
+
+class JobPermanentError(Exception):
+    """El trabajo no se puede completar y reintentarlo no serviría de nada"""
+
+
+async def process_email_job(job):
+    """Parsea el email del trabajo, convierte el PDF y responde al remitente"""
+    print(f"Procesando trabajo {job['id']} (intento {job['attempts']})")
+
+    # Cada intento es un span hijo del webhook que recibió el email
+    attributes = {"job.id": job['id'], "job.attempt": job['attempts']}
+    with trace_span("process_job", attributes, trace_id=job['id'], parent_span_id=job['id'][:16]) as span:
+        with tempfile.TemporaryDirectory() as work_dir:
+            note = await _process_email_job(job, work_dir)
+        span.set_attribute("job.result", note)
+        return note
+
+
+async def _process_email_job(job, work_dir):
+    # Parsear el mensaje MIME; los PDFs adjuntos se decodifican directamente en work_dir
+    print("Parseando email MIME...")
+    with MIME_PARSE_SECONDS.time(), trace_span("mime_parse", {"email.bytes": os.path.getsize(job['email_path'])}) as span:
+        msg, pdf_attachments = await run_in_threadpool(parse_email_streaming, job['email_path'], work_dir)
+        span.set_attribute("email.pdf_attachments", len(pdf_attachments))
+        span.set_attribute("email.pdf_bytes", sum(attachment['size'] for attachment in pdf_attachments))
+
+    # Extraer información del email
+    from_email = str(msg.get('From', '')).strip()
+    subject = str(msg.get('Subject', '')).lower()
+
+    print(f"Email de: {from_email}")
+    print(f"Asunto: {subject}")
+
+    # Validar datos básicos
+    if not from_email:
+        raise JobPermanentError("No se encontró email remitente")
+
+    if not pdf_attachments:
+        raise JobPermanentError("No se encontraron archivos PDF adjuntos")
+
+    print(f"PDFs adjuntos: {[attachment['filename'] for attachment in pdf_attachments]}")
+
+    # 2. VALIDACIÓN
+    wants_docx = 'word' in subject or 'docx' in subject
+
+    fast_mode = any(keyword in subject for keyword in FAST_MODE_KEYWORDS)
+
+    print(f"Quiere DOCX: {wants_docx}")
+
+    if not wants_docx:
+        print("No se pidió conversión a Word. No se hace nada.")
+        return "Sin conversión solicitada"
+
+    # 3. CONVERSIÓN: todos los PDFs a la vez en el pool de conversión
+    print(f"Iniciando conversión a DOCX {'en modo rápido ' if fast_mode else ''}de {len(pdf_attachments)} PDF(s)...")
+    conversion_start_time = time.time()
+
+    # El mismo PDF adjuntado dos veces se convierte una sola vez
+    unique_attachments = {}
+    for attachment in pdf_attachments:
+        unique_attachments.setdefault(attachment['sha256'], attachment)
+
+    # Un email con muchos PDFs no ocupa más del sitio libre del pool (ni más que sus workers)
+    fan_out = asyncio.Semaphore(max(1, min(conversion_pool.workers, conversion_pool.room())))
+
+    async def convert_limited(attachment, index):
+        async with fan_out:
+            return await convert_attachment(attachment, os.path.join(work_dir, f"pdf_{index}"), fast_mode)
+
+    unique_results = await asyncio.gather(
+        *[convert_limited(attachment, index) for index, attachment in enumerate(unique_attachments.values())],
+        return_exceptions=True
+    )
+    results_by_hash = dict(zip(unique_attachments.keys(), unique_results))
+    results = [results_by_hash[attachment['sha256']] for attachment in pdf_attachments]
+    print(f"Conversiones terminadas en {time.time() - conversion_start_time:.2f} segundos.")
+
+    converted = []
+    timed_out = []
+    rejected = []
+    failed = []
+    for attachment, result in zip(pdf_attachments, results):
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+        if isinstance(result, PDFRejected):
+            print(f"PDF rechazado en el triaje: {attachment['filename']}: {result}")
+            rejected.append((attachment, str(result)))
+        elif isinstance(result, ConversionTimeout):
+            print(f"Error de timeout detectado en {attachment['filename']}: {result}")
+            timed_out.append(attachment)
+        elif isinstance(result, BaseException):
+            print(f"Error de conversión no manejado en {attachment['filename']}: {result}")
+            failed.append(attachment)
+        else:
+            converted.append((attachment, result))
+
+    if not converted:
+        if timed_out:
+            # Enviar email informativo de timeout; reintentar la conversión volvería a agotar el tiempo
+            filenames = ", ".join(attachment['filename'] for attachment in timed_out)
+            timeout = max(attachment['timeout'] for attachment in timed_out)
+            with trace_span("smtp_send", {"email.kind": "timeout"}):
+                timeout_sent = await run_in_threadpool(
+                    handle_conversion_timeout, filenames, from_email, timeout, fast_mode
+                )
+
+            if timeout_sent:
+                print("Email de timeout enviado exitosamente")
+                return "Timeout handled"
+            raise Exception("Error sending timeout email")
+        if rejected and not failed:
+            # Reintentar no cambiaría nada: se explica al usuario por qué no se convierte
+            with trace_span("smtp_send", {"email.kind": "rejection"}):
+                rejection_sent = await run_in_threadpool(handle_rejected_pdfs, rejected, from_email)
+            if rejection_sent:
+                return f"{len(rejected)} PDF(s) rechazados en el triaje"
+            raise Exception("Error sending rejection email")
+        # Es otro tipo de error, se reintentará más tarde
+        raise Exception(f"Error en la conversión de {len(failed)} PDF(s)")
+
+    # 4. ENVÍO DEL EMAIL DE RESPUESTA (uno solo para todos los ficheros)
+    attachments = []
+    used_names = set()
+    for attachment, docx_path in converted:
+        output_filename = f"{attachment['filename'].split('.')[0]}.docx"
+        if output_filename in used_names:
+            output_filename = f"{output_filename[:-5]}_{len(used_names) + 1}.docx"
+        used_names.add(output_filename)
+        attachments.append({
             'filename': output_filename,
-            'content': docx_buffer
+            'path': docx_path
+        })
+
+    total_size = sum(os.path.getsize(attachment['path']) for attachment in attachments)
+    if len(attachments) > 1 and total_size > MAX_EMAIL_ATTACHMENT_MB * 1024 * 1024:
+        # Demasiado para adjuntarlo suelto: un único ZIP con todos los DOCX
+        zip_path = os.path.join(work_dir, "documentos_convertidos.zip")
+        with trace_span("zip_attachments", {"zip.files": len(attachments), "zip.input_bytes": total_size}) as span:
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+                for attachment in attachments:
+                    zf.write(attachment['path'], attachment['filename'])
+            span.set_attribute("zip.bytes", os.path.getsize(zip_path))
+        print(f"Adjuntos de {total_size / (1024 * 1024):.2f}MB comprimidos en ZIP "
+              f"de {os.path.getsize(zip_path) / (1024 * 1024):.2f}MB")
+        attachments = [{
+            'filename': "documentos_convertidos.zip",
+            'path': zip_path
         }]
-        
+
+    original_names = ", ".join(f"<strong>{attachment['filename']}</strong>" for attachment, _ in converted)
+    if len(converted) == 1:
+        subject = f"Tu fichero convertido: {attachments[0]['filename']}"
+        html_content = f"<strong>Hola,</strong><br>hemos convertido tu fichero {original_names} a formato Word (.docx).<br>Puedes descargarlo adjunto en este correo."
+    else:
+        subject = f"Tus ficheros convertidos: {len(converted)} documentos"
+        html_content = f"<strong>Hola,</strong><br>hemos convertido tus ficheros {original_names} a formato Word (.docx).<br>Puedes descargarlos adjuntos en este correo."
+
+    not_converted = timed_out + failed
+    if not_converted:
+        names = ", ".join(f"<strong>{attachment['filename']}</strong>" for attachment in not_converted)
+        html_content += f"<br><br>No hemos podido convertir: {names}. Prueba a enviarlos de nuevo en unos minutos."
+    for attachment, reason in rejected:
+        html_content += f"<br><br>No se puede convertir <strong>{attachment['filename']}</strong>: {reason}."
+    not_converted += [attachment for attachment, _ in rejected]
+
+    attributes = {
+        "email.kind": "result",
+        "email.attachments": len(attachments),
+        "email.attachment_bytes": sum(os.path.getsize(attachment['path']) for attachment in attachments)
+    }
+    with trace_span("smtp_send", attributes) as span:
+        success = await run_in_threadpool(send_email_with_gmail, from_email, subject, html_content, attachments)
+        if not success:
+            span.set_error("Error sending email")
+    if not success:
+        raise Exception("Error sending email")
+
+    print("Email enviado exitosamente con Gmail")
+    return "OK" if not not_converted else f"OK ({len(not_converted)} PDF(s) sin convertir)"
+
+
+async def convert_attachment(pdf_attachment, work_dir, fast_mode=False):
+    """Convierte un PDF adjunto (ya decodificado en disco) y devuelve la ruta del DOCX"""
+    attributes = {
+        "file.name": pdf_attachment['filename'],
+        "file.bytes": pdf_attachment['size'],
+        "file.sha256": pdf_attachment['sha256'],
+        "conversion.fast_requested": fast_mode
+    }
+    with trace_span("convert_attachment", attributes):
+        return await _convert_attachment(pdf_attachment, work_dir, fast_mode)
+
+
+async def _convert_attachment(pdf_attachment, work_dir, fast_mode):
+    original_filename = pdf_attachment['filename']
+
+    # Sanitizar el nombre del archivo para evitar problemas
+    with trace_span("sanitize_filename") as span:
+        sanitized_filename = sanitize_filename(original_filename)
+        span.set_attribute("file.sanitized_name", sanitized_filename)
+
+    print(f"Procesando archivo: {original_filename}")
+    print(f"Nombre sanitizado: {sanitized_filename}")
+
+    # Triaje: decide si el PDF se puede convertir, y con qué motor, antes de ocupar el pool
+    with trace_span("triage") as span:
+        triage = await run_triage(pdf_attachment['path'])
+        triage['fast_requested'] = fast_mode
+        triage['route'] = choose_route(triage, fast_mode)
+        span.set_attributes({
+            "pdf.pages": triage['pages'],
+            "pdf.encrypted": triage['encrypted'],
+            "pdf.text_pages_sampled": f"{triage['text_pages']}/{triage['sampled_pages']}",
+            "pdf.image_coverage": triage['image_coverage'],
+            "triage.route": triage['route'],
+            "triage.reason": triage['reason']
+        })
+    TRIAGE_DECISIONS.labels(route=triage['route']).inc()
+    await run_in_threadpool(
+        log_triage_decision, original_filename, pdf_attachment['size'], pdf_attachment['sha256'], triage
+    )
+    if triage['route'] == 'reject':
+        raise PDFRejected(triage['reason'])
+
+    # Timeout aprendido de conversiones parecidas y coste con el que el pool ordena su cola
+    estimate = await run_in_threadpool(
+        conversion_times.predict, triage['route'], pdf_attachment['size'], triage['pages'], triage['image_coverage']
+    )
+    timeout = estimate['timeout']
+    pdf_attachment['timeout'] = timeout
+    cost = estimate_conversion_cost(pdf_attachment['size'], triage['pages'], triage['route'])
+    eta = f"ETA {estimate['eta']}s" if estimate['eta'] is not None else "sin ETA"
+    print(f"Timeout configurado: {timeout} segundos ({estimate['source']}, {estimate['samples']} muestras, {eta}; "
+          f"coste estimado {cost:.0f}s, carril {conversion_pool.lane_for(cost)})")
+
+    # Medir tiempo de conversión
+    conversion_start_time = time.time()
+
+    # Un PDF ya convertido antes con el mismo motor y versión sale de la caché
+    if triage['route'] == 'text':
+        cache_key = ConversionCache.make_key(pdf_attachment['sha256'], "text", PYMUPDF_VERSION)
+    else:
+        cache_key = ConversionCache.make_key(
+            pdf_attachment['sha256'], "pdf2docx", f"{PDF2DOCX_VERSION}+{docx_optimization_tag()}"
+        )
+
+    os.makedirs(work_dir, exist_ok=True)
+    docx_path = os.path.join(work_dir, "cached.docx")
+    engine = triage['route']
+    with trace_span("cache_lookup", {"cache.key": cache_key}) as span:
+        cache_hit = await run_in_threadpool(conversion_cache.get, cache_key, docx_path)
+        span.set_attribute("cache.hit", cache_hit)
+    if cache_hit:
+        CONVERSIONS.labels(engine=engine, outcome="cache_hit").inc()
+        print(f"Conversión encontrada en caché ({cache_key[:12]}...)")
+    else:
+        # El PDF ya está en disco: se mueve a su nombre final y el proceso hijo lo lee de ahí;
+        # el DOCX se queda en disco para adjuntarlo sin cargarlo en memoria
+        pdf_path = os.path.join(work_dir, sanitized_filename)
+        os.replace(pdf_attachment['path'], pdf_path)
+        profile = new_profile_metadata(engine, pdf_attachment, triage['pages']) if PROFILE_SLOW_CONVERSIONS else None
+        timing = {}
+        try:
+            attributes = {
+                "conversion.engine": engine,
+                "conversion.timeout_s": timeout,
+                "conversion.timeout_source": estimate['source'],
+                "conversion.eta_s": estimate['eta'],
+                "pdf.pages": triage['pages']
+            }
+            with CONVERSION_SECONDS.labels(engine=engine).time(), trace_span("conversion", attributes):
+                while True:
+                    try:
+                        if engine == 'text':
+                            docx_path = os.path.join(work_dir, f"{os.path.splitext(sanitized_filename)[0]}.docx")
+                            await conversion_pool.run(
+                                convert_pdf_to_docx_text_only, pdf_path, docx_path,
+                                timeout=timeout, profile=profile, cost=cost, timing=timing
+                            )
+                        else:
+                            docx_path, download_info = await conversion_pool.run(
+                                convert_pdf_to_docx_with_pdf2docx, None, sanitized_filename, timeout, work_dir, True,
+                                timeout=timeout, profile=profile, cost=cost, timing=timing
+                            )
+                        break
+                    except ConversionPoolBusy as e:
+                        # Pool lleno: se espera a que haya sitio sin gastar un intento del trabajo
+                        # ni repetir las conversiones que ya han terminado
+                        CONVERSIONS.labels(engine=engine, outcome="busy").inc()
+                        print(f"{e}; {original_filename} espera {CONVERSION_BUSY_RETRY_SECONDS}s")
+                        await asyncio.sleep(CONVERSION_BUSY_RETRY_SECONDS)
+            with DOCX_VALIDATION_SECONDS.time(), trace_span("docx_validation") as span:
+                span.set_attribute("docx.bytes", os.path.getsize(docx_path))
+                await run_in_threadpool(validate_docx, docx_path)
+        except ConversionTimeout:
+            CONVERSIONS.labels(engine=engine, outcome="timeout").inc()
+            # Solo se sabe que habría tardado más que el timeout: se guarda como cota inferior
+            await run_in_threadpool(
+                conversion_times.record, engine, pdf_attachment['size'], triage['pages'],
+                triage['image_coverage'], timeout, True
+            )
+            if profile:
+                await run_in_threadpool(mark_profile_interrupted, profile['id'], "timeout")
+            raise
+        except Exception:
+            CONVERSIONS.labels(engine=engine, outcome="error").inc()
+            if profile:
+                await run_in_threadpool(mark_profile_interrupted, profile['id'], "killed")
+            raise
+        CONVERSIONS.labels(engine=engine, outcome="ok").inc()
+        await run_in_threadpool(
+            conversion_times.record, engine, pdf_attachment['size'], triage['pages'],
+            triage['image_coverage'], timing['run_s']
+        )
+        with trace_span("cache_store"):
+            await run_in_threadpool(conversion_cache.put, cache_key, docx_path)
+
+    conversion_duration = time.time() - conversion_start_time
+    docx_size = os.path.getsize(docx_path) / (1024 * 1024)
+    print(f"Resultado: {original_filename} convertido ({engine}) en {conversion_duration:.2f}s - {docx_size:.2f}MB")
+    return docx_path
+
+
+async def job_worker(worker_id):
+    """Bucle de la etapa de procesamiento: reserva trabajos y los ejecuta"""
+    while True:
         try:
-            success = send_email_with_gmail(from_email, subject, html_content, attachments)
-            if success:
-                print("Email enviado exitosamente con Gmail")
+            job = await run_in_threadpool(claim_next_job)
+        except Exception as e:
+            print(f"Worker {worker_id}: error reservando trabajo: {e}")
+            job = None
+
+        if job is None:
+            # Esperar a que llegue un trabajo nuevo o a que venza algún reintento
+            job_available.clear()
+            try:
+                await asyncio.wait_for(job_available.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        processing = asyncio.create_task(process_email_job(job))
+        lease_keeper = asyncio.create_task(keep_job_lease(job, processing))
+        try:
+            note = await processing
+            if await run_in_threadpool(complete_job, job['id'], job['lease_owner'], note):
+                JOBS_FINISHED.labels(outcome="completed").inc()
+                print(f"Trabajo {job['id']} completado: {note}")
             else:
-                print("Error al enviar email con Gmail")
-                return JSONResponse({"error": "Error sending email"}, status_code=500)
+                print(f"Trabajo {job['id']} terminado sin reserva: otro worker lo ha reprocesado")
+        except JobPermanentError as e:
+            print(f"Trabajo {job['id']} descartado: {e}")
+            if await run_in_threadpool(complete_job, job['id'], job['lease_owner'], str(e)):
+                JOBS_FINISHED.labels(outcome="discarded").inc()
+        except asyncio.CancelledError:
+            if not job.get('lease_lost'):
+                raise
+            print(f"Trabajo {job['id']} abandonado: su reserva caducó y la tiene otro worker")
+        except Exception as e:
+            status = await run_in_threadpool(fail_job, job['id'], job['lease_owner'], job['attempts'], str(e))
+            if status != 'lost':
+                JOBS_FINISHED.labels(outcome="retry" if status == 'pending' else status).inc()
+            print(f"Trabajo {job['id']} falló en el intento {job['attempts']} ({status}): {e}")
+        finally:
+            lease_keeper.cancel()
+        # Queda un hueco libre bajo ADMISSION_MAX_RUNNING_JOBS: que otro worker lo aproveche ya
+        job_available.set()
+
+
+async def keep_job_lease(job, processing):
+    """
+    Renueva la reserva del trabajo mientras se procesa. Si se pierde (el proceso
+    estuvo parado más que JOB_LEASE_SECONDS y otro worker lo ha reservado) se
+    cancela el procesamiento para no convertir ni responder dos veces.
+    """
+    while not processing.done():
+        await asyncio.sleep(JOB_LEASE_RENEW_SECONDS)
+        try:
+            renewed = await run_in_threadpool(renew_job_lease, job['id'], job['lease_owner'])
         except Exception as e:
-            print(f"Error al enviar email con Gmail: {e}")
-            return JSONResponse({"error": "Error sending email"}, status_code=500)
+            print(f"Error renovando la reserva del trabajo {job['id']}: {e}")
+            continue
+        if not renewed:
+            job['lease_lost'] = True
+            processing.cancel()
+            return
+
+
+job_available = asyncio.Event()
+job_workers = []
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    await run_in_threadpool(init_job_store)
+    for worker_id in range(JOB_WORKERS):
+        job_workers.append(asyncio.create_task(job_worker(worker_id)))
+    print(f"Cola de trabajos iniciada con {JOB_WORKERS} workers en {JOBS_DIR}")
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    # Los trabajos interrumpidos se recuperan al caducar su reserva
+    for task in job_workers:
+        task.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    job_workers.clear()
+
+
+# --- ENDPOINT DE LA API ---
+@app.post("/api/convert")
+async def handler(request: Request):
+    print("Recibiendo solicitud de SendGrid...")
+    job_id, partial_path = new_spool_file()
+
+    # El id del trabajo es también el id de su traza; la petición es el span raíz
+    attributes = {"http.request_content_length": request.headers.get('content-length')}
+    with trace_span("webhook", attributes, trace_id=job_id, span_id=job_id[:16]) as span:
+        response = await _handle_webhook(request, job_id, partial_path)
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.set_error(response.body.decode('utf-8', 'replace'))
+        return response
+
+
+async def _handle_webhook(request, job_id, partial_path):
+    try:
+        content_type = request.headers.get('content-type', '')
+
+        try:
+            write_start = time.time()
+            with trace_span("temp_write") as write_span:
+                if 'multipart/form-data' in content_type:
+                    # SendGrid envía los datos como multipart/form-data con el email MIME;
+                    # el campo del email se vuelca a disco por bloques sin pasar por memoria
+                    field_name, fields = await stream_email_field_to_file(request, partial_path)
+                    print(f"Campos del formulario: {fields}")
+                else:
+                    form = await request.form()
+                    print(f"Campos del formulario: {list(form.keys())}")
+                    field_name = next((name for name in EMAIL_FORM_FIELDS if name in form), None)
+                    if field_name:
+                        email_content = form[field_name]
+                        if isinstance(email_content, str):
+                            email_content = email_content.encode('utf-8')
+                        elif hasattr(email_content, 'read'):
+                            email_content = await email_content.read()
+                        with open(partial_path, 'wb') as f:
+                            f.write(email_content)
+                            f.flush()
+                            os.fsync(f.fileno())
+                write_span.set_attribute("email.field", field_name)
+                write_span.set_attribute("email.bytes", os.path.getsize(partial_path) if field_name else 0)
+
+            if not field_name or os.path.getsize(partial_path) == 0:
+                print("Error: No se encontró el contenido del email en el formulario")
+                # Sin campo de email en un formulario urlencoded el fichero ni llega a crearse
+                with suppress(FileNotFoundError):
+                    os.remove(partial_path)
+                WEBHOOK_REQUESTS.labels(outcome="no_email").inc()
+                return JSONResponse({"error": "No email content found in form data"}, status_code=400)
+            TEMP_WRITE_SECONDS.observe(time.time() - write_start)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+
+        print(f"Email encontrado en campo: {field_name}")
+
+        # Encolar el trabajo y responder ya; la conversión y la respuesta van en segundo plano
+        email_size = os.path.getsize(partial_path)
+        with trace_span("enqueue") as span:
+            # El remitente se guarda con el trabajo para la admisión por remitente
+            sender = await run_in_threadpool(read_email_sender, partial_path)
+            span.set_attribute("email.sender_domain", sender.rpartition('@')[2] if sender else None)
+            await run_in_threadpool(enqueue_email_job, job_id, partial_path, sender)
+        job_available.set()
+        print(f"Email encolado como trabajo {job_id} ({email_size} bytes)")
+        WEBHOOK_REQUESTS.labels(outcome="accepted").inc()
 
         return PlainTextResponse("OK", status_code=200)
 
     except Exception as e:
+        WEBHOOK_REQUESTS.labels(outcome="error").inc()
         print(f"Error general en el handler: {e}")
         import traceback
         traceback.print_exc()
@@ -369,7 +2368,45 @@ async def handler(request: Request):
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok"}
+    # Las estadísticas que leen SQLite o recorren la caché no deben bloquear el event loop
+    return {
+        "status": "ok",
+        "conversion_pool": conversion_pool.stats(),
+        "jobs": await run_in_threadpool(job_queue_stats),
+        "cache": await run_in_threadpool(conversion_cache.stats),
+        "conversion_times": await run_in_threadpool(conversion_times.stats),
+        "smtp": smtp_pool.stats()
+    }
+
+def is_admin_request(request):
+    api_key = request.headers.get('x-api-key', '')
+    return bool(ADMIN_API_KEY) and hmac.compare_digest(api_key, ADMIN_API_KEY)
+
+
+@app.get("/admin/profiles")
+async def list_slow_conversion_profiles(request: Request, job_id: str = None):
+    """Perfiles guardados de conversiones lentas (filtrables por id de trabajo)"""
+    if not is_admin_request(request):
+        return JSONResponse({"error": "Forbidden"}, status_code=403)
+    return {
+        "enabled": PROFILE_SLOW_CONVERSIONS,
+        "threshold_s": PROFILE_THRESHOLD_SECONDS,
+        "profiles": await run_in_threadpool(profile_store.list, job_id)
+    }
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_slow_conversion_profile(profile_id: str, request: Request, format: str = "json"):
+    """Un perfil completo; con ?format=collapsed, las pilas listas para flamegraph.pl o speedscope"""
+    if not is_admin_request(request):
+        return JSONResponse({"error": "Forbidden"}, status_code=403)
+    profile = await run_in_threadpool(profile_store.load, profile_id)
+    if profile is None:
+        return JSONResponse({"error": "Profile not found"}, status_code=404)
+    if format == "collapsed":
+        return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in profile['stacks'].items()))
+    return profile
+
 
 @app.get("/api/diagnose")
 async def diagnose_environment():
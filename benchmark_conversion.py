@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Benchmark reproducible de los motores de conversión PDF -> DOCX
+
+Genera un corpus de PDFs sintéticos (siempre iguales para la misma semilla):
+texto, imágenes y tablas, de 1/10/100/500 páginas. Cada motor convierte cada PDF
+varias veces en un proceso aparte, y se mide:
+
+- latencia (p50/p90/p95/p99) de la conversión, sin contar el arranque
+- tiempo de CPU (usuario + sistema, incluidos los procesos hijos)
+- pico de memoria residente (RSS)
+- tamaño del DOCX generado
+
+Motores:
+- pdf2docx:    convert_pdf_to_docx_with_pdf2docx de api/convert.py
+- text:        modo rápido de solo texto de api/convert.py
+- libreoffice: pool de LibreOffice de server/main.py (solo si está instalado)
+
+Los resultados se guardan en JSON junto con el commit de git, para comparar
+entre versiones:
+
+    python benchmark_conversion.py --pages 1,10 --repeat 5
+    python benchmark_conversion.py --compare benchmark_results/anterior.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS_DIR = os.path.join(ROOT_DIR, "benchmark_corpus")
+DEFAULT_RESULTS_DIR = os.path.join(ROOT_DIR, "benchmark_results")
+
+ENGINES = ("pdf2docx", "text", "libreoffice")
+KINDS = ("text", "images", "tables")
+
+LOREM = (
+    "El presente documento recoge las condiciones generales del servicio de conversión. "
+    "Las partes acuerdan que los ficheros enviados se procesarán de forma automática y "
+    "se devolverán al remitente en formato Word en el menor tiempo posible. "
+    "Cualquier incidencia se comunicará por correo electrónico al usuario afectado. "
+)
+
+
+# --- GENERACIÓN DEL CORPUS ---
+
+def _text_page(page, rng, page_number):
+    import fitz
+    page.insert_text((72, 60), f"Documento de prueba - página {page_number + 1}", fontname="hebo", fontsize=14)
+    y = 90
+    while y < page.rect.height - 120:
+        text = LOREM * rng.randint(1, 3)
+        page.insert_textbox(fitz.Rect(72, y, page.rect.width - 72, y + 110), text, fontsize=10, fontname="helv")
+        y += 120
+
+
+def _images_page(page, rng, page_number):
+    import fitz
+    page.insert_text((72, 60), f"Informe con imágenes - página {page_number + 1}", fontname="hebo", fontsize=14)
+    for index in range(2):
+        # Ruido aleatorio: no se comprime, como una foto escaneada
+        width, height = 600, 400
+        pixmap = fitz.Pixmap(fitz.csRGB, width, height, rng.randbytes(width * height * 3), False)
+        top = 90 + index * 330
+        page.insert_image(fitz.Rect(72, top, page.rect.width - 72, top + 300), pixmap=pixmap)
+
+
+def _tables_page(page, rng, page_number):
+    import fitz
+    page.insert_text((72, 60), f"Tabla de datos - página {page_number + 1}", fontname="hebo", fontsize=14)
+    columns, rows = 5, 25
+    left, top = 72, 90
+    cell_width = (page.rect.width - 144) / columns
+    cell_height = 24
+    for row in range(rows + 1):
+        y = top + row * cell_height
+        page.draw_line((left, y), (left + columns * cell_width, y))
+    for column in range(columns + 1):
+        x = left + column * cell_width
+        page.draw_line((x, top), (x, top + rows * cell_height))
+    for row in range(rows):
+        for column in range(columns):
+            text = f"Concepto {row + 1}" if column == 0 else f"{rng.uniform(0, 10000):.2f}"
+            page.insert_text((left + column * cell_width + 4, top + row * cell_height + 16), text,
+                             fontname="hebo" if row == 0 else "helv", fontsize=9)
+
+
+PAGE_BUILDERS = {"text": _text_page, "images": _images_page, "tables": _tables_page}
+
+
+def generate_pdf(path, kind, pages, seed):
+    import fitz
+    rng = random.Random(f"{seed}-{kind}-{pages}")
+    doc = fitz.open()
+    for page_number in range(pages):
+        PAGE_BUILDERS[kind](doc.new_page(width=595, height=842), rng, page_number)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+def build_corpus(corpus_dir, kinds, page_counts, seed):
+    """Genera los PDFs que falten y devuelve la lista de (nombre, tipo, páginas, ruta)"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = []
+    for kind in kinds:
+        for pages in page_counts:
+            name = f"{kind}_{pages}p"
+            path = os.path.join(corpus_dir, f"{name}_s{seed}.pdf")
+            if not os.path.exists(path):
+                print(f"📄 Generando {name}...")
+                generate_pdf(path, kind, pages, seed)
+            corpus.append((name, kind, pages, path))
+    return corpus
+
+
+# --- MEDICIÓN (en un proceso aparte por motor y PDF) ---
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss va en KB en Linux; para los hijos es el del mayor de ellos
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+
+def _make_converter(engine):
+    """Devuelve (convertir(pdf_path, work_dir) -> docx_path, cerrar())"""
+    if engine in ("pdf2docx", "text"):
+        sys.path.insert(0, ROOT_DIR)
+        import api.convert as api
+
+        if engine == "text":
+            def convert(pdf_path, work_dir):
+                docx_path = os.path.join(work_dir, "salida.docx")
+                api.convert_pdf_to_docx_text_only(pdf_path, docx_path)
+                return docx_path
+        else:
+            def convert(pdf_path, work_dir):
+                shutil.copy(pdf_path, os.path.join(work_dir, "entrada.pdf"))
+                docx_path, _ = api.convert_pdf_to_docx_with_pdf2docx(
+                    None, "entrada.pdf", api.calculate_timeout_for_size(os.path.getsize(pdf_path)), work_dir, True
+                )
+                return docx_path
+        return convert, lambda: None
+
+    sys.path.insert(0, os.path.join(ROOT_DIR, "server"))
+    import main as server
+    pool = server.LibreOfficePool(1)
+    pool.start()
+
+    def convert(pdf_path, work_dir):
+        local_pdf = os.path.join(work_dir, "entrada.pdf")
+        shutil.copy(pdf_path, local_pdf)
+        return pool.convert(local_pdf, work_dir)
+    return convert, pool.stop
+
+
+def run_one(engine, pdf_path, repeat):
+    """Proceso hijo: convierte el PDF 'repeat' veces e imprime las medidas en JSON"""
+    convert, close = _make_converter(engine)
+    runs = []
+    errors = []
+    try:
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as work_dir:
+                cpu_before = _cpu_seconds()
+                start = time.perf_counter()
+                try:
+                    docx_path = convert(pdf_path, work_dir)
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                latency = time.perf_counter() - start
+                runs.append({
+                    "latency_s": latency,
+                    "cpu_s": _cpu_seconds() - cpu_before,
+                    "output_bytes": os.path.getsize(docx_path)
+                })
+    finally:
+        close()
+    print(json.dumps({"runs": runs, "errors": errors, "peak_rss_mb": _peak_rss_mb()}))
+
+
+# --- ESTADÍSTICAS E INFORME ---
+
+def percentile(values, p):
+    """Percentil por rango más cercano (suficiente para pocas repeticiones)"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50), 4),
+        "p90": round(percentile(values, 90), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "mean": round(sum(values) / len(values), 4),
+        "min": round(min(values), 4),
+        "max": round(max(values), 4)
+    }
+
+
+def measure(engine, name, kind, pages, pdf_path, repeat, timeout):
+    print(f"🧪 {engine:<12} {name:<14}", end=" ", flush=True)
+    result = {
+        "engine": engine, "corpus": name, "kind": kind, "pages": pages,
+        "pdf_bytes": os.path.getsize(pdf_path), "runs": 0
+    }
+    try:
+        completed = subprocess.run(
+            [sys.executable, "-W", "ignore", os.path.abspath(__file__), "--run-one", engine, pdf_path,
+             "--repeat", str(repeat)],
+            capture_output=True, text=True, timeout=timeout, cwd=ROOT_DIR
+        )
+        # Los conversores escriben sus propios logs; la medida es la última línea
+        measurement = json.loads(completed.stdout.strip().splitlines()[-1])
+    except subprocess.TimeoutExpired:
+        print(f"❌ timeout ({timeout}s)")
+        result["errors"] = [f"timeout tras {timeout}s"]
+        return result
+    except (IndexError, ValueError):
+        print("❌ el proceso de medida falló")
+        result["errors"] = [completed.stderr.strip()[-2000:]]
+        return result
+
+    runs = measurement["runs"]
+    result.update({
+        "runs": len(runs),
+        "latency_s": summarize([run["latency_s"] for run in runs]),
+        "cpu_s": summarize([run["cpu_s"] for run in runs]),
+        "peak_rss_mb": measurement["peak_rss_mb"],
+        "output_bytes": runs[-1]["output_bytes"] if runs else None,
+        "errors": measurement["errors"]
+    })
+    if runs:
+        print(f"✅ p50 {result['latency_s']['p50']:.3f}s  cpu {result['cpu_s']['p50']:.3f}s  "
+              f"rss {result['peak_rss_mb']} MB  docx {result['output_bytes'] / 1024:.0f} KB")
+    else:
+        print(f"❌ {measurement['errors'][:1]}")
+    return result
+
+
+def _git(*args):
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, cwd=ROOT_DIR).stdout.strip()
+    except OSError:
+        return None
+
+
+def collect_metadata():
+    versions = {}
+    for package in ("pdf2docx", "PyMuPDF", "Pillow"):
+        try:
+            import importlib.metadata
+            versions[package] = importlib.metadata.version(package)
+        except Exception:
+            versions[package] = None
+    if shutil.which("libreoffice"):
+        output = subprocess.run(["libreoffice", "--version"], capture_output=True, text=True).stdout.split()
+        versions["libreoffice"] = output[1] if len(output) > 1 else None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "git_commit": _git("rev-parse", "HEAD"),
+        "git_dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions
+    }
+
+
+def compare(current, baseline_path):
+    """Imprime la variación de p50 y RSS respecto a un JSON anterior"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["engine"], r["corpus"]): r for r in baseline["results"] if r.get("latency_s")}
+    print(f"\n📊 Comparación con {baseline_path} ({(baseline['meta'].get('git_commit') or '?')[:10]})")
+    for result in current["results"]:
+        old = previous.get((result["engine"], result["corpus"]))
+        if not old or not result.get("latency_s"):
+            continue
+        ratio = result["latency_s"]["p50"] / old["latency_s"]["p50"] if old["latency_s"]["p50"] else float("inf")
+        print(f"   {result['engine']:<12} {result['corpus']:<14} p50 {old['latency_s']['p50']:.3f}s -> "
+              f"{result['latency_s']['p50']:.3f}s ({ratio:.2f}x)  rss {old['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los motores de conversión PDF -> DOCX")
+    parser.add_argument("--engines", default=None,
+                        help="Motores separados por comas (por defecto todos los disponibles)")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="Tipos de PDF: text,images,tables")
+    parser.add_argument("--pages", default="1,10,100,500", help="Números de páginas del corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="Conversiones por motor y PDF")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla del corpus generado")
+    parser.add_argument("--timeout", type=int, default=3600, help="Segundos máximos por motor y PDF")
+    parser.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    parser.add_argument("--output", default=None, help="Fichero JSON de resultados")
+    parser.add_argument("--compare", default=None, help="JSON de una ejecución anterior para comparar")
+    parser.add_argument("--run-one", nargs=2, metavar=("MOTOR", "PDF"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(args.run_one[0], args.run_one[1], args.repeat)
+        return
+
+    if args.engines:
+        engines = [engine.strip() for engine in args.engines.split(",")]
+    else:
+        engines = [engine for engine in ENGINES if engine != "libreoffice" or shutil.which("libreoffice")]
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        parser.error(f"Motores desconocidos: {', '.join(sorted(unknown))}")
+    kinds = [kind.strip() for kind in args.kinds.split(",")]
+    page_counts = [int(pages) for pages in args.pages.split(",")]
+
+    print(f"Iniciando benchmark: motores {engines}, corpus {kinds} x {page_counts} páginas, "
+          f"{args.repeat} repeticiones\n")
+    corpus = build_corpus(args.corpus_dir, kinds, page_counts, args.seed)
+
+    results = {
+        "meta": collect_metadata(),
+        "config": {"engines": engines, "kinds": kinds, "pages": page_counts, "repeat": args.repeat, "seed": args.seed},
+        "results": []
+    }
+    for name, kind, pages, path in corpus:
+        for engine in engines:
+            results["results"].append(measure(engine, name, kind, pages, path, args.repeat, args.timeout))
+
+    output = args.output
+    if output is None:
+        commit = (results["meta"]["git_commit"] or "sin-git")[:10]
+        output = os.path.join(DEFAULT_RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultados guardados en {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
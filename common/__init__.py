@@ -0,0 +1,11 @@
+"""
+Código compartido por la API de email (api/convert.py) y el servidor de
+conversión (server/main.py).
+"""
+from .cache import ConversionCache
+from .docx_utils import (
+    DOCX_DEFLATE_LEVEL, DOCX_IMAGE_TARGET_DPI, DOCX_JPEG_QUALITY, DOCX_OPTIMIZE,
+    convert_pdf_to_docx_text_only, docx_optimization_tag, optimize_docx
+)
+from .pdf_utils import sample_page_numbers
+from .profiles import PROFILE_ID_PATTERN, ProfileStore
@@ -0,0 +1,91 @@
+"""
+Caché en disco de conversiones, compartida por las dos apps.
+"""
+import os
+import shutil
+import threading
+
+
+class ConversionCache:
+    """
+    Caché en disco de DOCX convertidos, direccionada por el SHA-256 del PDF más el
+    conversor y su versión. La expulsión es LRU usando el mtime de cada entrada,
+    que se actualiza en cada acierto.
+    """
+
+    def __init__(self, cache_dir, max_mb):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(pdf_sha256, converter, version):
+        return f"{pdf_sha256}_{converter}_{version}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.docx")
+
+    def get(self, key, dest_path):
+        """Copia la entrada a dest_path; devuelve False si no está en caché"""
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, dest_path)
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key, src_path):
+        if os.path.getsize(src_path) > self.max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        partial_path = f"{path}.{os.getpid()}.part"
+        shutil.copyfile(src_path, partial_path)
+        os.replace(partial_path, path)
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.docx'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def evict(self):
+        """Borra las entradas menos usadas hasta volver a estar por debajo del límite"""
+        with self.lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(entries),
+            "size_mb": round(sum(size for _, size, _ in entries) / (1024 * 1024), 2),
+            "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions
+        }
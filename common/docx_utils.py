@@ -0,0 +1,329 @@
+"""
+Utilidades de DOCX compartidas por las dos apps: reempaquetado optimizado del
+DOCX convertido y escritura directa de un DOCX de solo texto (modo rápido).
+"""
+import os
+import re
+import time
+import shutil
+import hashlib
+import zipfile
+import posixpath
+from io import BytesIO
+from xml.sax.saxutils import escape as xml_escape
+
+# PyMuPDF solo hace falta para el modo rápido
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+# Pillow es opcional: sin él se reempaqueta el DOCX pero no se tocan las imágenes
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Optimización del DOCX generado (la misma configuración en las dos apps)
+DOCX_OPTIMIZE = os.environ.get("DOCX_OPTIMIZE", "true").lower() == "true"
+DOCX_DEFLATE_LEVEL = int(os.environ.get("DOCX_DEFLATE_LEVEL", "9"))  # Nivel de compresión del ZIP (0-9)
+DOCX_IMAGE_TARGET_DPI = int(os.environ.get("DOCX_IMAGE_TARGET_DPI", "150"))  # 0 desactiva la reducción de imágenes
+DOCX_JPEG_QUALITY = int(os.environ.get("DOCX_JPEG_QUALITY", "80"))
+
+
+# --- OPTIMIZACIÓN DEL DOCX ---
+# Los conversores incrustan las imágenes a resolución completa y comprimen el ZIP
+# con el nivel por defecto. Tras convertir se reempaqueta el DOCX: imágenes
+# reducidas a DOCX_IMAGE_TARGET_DPI según el tamaño con el que se muestran,
+# medios idénticos guardados una sola vez y deflate con DOCX_DEFLATE_LEVEL.
+
+EMU_PER_INCH = 914400
+_DRAWING_RE = re.compile(rb'<w:drawing>.*?</w:drawing>', re.S)
+_EXTENT_RE = re.compile(rb'<wp:extent cx="(\d+)" cy="(\d+)"')
+_EMBED_RE = re.compile(rb'r:embed="([^"]+)"')
+_RELATIONSHIP_RE = re.compile(rb'<Relationship\b[^>]*>')
+_XML_ATTR_RE = re.compile(rb'([\w:]+)="([^"]*)"')
+_OVERRIDE_RE = re.compile(rb'<Override\b[^>]*PartName="([^"]+)"[^>]*/>')
+_IMAGE_FORMATS = {'.jpeg': 'JPEG', '.jpg': 'JPEG', '.png': 'PNG'}
+
+
+def docx_optimization_tag():
+    """Identifica los ajustes de optimización; forma parte de la clave de caché"""
+    if not DOCX_OPTIMIZE:
+        return "raw"
+    dpi = DOCX_IMAGE_TARGET_DPI if Image is not None else 0
+    return f"opt{DOCX_DEFLATE_LEVEL}-{dpi}dpi-q{DOCX_JPEG_QUALITY}"
+
+
+def _rels_source_dir(rels_name):
+    """word/_rels/document.xml.rels -> word"""
+    return posixpath.dirname(posixpath.dirname(rels_name))
+
+
+def _resolve_rel_target(rels_name, target):
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(_rels_source_dir(rels_name), target))
+
+
+def _parse_relationships(rels_xml):
+    relationships = []
+    for match in _RELATIONSHIP_RE.finditer(rels_xml):
+        attrs = {key.decode(): value.decode() for key, value in _XML_ATTR_RE.findall(match.group(0))}
+        relationships.append((match.group(0), attrs))
+    return relationships
+
+
+def _hash_zip_entry(zin, info):
+    digest = hashlib.sha256()
+    with zin.open(info) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _downsample_image(data, extension, extent):
+    """Reduce la imagen a DOCX_IMAGE_TARGET_DPI; devuelve los bytes nuevos o None si no compensa"""
+    image_format = _IMAGE_FORMATS.get(extension)
+    if image_format is None:
+        return None
+    shown_width_in = extent[0] / EMU_PER_INCH
+    if shown_width_in <= 0:
+        return None
+
+    with Image.open(BytesIO(data)) as img:
+        width, height = img.size
+        target_width = max(1, round(shown_width_in * DOCX_IMAGE_TARGET_DPI))
+        # Solo se toca si sobra al menos un 10% de resolución
+        if target_width >= width * 0.9:
+            return None
+        target_height = max(1, round(height * target_width / width))
+        if img.mode == 'P':
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        resized = img.resize((target_width, target_height), Image.LANCZOS)
+        output = BytesIO()
+        if image_format == 'JPEG':
+            if resized.mode not in ('RGB', 'L', 'CMYK'):
+                resized = resized.convert('RGB')
+            resized.save(output, 'JPEG', quality=DOCX_JPEG_QUALITY, optimize=True)
+        else:
+            resized.save(output, 'PNG', optimize=True)
+
+    new_data = output.getvalue()
+    return new_data if len(new_data) < len(data) else None
+
+
+def optimize_docx(docx_path):
+    """
+    Reempaqueta el DOCX en su sitio. Solo sustituye el archivo si el resultado es
+    más pequeño. Devuelve un dict con los bytes ahorrados y el tiempo empleado.
+    """
+    start = time.time()
+    original_size = os.path.getsize(docx_path)
+    stats = {"original_bytes": original_size, "optimized_bytes": original_size, "saved_bytes": 0,
+             "images_downsampled": 0, "media_deduplicated": 0, "duration_ms": 0}
+    partial_path = f"{docx_path}.opt"
+
+    try:
+        with zipfile.ZipFile(docx_path) as zin:
+            infos = zin.infolist()
+            names = {info.filename for info in infos}
+
+            # 1. Medios idénticos: el primero que aparece es el canónico
+            canonical_by_hash = {}
+            duplicates = {}
+            for info in infos:
+                if info.filename.startswith('word/media/'):
+                    digest = _hash_zip_entry(zin, info)
+                    canonical = canonical_by_hash.setdefault(digest, info.filename)
+                    if canonical != info.filename:
+                        duplicates[info.filename] = canonical
+
+            # 2. Relaciones: se redirigen los duplicados y se anota qué id apunta a cada imagen
+            replacements = {}
+            targets_by_part = {}
+            for info in infos:
+                if not info.filename.endswith('.rels'):
+                    continue
+                rels_xml = zin.read(info)
+                new_rels_xml = rels_xml
+                targets = {}
+                for tag, attrs in _parse_relationships(rels_xml):
+                    if attrs.get('TargetMode') == 'External' or 'Target' not in attrs:
+                        continue
+                    part = _resolve_rel_target(info.filename, attrs['Target'])
+                    if part in duplicates:
+                        part = duplicates[part]
+                        new_target = posixpath.relpath(part, _rels_source_dir(info.filename))
+                        new_tag = tag.replace(f'Target="{attrs["Target"]}"'.encode(), f'Target="{new_target}"'.encode())
+                        new_rels_xml = new_rels_xml.replace(tag, new_tag)
+                    targets[attrs.get('Id', '')] = part
+                if new_rels_xml != rels_xml:
+                    replacements[info.filename] = new_rels_xml
+                source_part = posixpath.join(_rels_source_dir(info.filename), posixpath.basename(info.filename)[:-len('.rels')])
+                targets_by_part[source_part] = targets
+
+            if duplicates and '[Content_Types].xml' in names:
+                content_types = zin.read('[Content_Types].xml')
+                removed = {f"/{name}".encode() for name in duplicates}
+                replacements['[Content_Types].xml'] = _OVERRIDE_RE.sub(
+                    lambda m: b'' if m.group(1) in removed else m.group(0), content_types
+                )
+
+            # 3. Tamaño con el que se muestra cada imagen (el mayor si aparece varias veces)
+            extents = {}
+            if Image is not None and DOCX_IMAGE_TARGET_DPI > 0:
+                for part, targets in targets_by_part.items():
+                    if part not in names or not part.endswith('.xml') or not targets:
+                        continue
+                    part_xml = zin.read(part)
+                    for drawing in _DRAWING_RE.findall(part_xml):
+                        extent = _EXTENT_RE.search(drawing)
+                        embed = _EMBED_RE.search(drawing)
+                        if not extent or not embed:
+                            continue
+                        media = targets.get(embed.group(1).decode())
+                        if media is None:
+                            continue
+                        cx, cy = int(extent.group(1)), int(extent.group(2))
+                        previous = extents.get(media, (0, 0))
+                        extents[media] = (max(previous[0], cx), max(previous[1], cy))
+
+                for media, extent in extents.items():
+                    if media not in names or media in duplicates:
+                        continue
+                    try:
+                        new_data = _downsample_image(zin.read(media), posixpath.splitext(media)[1].lower(), extent)
+                    except Exception as e:
+                        print(f"No se pudo reducir la imagen {media}: {e}")
+                        continue
+                    if new_data is not None:
+                        replacements[media] = new_data
+                        stats["images_downsampled"] += 1
+
+            # 4. Nuevo ZIP en el mismo orden ([Content_Types].xml sigue el primero)
+            with zipfile.ZipFile(partial_path, 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=DOCX_DEFLATE_LEVEL) as zout:
+                for info in infos:
+                    if info.filename in duplicates:
+                        continue
+                    if info.filename in replacements:
+                        zout.writestr(info.filename, replacements[info.filename])
+                    else:
+                        with zin.open(info) as src, zout.open(info.filename, 'w') as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        stats["media_deduplicated"] = len(duplicates)
+        optimized_size = os.path.getsize(partial_path)
+        if optimized_size < original_size:
+            os.replace(partial_path, docx_path)
+            stats["optimized_bytes"] = optimized_size
+            stats["saved_bytes"] = original_size - optimized_size
+    except Exception as e:
+        # Un DOCX que no se puede reempaquetar se entrega tal cual
+        print(f"No se pudo optimizar el DOCX: {e}")
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    stats["duration_ms"] = round((time.time() - start) * 1000, 1)
+    print(f"DOCX optimizado: {original_size / (1024 * 1024):.2f} MB -> "
+          f"{stats['optimized_bytes'] / (1024 * 1024):.2f} MB "
+          f"({stats['saved_bytes'] / 1024:.0f} KB ahorrados) en {stats['duration_ms']} ms, "
+          f"{stats['images_downsampled']} imágenes reducidas, {stats['media_deduplicated']} medios duplicados")
+    return stats
+
+
+# --- CONVERSIÓN RÁPIDA (SOLO TEXTO) ---
+# Para cartas y documentos de texto plano no hace falta reconstruir la
+# maquetación: se extraen los párrafos y los tramos de texto con PyMuPDF y se
+# escribe un DOCX mínimo directamente, página a página, sin pasar por
+# python-docx ni cargar el documento entero en memoria.
+
+_W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+_INVALID_XML_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+_FAST_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+_FAST_DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+
+def _xml_text(text):
+    return xml_escape(_INVALID_XML_CHARS_RE.sub('', text))
+
+
+def _fast_docx_run(text, bold, italic, size):
+    props = ''
+    if bold:
+        props += '<w:b/>'
+    if italic:
+        props += '<w:i/>'
+    if size:
+        props += f'<w:sz w:val="{round(size * 2)}"/>'
+    props = f'<w:rPr>{props}</w:rPr>' if props else ''
+    return f'<w:r>{props}<w:t xml:space="preserve">{_xml_text(text)}</w:t></w:r>'
+
+
+def _fast_docx_paragraphs(page):
+    """Un párrafo por bloque de texto; los tramos con el mismo formato se agrupan en un run"""
+    for block in page.get_text("dict", flags=fitz.TEXT_PRESERVE_WHITESPACE)["blocks"]:
+        if block.get("type") != 0:
+            continue
+        runs = []
+        current = None
+        for line_index, line in enumerate(block["lines"]):
+            for span_index, span in enumerate(line["spans"]):
+                text = span["text"]
+                if line_index and span_index == 0:
+                    # Las líneas de un mismo bloque se unen; un guion final se quita
+                    if current and current[0].endswith('-'):
+                        current[0] = current[0][:-1]
+                    elif current and not current[0].endswith(' '):
+                        text = ' ' + text
+                style = (bool(span["flags"] & fitz.TEXT_FONT_BOLD), bool(span["flags"] & fitz.TEXT_FONT_ITALIC),
+                         round(span["size"] * 2) / 2)
+                if current and current[1] == style:
+                    current[0] += text
+                else:
+                    current = [text, style]
+                    runs.append(current)
+        runs = [(text, style) for text, style in runs if text]
+        if any(text.strip() for text, _ in runs):
+            yield '<w:p>' + ''.join(_fast_docx_run(text, *style) for text, style in runs) + '</w:p>'
+
+
+def convert_pdf_to_docx_text_only(pdf_path, docx_path):
+    """Escribe un DOCX con solo el texto del PDF; devuelve el número de páginas"""
+    with fitz.open(pdf_path) as doc, \
+            zipfile.ZipFile(docx_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zf.writestr('[Content_Types].xml', _FAST_DOCX_CONTENT_TYPES)
+        zf.writestr('_rels/.rels', _FAST_DOCX_RELS)
+        with zf.open('word/document.xml', 'w') as out:
+            out.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                       f'<w:document xmlns:w="{_W_NS}"><w:body>').encode())
+            for page_number, page in enumerate(doc):
+                if page_number:
+                    out.write(b'<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+                for paragraph in _fast_docx_paragraphs(page):
+                    out.write(paragraph.encode())
+            # Tamaño de página del PDF (puntos a twips) y márgenes de 2 cm
+            width, height = (doc[0].rect.width, doc[0].rect.height) if doc.page_count else (595, 842)
+            out.write((f'<w:sectPr><w:pgSz w:w="{round(width * 20)}" w:h="{round(height * 20)}"/>'
+                       '<w:pgMar w:top="1134" w:right="1134" w:bottom="1134" w:left="1134" '
+                       'w:header="709" w:footer="709" w:gutter="0"/></w:sectPr>'
+                       '</w:body></w:document>').encode())
+        return doc.page_count
@@ -0,0 +1,13 @@
+"""
+Utilidades de PDF compartidas por el triaje de las dos apps.
+"""
+
+
+def sample_page_numbers(page_count, samples):
+    """Hasta `samples` páginas repartidas por todo el documento, incluidas la primera y la última"""
+    if page_count <= samples:
+        return list(range(page_count))
+    if samples <= 1:
+        return [0]
+    step = (page_count - 1) / (samples - 1)
+    return sorted({round(i * step) for i in range(samples)})
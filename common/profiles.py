@@ -0,0 +1,62 @@
+"""
+Almacén en disco de los perfiles de conversiones lentas, compartido por las dos
+apps. Cada perfil es un JSON con su id en el nombre; se escribe en un .part y se
+renombra, así un lector nunca ve un perfil a medias.
+"""
+import os
+import re
+import json
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+
+
+class ProfileStore:
+    def __init__(self, profiles_dir, max_files, summary_fields):
+        self.profiles_dir = profiles_dir
+        self.max_files = max_files
+        self.summary_fields = summary_fields
+
+    def _path(self, profile_id):
+        return os.path.join(self.profiles_dir, f"{profile_id}.json")
+
+    def save(self, profile):
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        partial_path = self._path(profile['id']) + ".part"
+        with open(partial_path, 'w') as f:
+            json.dump(profile, f, ensure_ascii=False)
+        os.replace(partial_path, self._path(profile['id']))
+
+    def load(self, profile_id):
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def list(self, job_id=None):
+        """Resumen de los perfiles guardados, los más recientes primero"""
+        if not os.path.isdir(self.profiles_dir):
+            return []
+        profiles = []
+        for entry in os.scandir(self.profiles_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            profile = self.load(entry.name[:-len('.json')])
+            if profile is None or (job_id and profile.get('job_id') != job_id):
+                continue
+            profiles.append({field: profile.get(field) for field in self.summary_fields})
+        return sorted(profiles, key=lambda profile: profile['created_at'], reverse=True)
+
+    def prune(self):
+        """Borra los perfiles más antiguos por encima de max_files"""
+        entries = sorted(
+            (entry for entry in os.scandir(self.profiles_dir) if entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries[:max(0, len(entries) - self.max_files)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de extremo a extremo del webhook /api/convert
+
+Arranca api.convert:app con uvicorn y un servidor SMTP local (aiosmtpd) que hace
+de Gmail, y envía peticiones multipart como las del Inbound Parse de SendGrid a
+ritmos crecientes (--rates, peticiones por segundo, llegadas a ritmo fijo). Cada
+petición lleva un remitente distinto, así que la respuesta que llega al SMTP
+local se empareja con su petición para medir la latencia completa.
+
+Por cada ritmo informa de:
+- throughput real (respuestas enviadas por segundo)
+- latencia del webhook y de extremo a extremo (p50/p95/p99)
+- tasa de errores (HTTP distinto de 200 y respuestas que no llegan)
+- memoria (RSS) de uvicorn y sus procesos hijos, y profundidad de la cola
+
+y se detiene en el primer ritmo que satura la configuración actual.
+
+Requiere: pip install -r requirements-dev.txt (aiosmtpd y httpx)
+
+    python loadtest_convert.py --rates 1,2,4,8 --duration 30 --workers 1
+    python loadtest_convert.py --env CONVERSION_WORKERS=4 --env JOB_WORKERS=4
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from email.message import EmailMessage
+
+import httpx
+import psutil
+from aiosmtpd.controller import Controller
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ReplySink:
+    """Servidor SMTP local: anota cuándo llega la respuesta de cada destinatario"""
+
+    def __init__(self):
+        self.received = {}
+        self.lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        now = time.time()
+        with self.lock:
+            for rcpt in envelope.rcpt_tos:
+                self.received.setdefault(rcpt.lower(), now)
+        return '250 OK'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return round(ordered[index], 4)
+
+
+def load_pdf(path):
+    if path:
+        with open(path, 'rb') as f:
+            return f.read()
+    # Sin PDF propio se usa una carta de una página del corpus del benchmark
+    sys.path.insert(0, ROOT_DIR)
+    from benchmark_conversion import generate_pdf
+    pdf_path = os.path.join(tempfile.gettempdir(), "loadtest_carta.pdf")
+    generate_pdf(pdf_path, "text", 1, 42)
+    with open(pdf_path, 'rb') as f:
+        return f.read()
+
+
+def build_inbound_fields(sender, subject, pdf_bytes, unique_id):
+    """Campos del formulario tal como los manda SendGrid con 'Send Raw' activado"""
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = 'convert@example.com'
+    msg['Subject'] = subject
+    msg.set_content('Adjunto el documento.')
+    # Un comentario tras %%EOF hace cada PDF distinto (la caché no acierta) sin invalidarlo
+    pdf = pdf_bytes + f"\n% loadtest {unique_id}\n".encode()
+    msg.add_attachment(pdf, maintype='application', subtype='pdf', filename=f'documento_{unique_id}.pdf')
+    return {
+        'email': (None, msg.as_bytes()),
+        'to': (None, 'convert@example.com'),
+        'from': (None, sender),
+        'subject': (None, subject),
+        'envelope': (None, json.dumps({"to": ["convert@example.com"], "from": sender})),
+        'charsets': (None, json.dumps({"to": "UTF-8", "from": "UTF-8", "subject": "UTF-8"})),
+        'SPF': (None, 'pass')
+    }
+
+
+class ResourceSampler:
+    """Muestrea el RSS del árbol de procesos de uvicorn y la cola de trabajos"""
+
+    def __init__(self, pid, health_url):
+        self.process = psutil.Process(pid)
+        self.health_url = health_url
+        self.samples = []
+
+    def rss_mb(self):
+        total = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                total += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total / (1024 * 1024)
+
+    async def run(self, client, interval=0.5):
+        while True:
+            sample = {"time": time.time(), "rss_mb": self.rss_mb(), "queue": None}
+            try:
+                jobs = (await client.get(self.health_url, timeout=5)).json().get("jobs", {})
+                sample["queue"] = jobs.get("pending", 0) + jobs.get("running", 0)
+            except Exception:
+                pass
+            self.samples.append(sample)
+            await asyncio.sleep(interval)
+
+    def window(self, start, end):
+        return [sample for sample in self.samples if start <= sample["time"] <= end]
+
+
+async def run_stage(client, url, rate, duration, drain_timeout, pdf_bytes, subject, sink, sampler, stage_index):
+    requests_count = max(1, int(rate * duration))
+    sent_at = {}
+    http_latencies = []
+    http_errors = []
+
+    async def send(n):
+        sender = f"loadtest+{stage_index}-{n}@example.com"
+        fields = build_inbound_fields(sender, subject, pdf_bytes, f"{stage_index}-{n}")
+        start = time.time()
+        sent_at[sender] = start
+        try:
+            response = await client.post(url, files=fields, timeout=60)
+            http_latencies.append(time.time() - start)
+            if response.status_code != 200:
+                http_errors.append(f"HTTP {response.status_code}")
+                sent_at.pop(sender)
+        except httpx.HTTPError as e:
+            http_errors.append(type(e).__name__)
+            sent_at.pop(sender)
+
+    print(f"🚀 {rate} pet/s durante {duration}s ({requests_count} peticiones)...", flush=True)
+    stage_start = time.time()
+    tasks = []
+    for n in range(requests_count):
+        # Llegadas a ritmo fijo, sin esperar a que terminen las anteriores
+        await asyncio.sleep(max(0, stage_start + n / rate - time.time()))
+        tasks.append(asyncio.create_task(send(n)))
+    await asyncio.gather(*tasks)
+
+    deadline = time.time() + drain_timeout
+    while time.time() < deadline:
+        with sink.lock:
+            pending = [sender for sender in sent_at if sender not in sink.received]
+        if not pending:
+            break
+        await asyncio.sleep(0.2)
+    stage_end = time.time()
+
+    with sink.lock:
+        replies = {sender: sink.received[sender] - started
+                   for sender, started in sent_at.items() if sender in sink.received}
+    reply_times = sorted(sent_at[sender] + latency for sender, latency in replies.items())
+    # Ritmo entre la primera y la última respuesta, sin contar la latencia de arranque y vaciado
+    if len(reply_times) > 1:
+        throughput = (len(reply_times) - 1) / max(reply_times[-1] - reply_times[0], 1e-6)
+    else:
+        throughput = len(reply_times) / max(stage_end - stage_start, 1e-6)
+    missing = len(sent_at) - len(replies)
+    errors = len(http_errors) + missing
+    samples = sampler.window(stage_start, stage_end)
+    queue_depths = [sample["queue"] for sample in samples if sample["queue"] is not None]
+
+    result = {
+        "offered_rate": rate,
+        "requests": requests_count,
+        "replies": len(replies),
+        "throughput": round(throughput, 3),
+        "http_latency_s": {p: percentile(http_latencies, int(p[1:])) for p in ("p50", "p95", "p99")},
+        "e2e_latency_s": {p: percentile(list(replies.values()), int(p[1:])) for p in ("p50", "p95", "p99")},
+        "http_errors": len(http_errors),
+        "missing_replies": missing,
+        "error_rate": round(errors / requests_count, 4),
+        "rss_mb": {
+            "start": round(samples[0]["rss_mb"], 1) if samples else None,
+            "peak": round(max(sample["rss_mb"] for sample in samples), 1) if samples else None,
+            "end": round(samples[-1]["rss_mb"], 1) if samples else None
+        },
+        "max_queue_depth": max(queue_depths) if queue_depths else None
+    }
+    # Saturado: no da abasto con el ritmo ofrecido o empieza a perder peticiones
+    result["saturated"] = result["error_rate"] > 0.01 or result["throughput"] < 0.9 * rate
+
+    e2e = result["e2e_latency_s"]
+    print(f"   throughput {result['throughput']} resp/s | e2e p50 {e2e['p50']}s p95 {e2e['p95']}s p99 {e2e['p99']}s | "
+          f"errores {result['error_rate']:.1%} | RSS {result['rss_mb']['start']} -> {result['rss_mb']['peak']} MB | "
+          f"cola máx {result['max_queue_depth']}" + (" | ⚠️ SATURADO" if result["saturated"] else ""))
+    return result
+
+
+def start_app(port, smtp_port, workers, jobs_dir, extra_env, log_path):
+    env = dict(os.environ)
+    env.update({
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_STARTTLS": "false",
+        "GMAIL_EMAIL": "convert@example.com",
+        "GMAIL_APP_PASSWORD": "",
+        "JOBS_DIR": jobs_dir,
+        "CACHE_DIR": os.path.join(jobs_dir, "cache"),
+        "TRIAGE_LOG_PATH": os.path.join(jobs_dir, "triage.jsonl")
+    })
+    env.update(extra_env)
+    log = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, "-W", "ignore", "-m", "uvicorn", "api.convert:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    return process, log
+
+
+async def wait_until_ready(client, health_url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("uvicorn terminó al arrancar; revisa el log")
+        try:
+            if (await client.get(health_url, timeout=2)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("uvicorn no respondió a /health a tiempo")
+
+
+async def main_async(args):
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    rates = [float(rate) for rate in args.rates.split(",")]
+    pdf_bytes = load_pdf(args.pdf)
+
+    sink = ReplySink()
+    smtp_port = free_port()
+    controller = Controller(sink, hostname='127.0.0.1', port=smtp_port)
+    controller.start()
+
+    app_port = free_port()
+    jobs_dir = tempfile.mkdtemp(prefix="loadtest_jobs_")
+    log_path = os.path.join(jobs_dir, "uvicorn.log")
+    process, log = start_app(app_port, smtp_port, args.workers, jobs_dir, extra_env, log_path)
+    base_url = f"http://127.0.0.1:{app_port}"
+    print(f"Servidor en {base_url} ({args.workers} workers), SMTP local en :{smtp_port}, log en {log_path}\n")
+
+    stages = []
+    limits = httpx.Limits(max_connections=args.max_connections)
+    try:
+        async with httpx.AsyncClient(limits=limits) as client:
+            await wait_until_ready(client, f"{base_url}/health", process)
+            sampler = ResourceSampler(process.pid, f"{base_url}/health")
+            sampler_task = asyncio.create_task(sampler.run(client))
+            baseline_rss = sampler.rss_mb()
+            for index, rate in enumerate(rates):
+                stage = await run_stage(client, f"{base_url}/api/convert", rate, args.duration, args.drain_timeout,
+                                        pdf_bytes, args.subject, sink, sampler, index)
+                stages.append(stage)
+                if stage["saturated"] and not args.keep_going:
+                    break
+            sampler_task.cancel()
+            final_rss = sampler.rss_mb()
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        controller.stop()
+
+    sustained = [stage["offered_rate"] for stage in stages if not stage["saturated"]]
+    saturated = [stage["offered_rate"] for stage in stages if stage["saturated"]]
+    summary = {
+        "max_sustained_rate": max(sustained) if sustained else None,
+        "first_saturated_rate": min(saturated) if saturated else None,
+        "rss_growth_mb": round(final_rss - baseline_rss, 1)
+    }
+    print("\n📊 Resumen")
+    if saturated:
+        print(f"   Saturación entre {summary['max_sustained_rate']} y {summary['first_saturated_rate']} pet/s")
+    else:
+        print(f"   Sin saturación hasta {summary['max_sustained_rate']} pet/s; prueba ritmos mayores")
+    print(f"   Crecimiento de memoria: {summary['rss_growth_mb']} MB ({baseline_rss:.1f} -> {final_rss:.1f} MB)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "meta": {"timestamp": datetime.now().isoformat(), "workers": args.workers, "env": extra_env,
+                         "duration": args.duration, "pdf_bytes": len(pdf_bytes), "cpu_count": os.cpu_count()},
+                "stages": stages,
+                "summary": summary
+            }, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de /api/convert con SMTP local")
+    parser.add_argument("--rates", default="0.5,1,2,4,8", help="Ritmos a probar, en peticiones por segundo")
+    parser.add_argument("--duration", type=int, default=30, help="Segundos enviando peticiones por ritmo")
+    parser.add_argument("--drain-timeout", type=int, default=120,
+                        help="Segundos máximos esperando las respuestas pendientes tras cada ritmo")
+    parser.add_argument("--workers", type=int, default=1, help="Workers de uvicorn")
+    parser.add_argument("--env", action="append", default=[], metavar="CLAVE=VALOR",
+                        help="Variables de entorno extra para la app (p. ej. CONVERSION_WORKERS=4)")
+    parser.add_argument("--pdf", default=None, help="PDF adjunto (por defecto una carta generada)")
+    parser.add_argument("--subject", default="word", help="Asunto de los emails (p. ej. 'word rapido')")
+    parser.add_argument("--max-connections", type=int, default=200, help="Conexiones HTTP simultáneas máximas")
+    parser.add_argument("--keep-going", action="store_true", help="Seguir con los ritmos mayores tras saturar")
+    parser.add_argument("--output", default=None, help="Fichero JSON de resultados")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
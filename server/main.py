@@ -1,12 +1,64 @@
 import os
+import sys
+import asyncio
 import subprocess
 import tempfile
 import uuid
 import time
 import shutil
+import queue
+import threading
+import hashlib
+import collections
+import sqlite3
+import json
+import re
+import zipfile
+import math
+import multiprocessing
+from multiprocessing import forkserver
+from contextlib import asynccontextmanager, closing, contextmanager
 from datetime import datetime, timedelta
-from fastapi import FastAPI, File, UploadFile, HTTPException, Header
-from fastapi.responses import FileResponse, JSONResponse
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# El código compartido con api/convert.py está en common/, en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import (
+    DOCX_OPTIMIZE, ConversionCache, ProfileStore, convert_pdf_to_docx_text_only, docx_optimization_tag,
+    optimize_docx, sample_page_numbers
+)
+
+# El puente UNO solo existe si LibreOffice trae su binding de Python (python3-uno)
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+# PyMuPDF es opcional: sin él el triaje se hace buscando marcadores en los bytes del PDF
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+# psutil es opcional: sin él no se perfilan las conversiones lentas
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 # --- CONFIGURACIÓN ---
 # ¡CAMBIA ESTA CLAVE por una segura y larga!
@@ -16,32 +68,1356 @@ API_KEY = "yW22q7[+4h0"
 TEMP_DIR = "/opt/conversion-api/temp_files"
 MAX_FILE_SIZE_MB = 25  # Límite para envío directo por email
 FILE_EXPIRY_HOURS = 24  # Tiempo de vida de los archivos temporales
+# Registro de archivos almacenados, compartido por todos los workers de uvicorn
+FILE_REGISTRY_DB_PATH = os.environ.get("FILE_REGISTRY_DB_PATH", "/opt/conversion-api/file_registry.db")
+FILE_SWEEP_INTERVAL_SECONDS = int(os.environ.get("FILE_SWEEP_INTERVAL_SECONDS", "60"))  # Espera máxima entre barridos
+FILE_SWEEP_BATCH_SIZE = int(os.environ.get("FILE_SWEEP_BATCH_SIZE", "500"))  # Entradas borradas por transacción
+MAX_UPLOAD_SIZE_MB = int(os.environ.get("MAX_UPLOAD_SIZE_MB", "100"))  # Tamaño máximo del PDF subido
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bloques de 1 MB al copiar el PDF subido a disco
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Bloques al servir descargas
+
+# Configuración del pool de LibreOffice
+LIBREOFFICE_POOL_SIZE = int(os.environ.get("LIBREOFFICE_POOL_SIZE", "2"))  # Instancias headless simultáneas
+LIBREOFFICE_MAX_JOBS = int(os.environ.get("LIBREOFFICE_MAX_JOBS", "50"))  # Reciclar la instancia tras N conversiones
+# Puerto UNO de la primera instancia; con 0 cada instancia escucha en una pipe con nombre
+# propio (worker e índice), así varios workers de uvicorn nunca compiten por un puerto
+LIBREOFFICE_BASE_PORT = int(os.environ.get("LIBREOFFICE_BASE_PORT", "0"))
+LIBREOFFICE_STARTUP_TIMEOUT = 30  # Segundos para que una instancia acepte conexiones UNO
+LIBREOFFICE_CONVERSION_TIMEOUT = int(os.environ.get("LIBREOFFICE_CONVERSION_TIMEOUT", "300"))
+LIBREOFFICE_PROFILES_DIR = os.environ.get(
+    "LIBREOFFICE_PROFILES_DIR",
+    os.path.join(tempfile.gettempdir(), "libreoffice_profiles")
+)
+
+# Caché de conversiones por hash del PDF
+CACHE_DIR = os.environ.get("CACHE_DIR", "/opt/conversion-api/cache")
+CACHE_MAX_MB = float(os.environ.get("CACHE_MAX_MB", "1000"))
+
+# Triaje previo a la conversión
+TRIAGE_SAMPLE_PAGES = int(os.environ.get("TRIAGE_SAMPLE_PAGES", "5"))  # Páginas inspeccionadas por PDF
+TRIAGE_MAX_PAGES = int(os.environ.get("TRIAGE_MAX_PAGES", "2000"))  # PDFs más largos se rechazan
+TRIAGE_LOG_PATH = os.environ.get("TRIAGE_LOG_PATH", "/opt/conversion-api/triage.jsonl")  # Decisiones de enrutado
+TRIAGE_TIMEOUT_SECONDS = int(os.environ.get("TRIAGE_TIMEOUT_SECONDS", "15"))  # PDFs que tardan más en analizarse se rechazan
+# Con TRIAGE_AUTO_FAST los PDFs de texto puro van al modo rápido aunque no se pida ?fast=true
+TRIAGE_AUTO_FAST = os.environ.get("TRIAGE_AUTO_FAST", "false").lower() == "true"
+
+# Optimización del DOCX convertido: DOCX_OPTIMIZE, DOCX_DEFLATE_LEVEL, DOCX_IMAGE_TARGET_DPI
+# y DOCX_JPEG_QUALITY se leen en common/docx_utils.py, igual para las dos apps
+
+# Perfiles de las conversiones lentas (opcional): CPU, memoria y estado de soffice
+# muestreados durante cada conversión; se guardan los de las que superan el umbral
+PROFILE_SLOW_CONVERSIONS = os.environ.get("PROFILE_SLOW_CONVERSIONS", "false").lower() == "true"
+PROFILE_THRESHOLD_SECONDS = float(os.environ.get("PROFILE_THRESHOLD_SECONDS", "30"))
+PROFILE_SAMPLE_INTERVAL_MS = int(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "100"))
+PROFILE_MAX_TIMELINE_POINTS = 1000  # Las series más largas se diezman al guardarlas
+PROFILES_DIR = os.environ.get("PROFILES_DIR", "/opt/conversion-api/profiles")
+PROFILES_MAX_FILES = int(os.environ.get("PROFILES_MAX_FILES", "200"))  # Se borran los más antiguos
+
+# Admisión: bucket de tokens por clave de API (compartido por todos los workers) y
+# tope de conversiones simultáneas por worker, igual que su pool de LibreOffice.
+# Lo que supera el límite espera su turno hasta ADMISSION_MAX_WAIT_SECONDS; si no, 429
+ADMISSION_KEY_RATE_PER_MINUTE = float(os.environ.get("ADMISSION_KEY_RATE_PER_MINUTE", "60"))  # 0 sin límite
+ADMISSION_KEY_BURST = int(os.environ.get("ADMISSION_KEY_BURST", "20"))  # Conversiones seguidas antes de frenar
+ADMISSION_MAX_CONCURRENT = int(os.environ.get(  # Conversiones en curso por proceso de uvicorn
+    "ADMISSION_MAX_CONCURRENT", str(max(LIBREOFFICE_POOL_SIZE, os.cpu_count() or 1))
+))
+ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "30"))
+
+# Métricas de Prometheus en /metrics; con varios workers de uvicorn hay que apuntar
+# PROMETHEUS_MULTIPROC_DIR a un directorio vacío para que se sumen los de todos
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
 
 # Crear directorio temporal si no existe
 os.makedirs(TEMP_DIR, exist_ok=True)
 
 app = FastAPI()
 
-# Diccionario para rastrear archivos (en producción usar BD)
-file_registry = {}
+# --- MÉTRICAS ---
+# Un histograma por etapa de una conversión, contadores por resultado y gauges
+# de las conversiones en curso y del registro de archivos.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
 
-def cleanup_expired_files():
-    """Eliminar archivos expirados"""
-    current_time = datetime.now()
-    expired_files = []
-    
-    for file_id, file_info in file_registry.items():
-        if current_time > file_info['expires_at']:
-            expired_files.append(file_id)
+TEMP_WRITE_SECONDS = Histogram(
+    "conversion_api_temp_write_seconds", "Copia a disco del PDF subido", buckets=STAGE_BUCKETS
+)
+CONVERSION_SECONDS = Histogram(
+    "conversion_api_conversion_seconds", "Conversión de un PDF (sin contar aciertos de caché)",
+    ["engine"], buckets=STAGE_BUCKETS
+)
+DOCX_VALIDATION_SECONDS = Histogram(
+    "conversion_api_docx_validation_seconds", "Validación del DOCX generado", buckets=STAGE_BUCKETS
+)
+
+TRIAGE_DECISIONS = Counter("conversion_api_triage_decisions_total", "Decisiones del triaje por ruta", ["route"])
+CONVERSIONS = Counter("conversion_api_conversions_total", "Conversiones por motor y resultado", ["engine", "outcome"])
+
+ADMISSION_DECISIONS = Counter(
+    "conversion_api_admission_total", "Peticiones de conversión por resultado de la admisión",
+    ["outcome"]  # immediate, delayed, rejected
+)
+
+CONVERSIONS_IN_FLIGHT = Gauge(
+    "conversion_api_conversions_in_flight", "Conversiones en curso", multiprocess_mode="livesum"
+)
+
+
+class FileRegistryCollector:
+    """
+    Archivos en el registro; se lee de SQLite en cada scrape porque lo comparten todos
+    los workers. /metrics llama a generate_latest en el threadpool, así que la lectura
+    no bloquea el event loop.
+    """
+
+    def _family(self):
+        return GaugeMetricFamily("conversion_api_registered_files", "Archivos convertidos pendientes de descarga")
+
+    def describe(self):
+        return [self._family()]
+
+    def collect(self):
+        family = self._family()
+        try:
+            family.add_metric([], count_registered_files())
+        except sqlite3.Error as e:
+            print(f"Error leyendo el registro de archivos para las métricas: {e}")
+            return
+        yield family
+
+
+file_registry_collector = FileRegistryCollector()
+if not PROMETHEUS_MULTIPROC_DIR:
+    REGISTRY.register(file_registry_collector)
+
+
+def metrics_registry():
+    """Registro a exportar: el del proceso o, en modo multiproceso, el agregado de todos los workers"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(file_registry_collector)
+    return registry
+
+
+@app.get("/metrics")
+async def metrics():
+    data = await run_in_threadpool(generate_latest, metrics_registry())
+    return Response(data, media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("shutdown")
+async def mark_metrics_process_dead():
+    # Los gauges 'livesum' de este worker dejan de contar al terminar
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+# --- PERFILES DE CONVERSIONES LENTAS ---
+# soffice no es Python, así que no hay pilas que muestrear: con PROFILE_SLOW_CONVERSIONS
+# se apunta cada PROFILE_SAMPLE_INTERVAL_MS la CPU de usuario y de sistema, la memoria
+# y los hilos de soffice y sus hijos, el estado de cada proceso y, en Linux, el canal
+# del kernel en el que espera (wchan). La proporción entre CPU y tiempo real y esos
+# estados dicen si una conversión lenta está calculando o esperando. Los perfiles de
+# las conversiones que superan PROFILE_THRESHOLD_SECONDS se guardan en PROFILES_DIR.
+PROFILE_SUMMARY_FIELDS = ('id', 'created_at', 'status', 'engine', 'filename', 'wall_s', 'cpu_s', 'samples')
+profile_store = ProfileStore(PROFILES_DIR, PROFILES_MAX_FILES, PROFILE_SUMMARY_FIELDS)
+
+
+def new_profile_metadata(pdf_path, pdf_sha256):
+    return {
+        "id": uuid.uuid4().hex[:16],
+        "engine": "libreoffice",
+        "filename": os.path.basename(pdf_path),
+        "sha256": pdf_sha256,
+        "pdf_bytes": os.path.getsize(pdf_path)
+    }
+
+
+def _read_wait_channel(pid):
+    try:
+        with open(f"/proc/{pid}/wchan") as f:
+            wchan = f.read().strip()
+    except OSError:
+        return None
+    return wchan if wchan and wchan != "0" else None
+
+
+class SofficeProfiler:
+    """Muestrea soffice y sus procesos hijos en un hilo mientras dura una conversión"""
+
+    def __init__(self, pid, metadata):
+        self.process = psutil.Process(pid)
+        self.profile = dict(metadata)
+        self.timeline = []
+        self.states = collections.Counter()
+        self.wait_channels = collections.Counter()
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.start_time = time.time()
+        self.start_cpu = self._cpu_times()
+
+    def _processes(self):
+        try:
+            return [self.process] + self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
+
+    def _cpu_times(self):
+        # Los hijos ya terminados cuentan en children_* de quien los esperó
+        user = system = 0.0
+        for process in self._processes():
+            try:
+                times = process.cpu_times()
+            except psutil.NoSuchProcess:
+                continue
+            user += times.user + times.children_user
+            system += times.system + times.children_system
+        return user, system
+
+    def _sample(self):
+        rss = 0
+        threads = 0
+        for process in self._processes():
             try:
-                os.remove(file_info['path'])
-                print(f"Archivo expirado eliminado: {file_info['path']}")
+                with process.oneshot():
+                    name = process.name()
+                    rss += process.memory_info().rss
+                    threads += process.num_threads()
+                    self.states[f"{name}:{process.status()}"] += 1
+            except psutil.NoSuchProcess:
+                continue
+            wait_channel = _read_wait_channel(process.pid)
+            if wait_channel:
+                self.wait_channels[f"{name}:{wait_channel}"] += 1
+        user, system = self._cpu_times()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.timeline.append({
+            "t": round(time.time() - self.start_time, 3),
+            "cpu_user_s": round(user - self.start_cpu[0], 3),
+            "cpu_system_s": round(system - self.start_cpu[1], 3),
+            "rss_mb": round(rss / (1024 * 1024), 1),
+            "threads": threads
+        })
+
+    def _run(self):
+        while not self.stop_event.wait(PROFILE_SAMPLE_INTERVAL_MS / 1000):
+            self._sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, status, error=None):
+        self.stop_event.set()
+        self.thread.join()
+        wall = time.time() - self.start_time
+        if wall < PROFILE_THRESHOLD_SECONDS:
+            return
+        last = self.timeline[-1] if self.timeline else {"cpu_user_s": 0, "cpu_system_s": 0}
+        cpu = last["cpu_user_s"] + last["cpu_system_s"]
+        step = max(1, len(self.timeline) // PROFILE_MAX_TIMELINE_POINTS)
+        self.profile.update({
+            "status": status,
+            "error": error,
+            "created_at": datetime.fromtimestamp(self.start_time).isoformat(),
+            "threshold_s": PROFILE_THRESHOLD_SECONDS,
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3),
+            "cpu_user_s": last["cpu_user_s"],
+            "cpu_system_s": last["cpu_system_s"],
+            "cpu_utilisation": round(cpu / wall, 2),
+            "peak_rss_mb": round(self.peak_rss / (1024 * 1024), 1),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL_MS,
+            "samples": len(self.timeline),
+            "states": dict(self.states.most_common()),
+            "wait_channels": dict(self.wait_channels.most_common(20)),
+            "timeline": self.timeline[::step]
+        })
+        try:
+            profile_store.save(self.profile)
+            profile_store.prune()
+        except OSError as e:
+            print(f"No se pudo guardar el perfil {self.profile['id']}: {e}")
+            return
+        print(f"Perfil de conversión lenta guardado: {self.profile['id']} "
+              f"({wall:.1f}s, CPU {self.profile['cpu_utilisation']:.0%})")
+
+
+@contextmanager
+def profile_soffice(pid, profile):
+    """Perfila soffice mientras dura el bloque, si se pidió perfil y psutil está disponible"""
+    profiler = None
+    if profile is not None and psutil is not None and pid is not None:
+        try:
+            profiler = SofficeProfiler(pid, profile)
+            profiler.start()
+        except psutil.NoSuchProcess:
+            profiler = None
+    if profiler is None:
+        yield
+        return
+    try:
+        yield
+    except BaseException as e:
+        profiler.stop("error", str(e))
+        raise
+    profiler.stop("ok")
+
+
+class LibreOfficeError(Exception):
+    """Error de conversión en una instancia de LibreOffice"""
+
+
+def remove_stale_profiles():
+    """Borra los perfiles de LibreOffice de workers que ya no existen"""
+    if not os.path.isdir(LIBREOFFICE_PROFILES_DIR):
+        return
+    for entry in os.scandir(LIBREOFFICE_PROFILES_DIR):
+        pid = entry.name[len('worker_'):]
+        if not entry.name.startswith('worker_') or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except PermissionError:
+            pass
+
+
+class LibreOfficeInstance:
+    """
+    Proceso headless de LibreOffice de larga duración con su propio perfil de usuario
+    y listener UNO. Sin binding UNO se usa --convert-to con el perfil dedicado, que al
+    menos evita recrear el perfil en cada conversión y permite conversiones en paralelo.
+
+    El listener es una pipe con nombre que crea el propio soffice: no hay que buscar
+    antes un puerto libre que otro proceso podría ocupar entre medias.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.connection = None
+        self.process = None
+        self.desktop = None
+        self.jobs_done = 0
+        self.restarts = 0
+
+    @property
+    def profile_dir(self):
+        # Un directorio por proceso: dos workers de uvicorn nunca comparten perfil
+        return os.path.join(LIBREOFFICE_PROFILES_DIR, f"worker_{os.getpid()}", f"instance_{self.index}")
+
+    @property
+    def profile_url(self):
+        return f"file://{self.profile_dir}"
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.jobs_done = 0
+        if uno is None:
+            return
+
+        if LIBREOFFICE_BASE_PORT:
+            self.connection = f"socket,host=127.0.0.1,port={LIBREOFFICE_BASE_PORT + self.index}"
+        else:
+            # Nombre nuevo en cada arranque: no choca con la pipe de una instancia que se mató
+            self.connection = f"pipe,name=pdf2word_{os.getpid()}_{self.index}_{self.restarts}"
+
+        command = [
+            'libreoffice',
+            '--headless',
+            '--invisible',
+            '--nologo',
+            '--nodefault',
+            '--norestore',
+            '--nolockcheck',
+            f'-env:UserInstallation={self.profile_url}',
+            f'--accept={self.connection};urp;StarOffice.ComponentContext'
+        ]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # Esperar a que el listener UNO acepte conexiones
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        deadline = time.time() + LIBREOFFICE_STARTUP_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:{self.connection};urp;StarOffice.ComponentContext"
+                )
+                self.desktop = context.ServiceManager.createInstanceWithContext(
+                    "com.sun.star.frame.Desktop", context
+                )
+                break
+            except Exception:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise LibreOfficeError(f"La instancia {self.index} de LibreOffice no arrancó")
+                time.sleep(0.5)
+
+        print(f"Instancia {self.index} de LibreOffice lista ({self.connection})")
+
+    def stop(self):
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def is_alive(self):
+        if uno is None:
+            return True
+        return self.process is not None and self.process.poll() is None
+
+    def kill(self):
+        """Mata el proceso; cualquier llamada UNO en curso falla inmediatamente"""
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def convert(self, pdf_path, outdir, profile=None):
+        """Convierte pdf_path a DOCX dentro de outdir y devuelve la ruta del DOCX"""
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        docx_path = os.path.join(outdir, f"{base_name}.docx")
+
+        if uno is None:
+            command = [
+                'libreoffice',
+                f'-env:UserInstallation={self.profile_url}',
+                '--headless',
+                '--convert-to', 'docx',
+                '--outdir', outdir,
+                pdf_path
+            ]
+            # Popen en lugar de run para conocer el pid y poder perfilar el proceso
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            with profile_soffice(process.pid, profile):
+                try:
+                    _, stderr = process.communicate(timeout=LIBREOFFICE_CONVERSION_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.communicate()
+                    raise LibreOfficeError(f"LibreOffice tardó más de {LIBREOFFICE_CONVERSION_TIMEOUT} segundos")
+                if process.returncode != 0:
+                    raise LibreOfficeError(stderr)
+            self.jobs_done += 1
+            return docx_path
+
+        with profile_soffice(self.process.pid if self.process else None, profile):
+            # Si la conversión se cuelga, matar la instancia para desbloquear la llamada UNO
+            watchdog = threading.Timer(LIBREOFFICE_CONVERSION_TIMEOUT, self.kill)
+            watchdog.start()
+            document = None
+            try:
+                document = self.desktop.loadComponentFromURL(
+                    uno.systemPathToFileUrl(os.path.abspath(pdf_path)), "_blank", 0,
+                    (PropertyValue(Name="Hidden", Value=True),
+                     PropertyValue(Name="FilterName", Value="writer_pdf_import"))
+                )
+                if document is None:
+                    raise LibreOfficeError("LibreOffice no pudo abrir el PDF")
+                document.storeToURL(
+                    uno.systemPathToFileUrl(os.path.abspath(docx_path)),
+                    (PropertyValue(Name="FilterName", Value="MS Word 2007 XML"),)
+                )
+            except LibreOfficeError:
+                raise
             except Exception as e:
-                print(f"Error eliminando archivo {file_info['path']}: {e}")
-    
-    # Limpiar registro
-    for file_id in expired_files:
-        del file_registry[file_id]
+                raise LibreOfficeError(f"Error en la instancia {self.index} de LibreOffice: {e}")
+            finally:
+                watchdog.cancel()
+                if document is not None:
+                    try:
+                        document.close(True)
+                    except Exception:
+                        pass
+
+        self.jobs_done += 1
+        return docx_path
+
+
+class LibreOfficePool:
+    """Pool de instancias de LibreOffice; cada conversión usa una instancia libre"""
+
+    def __init__(self, size):
+        self.instances = [LibreOfficeInstance(i) for i in range(size)]
+        self.idle = queue.Queue()
+        self.conversions = 0
+        self.failures = 0
+
+    def start(self):
+        remove_stale_profiles()
+        if uno is None:
+            print("AVISO: no se puede importar uno (paquete python3-uno). El pool de LibreOffice "
+                  "no mantiene instancias abiertas: cada conversión arranca soffice --convert-to en frío")
+        for instance in self.instances:
+            try:
+                instance.start()
+            except Exception as e:
+                # Se reintentará al asignarle la primera conversión
+                print(f"Error arrancando instancia {instance.index} de LibreOffice: {e}")
+            self.idle.put(instance)
+
+    def stop(self):
+        for instance in self.instances:
+            instance.stop()
+        shutil.rmtree(os.path.join(LIBREOFFICE_PROFILES_DIR, f"worker_{os.getpid()}"), ignore_errors=True)
+
+    def convert(self, pdf_path, outdir, profile=None):
+        try:
+            instance = self.idle.get(timeout=LIBREOFFICE_CONVERSION_TIMEOUT)
+        except queue.Empty:
+            raise LibreOfficeError("No hay instancias de LibreOffice libres")
+
+        try:
+            if not instance.is_alive():
+                print(f"Instancia {instance.index} de LibreOffice caída, reiniciando...")
+                instance.restart()
+
+            conversion_start = time.time()
+            docx_path = instance.convert(pdf_path, outdir, profile)
+            self.conversions += 1
+            print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Instancia {instance.index}: "
+                  f"conversión completada en {time.time() - conversion_start:.2f}s")
+
+            if instance.jobs_done >= LIBREOFFICE_MAX_JOBS:
+                print(f"Reciclando instancia {instance.index} tras {instance.jobs_done} conversiones")
+                instance.restart()
+            return docx_path
+        except Exception:
+            self.failures += 1
+            # Una instancia que falla puede quedar en mal estado: empezar de cero
+            try:
+                instance.restart()
+            except Exception as e:
+                print(f"Error reiniciando instancia {instance.index} de LibreOffice: {e}")
+            raise
+        finally:
+            self.idle.put(instance)
+
+    def stats(self):
+        return {
+            "mode": "uno" if uno is not None else "convert-to",
+            "size": len(self.instances),
+            "idle": self.idle.qsize(),
+            "conversions": self.conversions,
+            "failures": self.failures,
+            "instances": [
+                {
+                    "index": instance.index,
+                    "connection": instance.connection,
+                    "alive": instance.is_alive(),
+                    "jobs_done": instance.jobs_done,
+                    "restarts": instance.restarts
+                }
+                for instance in self.instances
+            ]
+        }
+
+
+libreoffice_pool = LibreOfficePool(LIBREOFFICE_POOL_SIZE)
+
+
+@app.on_event("startup")
+async def start_libreoffice_pool():
+    await run_in_threadpool(libreoffice_pool.start)
+
+
+@app.on_event("shutdown")
+async def stop_libreoffice_pool():
+    await run_in_threadpool(libreoffice_pool.stop)
+
+
+# --- CACHÉ DE CONVERSIONES ---
+# DOCX convertidos por SHA-256 del PDF, conversor y versión (ConversionCache, en common/cache.py)
+conversion_cache = ConversionCache(CACHE_DIR, CACHE_MAX_MB)
+libreoffice_version = None
+
+
+def get_libreoffice_version():
+    """Versión de LibreOffice para la clave de caché (se consulta una sola vez)"""
+    global libreoffice_version
+    if libreoffice_version is None:
+        try:
+            result = subprocess.run(['libreoffice', '--version'], capture_output=True, text=True, timeout=10)
+            libreoffice_version = result.stdout.split()[1] if result.stdout.strip() else "unknown"
+        except Exception:
+            libreoffice_version = "unknown"
+    return libreoffice_version
+
+
+# --- CONVERSIÓN CON LIBREOFFICE ---
+# Tras convertir, el DOCX se reempaqueta con optimize_docx (common/docx_utils.py) y se valida
+
+async def run_libreoffice_conversion(pdf_path, outdir, pdf_sha256):
+    """Convierte un PDF con el pool de LibreOffice sin bloquear el event loop"""
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    cached_path = os.path.join(outdir, f"{base_name}.docx")
+    cache_key = ConversionCache.make_key(
+        pdf_sha256, "libreoffice", f"{await run_in_threadpool(get_libreoffice_version)}+{docx_optimization_tag()}"
+    )
+    if await run_in_threadpool(conversion_cache.get, cache_key, cached_path):
+        CONVERSIONS.labels(engine="libreoffice", outcome="cache_hit").inc()
+        print(f"Conversión encontrada en caché ({cache_key[:12]}...)")
+        return cached_path
+
+    try:
+        with CONVERSIONS_IN_FLIGHT.track_inprogress(), CONVERSION_SECONDS.labels(engine="libreoffice").time():
+            profile = new_profile_metadata(pdf_path, pdf_sha256) if PROFILE_SLOW_CONVERSIONS else None
+            docx_path = await run_in_threadpool(libreoffice_pool.convert, pdf_path, outdir, profile)
+    except LibreOfficeError as e:
+        CONVERSIONS.labels(engine="libreoffice", outcome="error").inc()
+        print(f"Error en LibreOffice: {e}")
+        raise HTTPException(status_code=500, detail=f"Error durante la conversión: {e}")
+
+    if not os.path.exists(docx_path):
+        CONVERSIONS.labels(engine="libreoffice", outcome="error").inc()
+        raise HTTPException(status_code=500, detail="La conversión falló, no se encontró el archivo de salida.")
+
+    # Reempaquetar el DOCX antes de entregarlo (y de guardarlo en caché)
+    if DOCX_OPTIMIZE:
+        await run_in_threadpool(optimize_docx, docx_path)
+
+    await validate_conversion_output(docx_path, "libreoffice")
+    await run_in_threadpool(conversion_cache.put, cache_key, docx_path)
+    return docx_path
+
+
+def validate_docx(docx_path):
+    """
+    Comprueba que el DOCX es un ZIP legible con las partes mínimas de un documento
+    de Word. Solo lee el directorio central del ZIP, no descomprime nada.
+    """
+    try:
+        with zipfile.ZipFile(docx_path) as zf:
+            names = set(zf.namelist())
+    except (zipfile.BadZipFile, OSError) as e:
+        raise HTTPException(status_code=500, detail=f"La conversión generó un DOCX no válido: {e}")
+    missing = {'[Content_Types].xml', 'word/document.xml'} - names
+    if missing:
+        raise HTTPException(
+            status_code=500, detail=f"La conversión generó un DOCX no válido: faltan {', '.join(sorted(missing))}"
+        )
+
+
+async def validate_conversion_output(docx_path, engine):
+    """Valida el DOCX antes de guardarlo en caché y contabiliza el resultado de la conversión"""
+    try:
+        with DOCX_VALIDATION_SECONDS.time():
+            await run_in_threadpool(validate_docx, docx_path)
+    except HTTPException as e:
+        CONVERSIONS.labels(engine=engine, outcome="error").inc()
+        print(f"DOCX no válido ({engine}): {e.detail}")
+        raise
+    CONVERSIONS.labels(engine=engine, outcome="ok").inc()
+
+UPLOAD_PATHS = ("/convert", "/convert-and-store")
+
+
+class UploadTooLarge(Exception):
+    """El cuerpo de la subida ha superado MAX_UPLOAD_SIZE_MB mientras se recibía"""
+
+
+class RejectOversizedUploads:
+    """
+    Limita el tamaño de las subidas. Si Content-Length ya lo supera se responde 413
+    sin leer el cuerpo; si no viene (subida chunked) o miente, se cuentan los bytes
+    según llegan y se corta la petición en cuanto se pasa del máximo. Es middleware
+    ASGI puro (no @app.middleware) para no envolver las respuestas: las descargas
+    pasan al servidor bloque a bloque sin otra copia intermedia.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in UPLOAD_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = MAX_UPLOAD_SIZE_MB * 1024 * 1024
+        content_length = Request(scope).headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise UploadTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except UploadTooLarge:
+            if response_started:
+                raise
+            await self.reject(scope, receive, send)
+
+    @staticmethod
+    async def reject(scope, receive, send):
+        response = JSONResponse(
+            {"detail": f"El archivo supera el máximo de {MAX_UPLOAD_SIZE_MB} MB"},
+            status_code=413,
+            headers={"Connection": "close"}
+        )
+        await response(scope, receive, send)
+
+
+app.add_middleware(RejectOversizedUploads)
+
+
+async def save_upload_streaming(request, dest_path, field_name="file"):
+    """
+    Lee el multipart/form-data de la petición por bloques y vuelca el campo
+    field_name directamente a dest_path, calculando su SHA-256 sobre la marcha.
+    El cuerpo no pasa por el UploadFile de Starlette, así que el PDF se escribe
+    una sola vez y la memoria usada no depende de su tamaño; el límite de tamaño
+    lo aplica RejectOversizedUploads mientras llegan los bloques.
+    Devuelve (nombre del archivo, bytes, sha256).
+    """
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise HTTPException(status_code=400, detail="Se esperaba un formulario multipart con el archivo PDF")
+
+    state = {"header_field": b"", "header_value": b"", "headers": {}, "writing": False, "filename": None}
+    pending = []
+
+    def on_part_begin():
+        state["headers"] = {}
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        state["headers"][state["header_field"].lower()] = state["header_value"]
+        state["header_field"] = b""
+        state["header_value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(state["headers"].get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("latin-1")
+        state["writing"] = state["filename"] is None and name == field_name
+        if state["writing"]:
+            state["filename"] = options.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        if state["writing"]:
+            pending.append(data[start:end])
+
+    def on_part_end():
+        state["writing"] = False
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end
+    })
+
+    sha256 = hashlib.sha256()
+    total = 0
+    with open(dest_path, "wb") as buffer:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if pending:
+                data = b"".join(pending)
+                pending.clear()
+                total += len(data)
+                sha256.update(data)
+                await run_in_threadpool(buffer.write, data)
+        parser.finalize()
+
+    if state["filename"] is None:
+        raise HTTPException(status_code=400, detail=f"Falta el campo '{field_name}' con el archivo PDF")
+    return state["filename"], total, sha256.hexdigest()
+
+def store_upload_as(tmpdir, filename):
+    """
+    Comprueba que la subida es un PDF y le da su nombre original dentro de tmpdir
+    (LibreOffice nombra la salida a partir de él). Devuelve la ruta final.
+    """
+    filename = os.path.basename(filename or "")
+    if not filename.endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="El archivo debe ser un PDF")
+    pdf_path = os.path.join(tmpdir, filename)
+    os.replace(os.path.join(tmpdir, "upload"), pdf_path)
+    return pdf_path
+
+# --- TRIAJE DE PDFs ---
+# Antes de ocupar una instancia de LibreOffice se mira el PDF por encima: con
+# PyMuPDF (solo la tabla xref y unas pocas páginas de muestra) o, si no está
+# instalado, buscando marcadores en los bytes. Un PDF con contraseña o que no
+# es un PDF se rechaza en el momento en lugar de agotar el timeout de
+# LibreOffice. Cada decisión se añade a TRIAGE_LOG_PATH.
+
+_PDF_PAGE_RE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+_PDF_IMAGE_RE = re.compile(rb'/Subtype\s*/Image\b')
+_PDF_FONT_RE = re.compile(rb'/Type\s*/Font\b')
+_PDF_ENCRYPT_RE = re.compile(rb'/Encrypt\b')
+
+
+def _inspect_pdf_with_fitz(pdf_path, info):
+    try:
+        doc = fitz.open(pdf_path)
+    except Exception as e:
+        info.update(route="reject", reason="El archivo no es un PDF válido", error=str(e))
+        return
+    with doc:
+        if doc.needs_pass:
+            info.update(encrypted=True, route="reject", reason="El PDF está protegido con contraseña")
+            return
+        info["pages"] = doc.page_count
+        info["encrypted"] = bool(doc.is_encrypted or (doc.metadata or {}).get("encryption"))
+        if doc.page_count == 0:
+            return
+        coverage = 0.0
+        text_pages = 0
+        sample = sample_page_numbers(doc.page_count, TRIAGE_SAMPLE_PAGES)
+        for page_number in sample:
+            page = doc[page_number]
+            if page.get_text("text").strip():
+                text_pages += 1
+            image_area = sum(abs(fitz.Rect(image["bbox"]) & page.rect) for image in page.get_image_info())
+            coverage += min(image_area / (abs(page.rect) or 1), 1.0)
+        info["has_text"] = text_pages > 0
+        info["image_coverage"] = round(coverage / len(sample), 3)
+        info["text_only"] = text_pages == len(sample) and coverage == 0
+
+
+def _inspect_pdf_bytes(pdf_path, info):
+    """Sin PyMuPDF: cuenta marcadores en una sola pasada (los objetos comprimidos no se ven)"""
+    pages = images = fonts = 0
+    encrypted = False
+    tail = b''
+    with open(pdf_path, 'rb') as f:
+        if b'%PDF-' not in f.read(1024):
+            info.update(route="reject", reason="El archivo no es un PDF válido")
+            return
+        f.seek(0)
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            # Los marcadores partidos entre bloques se cuentan en el bloque siguiente
+            data = tail + chunk
+            cut = max(len(data) - 32, 0)
+            scanned = data[:cut]
+            pages += len(_PDF_PAGE_RE.findall(scanned))
+            images += len(_PDF_IMAGE_RE.findall(scanned))
+            fonts += len(_PDF_FONT_RE.findall(scanned))
+            encrypted = encrypted or bool(_PDF_ENCRYPT_RE.search(scanned))
+            tail = data[cut:]
+    pages += len(_PDF_PAGE_RE.findall(tail))
+    images += len(_PDF_IMAGE_RE.findall(tail))
+    fonts += len(_PDF_FONT_RE.findall(tail))
+    encrypted = encrypted or bool(_PDF_ENCRYPT_RE.search(tail))
+    # Sin descifrar no se sabe si hace falta contraseña; LibreOffice lo intenta igualmente
+    info.update(pages=pages or None, encrypted=encrypted, has_text=fonts > 0, images=images)
+
+
+def _new_triage_info():
+    return {
+        "method": "fitz" if fitz is not None else "bytes",
+        "pages": None,
+        "encrypted": False,
+        "has_text": None,
+        "image_coverage": None,
+        "text_only": False,
+        "route": "libreoffice",
+        "reason": None
+    }
+
+
+def triage_pdf(pdf_path):
+    """Decide si el PDF se puede convertir ('libreoffice') o no ('reject')"""
+    start = time.time()
+    info = _new_triage_info()
+    if fitz is not None:
+        _inspect_pdf_with_fitz(pdf_path, info)
+    else:
+        _inspect_pdf_bytes(pdf_path, info)
+
+    if info["route"] != "reject":
+        if info["pages"] == 0:
+            info.update(route="reject", reason="El PDF no tiene páginas")
+        elif info["pages"] and info["pages"] > TRIAGE_MAX_PAGES:
+            info.update(route="reject", reason=f"El PDF tiene {info['pages']} páginas (máximo {TRIAGE_MAX_PAGES})")
+    info["duration_ms"] = round((time.time() - start) * 1000, 1)
+    return info
+
+
+# Los procesos del triaje salen de un forkserver de un solo hilo: un fork de este
+# proceso, que tiene hilos (threadpool, pool de LibreOffice), puede quedarse colgado
+# en un lock heredado
+triage_context = multiprocessing.get_context("forkserver")
+triage_context.set_forkserver_preload([__name__])
+
+
+@app.on_event("startup")
+async def start_triage_forkserver():
+    await run_in_threadpool(forkserver.ensure_running)
+
+
+def _triage_process_main(conn, triage, pdf_path):
+    try:
+        conn.send(("ok", triage(pdf_path)))
+    except Exception as e:
+        conn.send(("error", str(e)))
+    finally:
+        conn.close()
+
+
+def triage_pdf_with_deadline(pdf_path, timeout):
+    """
+    Ejecuta triage_pdf en un proceso hijo y lo mata si pasa de timeout. El PDF
+    aún no se ha validado: si PyMuPDF se cuelga o revienta con él, el PDF se
+    rechaza sin afectar al worker.
+    """
+    start = time.time()
+    parent_conn, child_conn = triage_context.Pipe(duplex=False)
+    process = triage_context.Process(target=_triage_process_main, args=(child_conn, triage_pdf, pdf_path), daemon=True)
+    process.start()
+    child_conn.close()
+    info = _new_triage_info()
+    try:
+        if not parent_conn.poll(timeout):
+            info.update(route="reject", reason=f"El PDF tarda demasiado en analizarse (más de {timeout}s)")
+        else:
+            try:
+                status, result = parent_conn.recv()
+            except EOFError:
+                process.join(5)
+                status, result = "error", f"El proceso de triaje terminó inesperadamente (código {process.exitcode})"
+            if status == "ok":
+                return result
+            info.update(route="reject", reason="El archivo no es un PDF válido", error=result)
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        parent_conn.close()
+    info["duration_ms"] = round((time.time() - start) * 1000, 1)
+    return info
+
+
+def log_triage_decision(filename, size, sha256, info):
+    print(f"Triaje de {filename} ({info['method']}): ruta={info['route']}, páginas={info['pages']}, "
+          f"texto={info['has_text']}, cifrado={info['encrypted']} ({info['duration_ms']} ms)"
+          + (f" - {info['reason']}" if info['reason'] else ""))
+    record = {"time": datetime.now().isoformat(), "filename": filename, "size": size, "sha256": sha256, **info}
+    try:
+        os.makedirs(os.path.dirname(TRIAGE_LOG_PATH), exist_ok=True)
+        with open(TRIAGE_LOG_PATH, 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"No se pudo registrar el triaje: {e}")
+
+
+def choose_route(triage, fast_requested):
+    """Motor final: 'text' (rápido), 'libreoffice' o 'reject'"""
+    if triage['route'] == 'reject':
+        return 'reject'
+    if fast_requested or (TRIAGE_AUTO_FAST and triage['text_only']):
+        if fitz is None:
+            print("Modo rápido no disponible sin PyMuPDF: se convierte con LibreOffice")
+        elif not triage['has_text']:
+            # Sin capa de texto el modo rápido devolvería un documento vacío
+            print("Modo rápido pedido, pero el PDF no tiene texto: se convierte con LibreOffice")
+        else:
+            return 'text'
+    return 'libreoffice'
+
+
+async def triage_upload(pdf_path, filename, size, sha256, fast=False):
+    """Triaje de un PDF subido; rechaza con 400 los que no se pueden convertir"""
+    info = await run_in_threadpool(triage_pdf_with_deadline, pdf_path, TRIAGE_TIMEOUT_SECONDS)
+    info['fast_requested'] = fast
+    info['route'] = choose_route(info, fast)
+    TRIAGE_DECISIONS.labels(route=info['route']).inc()
+    await run_in_threadpool(log_triage_decision, filename, size, sha256, info)
+    if info["route"] == "reject":
+        raise HTTPException(status_code=400, detail=info["reason"])
+    return info
+
+
+# --- CONVERSIÓN RÁPIDA (SOLO TEXTO) ---
+# Con ?fast=true no se pasa por LibreOffice: convert_pdf_to_docx_text_only
+# (common/docx_utils.py) escribe un DOCX mínimo directamente con PyMuPDF.
+
+async def run_text_conversion(pdf_path, outdir, pdf_sha256):
+    """Modo rápido: DOCX de solo texto escrito directamente con PyMuPDF"""
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    docx_path = os.path.join(outdir, f"{base_name}.docx")
+    cache_key = ConversionCache.make_key(pdf_sha256, "text", fitz.VersionBind)
+    if await run_in_threadpool(conversion_cache.get, cache_key, docx_path):
+        CONVERSIONS.labels(engine="text", outcome="cache_hit").inc()
+        print(f"Conversión encontrada en caché ({cache_key[:12]}...)")
+        return docx_path
+
+    start = time.time()
+    try:
+        with CONVERSIONS_IN_FLIGHT.track_inprogress(), CONVERSION_SECONDS.labels(engine="text").time():
+            pages = await run_in_threadpool(convert_pdf_to_docx_text_only, pdf_path, docx_path)
+    except Exception as e:
+        CONVERSIONS.labels(engine="text", outcome="error").inc()
+        print(f"Error en la conversión rápida: {e}")
+        raise HTTPException(status_code=500, detail=f"Error durante la conversión: {e}")
+    print(f"Conversión rápida de {pages} páginas en {time.time() - start:.2f}s")
+
+    await validate_conversion_output(docx_path, "text")
+    await run_in_threadpool(conversion_cache.put, cache_key, docx_path)
+    return docx_path
+
+
+async def run_conversion(triage, pdf_path, outdir, pdf_sha256):
+    if triage['route'] == 'text':
+        return await run_text_conversion(pdf_path, outdir, pdf_sha256)
+    return await run_libreoffice_conversion(pdf_path, outdir, pdf_sha256)
+
+
+# --- ADMISIÓN ---
+# Cada clave de API tiene un bucket de tokens en la tabla admission_buckets del
+# registro de archivos, así que el ritmo por clave es el mismo con uno o con varios
+# workers de uvicorn. Las peticiones sin token reservan el siguiente (el saldo queda
+# en negativo) y esperan a que se genere, así que se atienden en orden de llegada.
+# Después esperan un hueco bajo el tope de conversiones simultáneas, que es por
+# proceso igual que el pool de LibreOffice al que protege.
+
+class AdmissionController:
+    def __init__(self, rate_per_minute, burst, max_concurrent, max_wait):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_wait = max_wait
+        self.max_concurrent = max_concurrent
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _bucket_id(key):
+        # En la base de datos no se guarda la clave de API, solo su hash
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _reserve_token(self, key, now):
+        """
+        Segundos hasta que el siguiente token esté disponible; solo se reserva si no
+        supera max_wait. now es time.time(): el saldo lo comparten todos los procesos.
+        """
+        if self.rate <= 0:
+            return 0
+        bucket_id = self._bucket_id(key)
+        with closing(_registry_db()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT tokens, updated_at FROM admission_buckets WHERE key_hash = ?", (bucket_id,)
+                ).fetchone()
+                tokens, updated_at = (self.burst, now) if row is None else (row['tokens'], row['updated_at'])
+                tokens = min(self.burst, tokens + max(0, now - updated_at) * self.rate) - 1
+                wait = -tokens / self.rate if tokens < 0 else 0
+                if wait <= self.max_wait:
+                    conn.execute(
+                        "INSERT INTO admission_buckets (key_hash, tokens, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(key_hash) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                        (bucket_id, tokens, max(now, updated_at))
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def _refund_token(self, key):
+        if self.rate <= 0:
+            return
+        with closing(_registry_db()) as conn:
+            conn.execute(
+                "UPDATE admission_buckets SET tokens = MIN(?, tokens + 1) WHERE key_hash = ?",
+                (self.burst, self._bucket_id(key))
+            )
+
+    def _reject(self, retry_after):
+        self.rejected += 1
+        ADMISSION_DECISIONS.labels(outcome="rejected").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas conversiones en curso, inténtalo más tarde",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    @asynccontextmanager
+    async def admit(self, key):
+        start = time.monotonic()
+        wait = await run_in_threadpool(self._reserve_token, key, time.time())
+        if wait > self.max_wait:
+            self._reject(wait - self.max_wait)
+
+        self.waiting += 1
+        try:
+            if wait:
+                await asyncio.sleep(wait)
+            remaining = self.max_wait - (time.monotonic() - start)
+            try:
+                await asyncio.wait_for(self._slots.acquire(), max(remaining, 0.01))
+            except asyncio.TimeoutError:
+                # Sin hueco a tiempo: el token no se ha usado, se devuelve al bucket
+                await run_in_threadpool(self._refund_token, key)
+                self._reject(self.max_wait)
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - start
+        ADMISSION_DECISIONS.labels(outcome="delayed" if waited >= 0.01 else "immediate").inc()
+        if waited >= 1:
+            print(f"Admisión: conversión retenida {waited:.1f}s")
+        self.admitted += 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "rate_per_minute": self.rate * 60,
+            "burst": self.burst,
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
+
+
+admission = AdmissionController(
+    ADMISSION_KEY_RATE_PER_MINUTE, ADMISSION_KEY_BURST, ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_WAIT_SECONDS
+)
+
+
+# --- REGISTRO DE ARCHIVOS ---
+# Tabla SQLite en modo WAL: sobrevive a reinicios, la comparten todos los workers
+# y las búsquedas por id o por expires_at usan índices.
+
+def _registry_db():
+    conn = sqlite3.connect(FILE_REGISTRY_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_file_registry():
+    """Crea las tablas del registro de archivos y de los buckets de admisión si no existen"""
+    os.makedirs(os.path.dirname(FILE_REGISTRY_DB_PATH), exist_ok=True)
+    with closing(_registry_db()) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                original_filename TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS files_expires_at ON files (expires_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS admission_buckets (
+                key_hash TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+
+def register_file(file_id, path, original_filename, size_bytes, created_at, expires_at):
+    with closing(_registry_db()) as conn:
+        conn.execute(
+            "INSERT INTO files (id, path, original_filename, size_bytes, created_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (file_id, path, original_filename, size_bytes, created_at.timestamp(), expires_at.timestamp())
+        )
+
+
+def get_registered_file(file_id):
+    """Devuelve la entrada del registro como dict, o None si no existe"""
+    with closing(_registry_db()) as conn:
+        row = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+    if row is None:
+        return None
+    file_info = dict(row)
+    file_info['created_at'] = datetime.fromtimestamp(file_info['created_at'])
+    file_info['expires_at'] = datetime.fromtimestamp(file_info['expires_at'])
+    return file_info
+
+
+def unregister_file(file_id):
+    with closing(_registry_db()) as conn:
+        conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+
+def count_registered_files():
+    with closing(_registry_db()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+init_file_registry()
+
+class ExpirySweeper:
+    """
+    Tarea de fondo que borra los archivos expirados. Recorre el índice de
+    expires_at en orden y solo toca las entradas vencidas, por lotes: cada lote
+    se saca del registro en una transacción y después se borran sus ficheros.
+    Entre barridos duerme hasta la próxima expiración (o FILE_SWEEP_INTERVAL_SECONDS).
+    """
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task = None
+        self.lock = threading.Lock()
+        self.sweeps = 0
+        self.files_removed = 0
+        self.bytes_reclaimed = 0
+        self.last_sweep_at = None
+        self.last_sweep_duration = None
+        self.last_sweep_removed = 0
+
+    def _claim_batch(self, conn, now):
+        """Saca del registro un lote de entradas vencidas y las devuelve"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, path, size_bytes FROM files WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                (now, self.batch_size)
+            ).fetchall()
+            conn.executemany("DELETE FROM files WHERE id = ?", [(row['id'],) for row in rows])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def sweep(self):
+        """Borra todas las entradas vencidas; devuelve cuántas se eliminaron"""
+        with self.lock:
+            start = time.time()
+            removed = 0
+            reclaimed = 0
+            with closing(_registry_db()) as conn:
+                while True:
+                    rows = self._claim_batch(conn, start)
+                    for row in rows:
+                        try:
+                            os.remove(row['path'])
+                            reclaimed += row['size_bytes']
+                        except FileNotFoundError:
+                            pass
+                        except Exception as e:
+                            print(f"Error eliminando archivo {row['path']}: {e}")
+                    removed += len(rows)
+                    if len(rows) < self.batch_size:
+                        break
+
+            self.sweeps += 1
+            self.files_removed += removed
+            self.bytes_reclaimed += reclaimed
+            self.last_sweep_at = datetime.now()
+            self.last_sweep_duration = time.time() - start
+            self.last_sweep_removed = removed
+            if removed:
+                print(f"Barrido de expirados: {removed} archivos, {reclaimed / (1024 * 1024):.2f} MB "
+                      f"liberados en {self.last_sweep_duration:.3f}s")
+            return removed
+
+    def seconds_until_next_expiry(self):
+        with closing(_registry_db()) as conn:
+            next_expiry = conn.execute("SELECT MIN(expires_at) FROM files").fetchone()[0]
+        if next_expiry is None:
+            return self.interval
+        return min(self.interval, max(next_expiry - time.time(), 0))
+
+    async def run(self):
+        while True:
+            try:
+                await run_in_threadpool(self.sweep)
+                delay = await run_in_threadpool(self.seconds_until_next_expiry)
+            except Exception as e:
+                print(f"Error en el barrido de archivos expirados: {e}")
+                delay = self.interval
+            # Nunca en bucle cerrado si hay muchas entradas venciendo a la vez
+            await asyncio.sleep(max(delay, 1))
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self):
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "sweeps": self.sweeps,
+            "files_removed": self.files_removed,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "last_sweep_at": self.last_sweep_at.isoformat() if self.last_sweep_at else None,
+            "last_sweep_duration_ms": round(self.last_sweep_duration * 1000, 1) if self.last_sweep_duration is not None else None,
+            "last_sweep_removed": self.last_sweep_removed
+        }
+
+
+file_sweeper = ExpirySweeper(FILE_SWEEP_INTERVAL_SECONDS, FILE_SWEEP_BATCH_SIZE)
+
+
+@app.on_event("startup")
+async def start_file_sweeper():
+    file_sweeper.start()
+
+
+@app.on_event("shutdown")
+async def stop_file_sweeper():
+    await file_sweeper.stop()
 
 @app.get("/admin/cleanup")
 async def manual_cleanup(api_key: str = Header(..., name="X-API-Key")):
@@ -49,8 +1425,38 @@ async def manual_cleanup(api_key: str = Header(..., name="X-API-Key")):
     if api_key != API_KEY:
         raise HTTPException(status_code=403, detail="Clave de API inválida")
     
-    cleanup_expired_files()
-    return {"status": "Cleanup completed", "active_files": len(file_registry)}
+    removed = await run_in_threadpool(file_sweeper.sweep)
+    return {
+        "status": "Cleanup completed",
+        "removed_files": removed,
+        "active_files": await run_in_threadpool(count_registered_files),
+        "sweeper": file_sweeper.stats()
+    }
+
+@app.get("/admin/profiles")
+async def list_slow_conversion_profiles(api_key: str = Header(..., name="X-API-Key")):
+    """Perfiles guardados de conversiones lentas de LibreOffice"""
+    if api_key != API_KEY:
+        raise HTTPException(status_code=403, detail="Clave de API inválida")
+
+    return {
+        "enabled": PROFILE_SLOW_CONVERSIONS and psutil is not None,
+        "threshold_s": PROFILE_THRESHOLD_SECONDS,
+        "profiles": await run_in_threadpool(profile_store.list)
+    }
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_slow_conversion_profile(profile_id: str, api_key: str = Header(..., name="X-API-Key")):
+    """Un perfil completo, con la serie de CPU y memoria y los estados de soffice"""
+    if api_key != API_KEY:
+        raise HTTPException(status_code=403, detail="Clave de API inválida")
+
+    profile = await run_in_threadpool(profile_store.load, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return profile
+
 
 def verify_api_key(api_key: str = Header(...)):
     if api_key != API_KEY:
@@ -58,158 +1464,256 @@ def verify_api_key(api_key: str = Header(...)):
 
 @app.post("/convert")
 async def convert_pdf_to_docx(
-    file: UploadFile = File(...),
+    request: Request,
     # El nombre 'X-API-Key' es un estándar, pero puedes usar el que prefieras
-    api_key: str = Header(..., name="X-API-Key") 
+    api_key: str = Header(..., name="X-API-Key"),
+    fast: bool = False  # ?fast=true: modo rápido de solo texto
 ):
     # 1. Verificar la clave de API
     if api_key != API_KEY:
         raise HTTPException(status_code=403, detail="Clave de API inválida")
 
-    # 2. Validar el tipo de archivo
-    if not file.filename.endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="El archivo debe ser un PDF")
-
-    # 3. Crear un directorio temporal para la conversión
-    with tempfile.TemporaryDirectory() as tmpdir:
-        pdf_path = os.path.join(tmpdir, file.filename)
-        
-        # Guardar el PDF subido
-        with open(pdf_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-
-        # 4. Ejecutar la conversión con LibreOffice
-        try:
-            command = [
-                'libreoffice',
-                '--headless',
-                '--convert-to', 'docx',
-                '--outdir', tmpdir,
-                pdf_path
-            ]
-            process = subprocess.run(command, check=True, capture_output=True, text=True)
-
-            # 5. Preparar el archivo DOCX para la respuesta
-            base_name = os.path.splitext(file.filename)[0]
-            docx_path = os.path.join(tmpdir, f"{base_name}.docx")
-
-            if not os.path.exists(docx_path):
-                raise HTTPException(status_code=500, detail="La conversión falló, no se encontró el archivo de salida.")
+    # 2. Crear un directorio temporal para la conversión; se borra después de enviar la respuesta
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # 3. Guardar el PDF subido por bloques y validar el tipo de archivo
+        with TEMP_WRITE_SECONDS.time():
+            filename, pdf_size, pdf_sha256 = await save_upload_streaming(request, os.path.join(tmpdir, "upload"))
+        pdf_path = store_upload_as(tmpdir, filename)
 
-            # 6. Devolver el archivo convertido
-            return FileResponse(
-                path=docx_path,
-                media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                filename=f"{base_name}.docx"
-            )
+        # 4. Esperar turno en la admisión y ejecutar la conversión (pool de LibreOffice o modo rápido)
+        async with admission.admit(api_key):
+            triage = await triage_upload(pdf_path, filename, pdf_size, pdf_sha256, fast)
+            docx_path = await run_conversion(triage, pdf_path, tmpdir, pdf_sha256)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
 
-        except subprocess.CalledProcessError as e:
-            print(f"Error en LibreOffice: {e.stderr}")
-            raise HTTPException(status_code=500, detail=f"Error durante la conversión: {e.stderr}")
+    # 5. Devolver el archivo convertido
+    base_name = os.path.splitext(filename)[0]
+    return FileResponse(
+        path=docx_path,
+        media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+        filename=f"{base_name}.docx",
+        background=BackgroundTask(shutil.rmtree, tmpdir, ignore_errors=True)
+    )
 
 @app.post("/convert-and-store")
 async def convert_and_store_pdf(
-    file: UploadFile = File(...),
-    api_key: str = Header(..., name="X-API-Key")
+    request: Request,
+    api_key: str = Header(..., name="X-API-Key"),
+    fast: bool = False  # ?fast=true: modo rápido de solo texto
 ):
     """Convertir PDF a DOCX y almacenar temporalmente para archivos grandes"""
     if api_key != API_KEY:
         raise HTTPException(status_code=403, detail="Clave de API inválida")
 
-    if not file.filename.endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="El archivo debe ser un PDF")
-
-    # Limpiar archivos expirados primero
-    cleanup_expired_files()
-    
     with tempfile.TemporaryDirectory() as tmpdir:
-        pdf_path = os.path.join(tmpdir, file.filename)
+        # Guardar el PDF subido por bloques y validar el tipo de archivo
+        with TEMP_WRITE_SECONDS.time():
+            filename, pdf_size, pdf_sha256 = await save_upload_streaming(request, os.path.join(tmpdir, "upload"))
+        pdf_path = store_upload_as(tmpdir, filename)
+
+        async with admission.admit(api_key):
+            triage = await triage_upload(pdf_path, filename, pdf_size, pdf_sha256, fast)
+            docx_path = await run_conversion(triage, pdf_path, tmpdir, pdf_sha256)
+        base_name = os.path.splitext(filename)[0]
+
+        # Verificar tamaño del archivo
+        file_size_mb = os.path.getsize(docx_path) / (1024 * 1024)
+        
+        # Generar ID único y mover a almacenamiento temporal
+        file_id = str(uuid.uuid4())
+        temp_filename = f"{file_id}_{base_name}.docx"
+        temp_path = os.path.join(TEMP_DIR, temp_filename)
         
-        # Guardar el PDF subido
-        with open(pdf_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        shutil.copy2(docx_path, temp_path)
+        
+        # Registrar archivo
+        created_at = datetime.now()
+        expires_at = created_at + timedelta(hours=FILE_EXPIRY_HOURS)
+        await run_in_threadpool(
+            register_file, file_id, temp_path, f"{base_name}.docx",
+            os.path.getsize(temp_path), created_at, expires_at
+        )
+        
+        # Construir URL de descarga (asumiendo que el servidor corre en el mismo host)
+        download_url = f"/download/{file_id}"
+        
+        return JSONResponse({
+            "status": "success",
+            "message": "Archivo convertido y almacenado temporalmente",
+            "file_id": file_id,
+            "download_url": download_url,
+            "original_filename": f"{base_name}.docx",
+            "size_mb": round(file_size_mb, 2),
+            "expires_at": expires_at.isoformat()
+        })
 
-        try:
-            command = [
-                'libreoffice',
-                '--headless',
-                '--convert-to', 'docx',
-                '--outdir', tmpdir,
-                pdf_path
-            ]
-            process = subprocess.run(command, check=True, capture_output=True, text=True)
+DOCX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 
-            base_name = os.path.splitext(file.filename)[0]
-            docx_path = os.path.join(tmpdir, f"{base_name}.docx")
 
-            if not os.path.exists(docx_path):
-                raise HTTPException(status_code=500, detail="La conversión falló, no se encontró el archivo de salida.")
+class RangeFileResponse(Response):
+    """
+    Envía un archivo completo o un rango de bytes. Recibe el archivo ya abierto
+    (y lo cierra al terminar): las cabeceras se calculan sobre ese descriptor, así
+    que no puede desaparecer entre la respuesta 200/206 y el cuerpo. El archivo
+    se lee por bloques en el threadpool (uvicorn no implementa sendfile).
+    """
 
-            # Verificar tamaño del archivo
-            file_size_mb = os.path.getsize(docx_path) / (1024 * 1024)
-            
-            # Generar ID único y mover a almacenamiento temporal
-            file_id = str(uuid.uuid4())
-            temp_filename = f"{file_id}_{base_name}.docx"
-            temp_path = os.path.join(TEMP_DIR, temp_filename)
-            
-            shutil.copy2(docx_path, temp_path)
-            
-            # Registrar archivo
-            expires_at = datetime.now() + timedelta(hours=FILE_EXPIRY_HOURS)
-            file_registry[file_id] = {
-                'path': temp_path,
-                'original_filename': f"{base_name}.docx",
-                'size_mb': file_size_mb,
-                'created_at': datetime.now(),
-                'expires_at': expires_at
-            }
-            
-            # Construir URL de descarga (asumiendo que el servidor corre en el mismo host)
-            download_url = f"/download/{file_id}"
-            
-            return JSONResponse({
-                "status": "success",
-                "message": "Archivo convertido y almacenado temporalmente",
-                "file_id": file_id,
-                "download_url": download_url,
-                "original_filename": f"{base_name}.docx",
-                "size_mb": round(file_size_mb, 2),
-                "expires_at": expires_at.isoformat()
-            })
-
-        except subprocess.CalledProcessError as e:
-            print(f"Error en LibreOffice: {e.stderr}")
-            raise HTTPException(status_code=500, detail=f"Error durante la conversión: {e.stderr}")
-
-@app.get("/download/{file_id}")
-async def download_file(file_id: str):
-    """Descargar archivo almacenado temporalmente"""
-    if file_id not in file_registry:
+    def __init__(self, file, status_code, headers, start, length, send_body=True):
+        super().__init__(status_code=status_code, headers=headers)
+        self.file = file
+        self.start = start
+        self.length = length
+        self.send_body = send_body
+
+    async def __call__(self, scope, receive, send):
+        with self.file as f:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if not self.send_body or self.length == 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            fd = f.fileno()
+            offset = self.start
+            remaining = self.length
+            while remaining > 0:
+                chunk = await run_in_threadpool(os.pread, fd, min(DOWNLOAD_CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def parse_range_header(range_header, file_size):
+    """
+    Interpreta un Range de un solo intervalo ("bytes=a-b", "bytes=a-", "bytes=-n").
+    Devuelve (inicio, longitud), None si la cabecera no se puede usar (se sirve
+    el archivo completo) o lanza HTTPException 416 si el rango no es satisfacible.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, sep, last = (part.strip() for part in ranges.strip().partition("-"))
+    if not sep or not (first or last) or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+        return None
+    if first == "":
+        # Sufijo: los últimos n bytes. "bytes=-0" no selecciona nada y no es satisfacible
+        suffix = int(last)
+        start = max(file_size - suffix, 0) if suffix > 0 else file_size
+        end = file_size - 1
+    else:
+        start = int(first)
+        end = int(last) if last else None
+        if end is not None and end < start:
+            return None
+    if start >= file_size:
+        raise HTTPException(
+            status_code=416,
+            detail="Rango no satisfacible",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    end = file_size - 1 if end is None else min(end, file_size - 1)
+    return start, end - start + 1
+
+
+def etag_matches(header_value, etag):
+    if header_value.strip() == "*":
+        return True
+    # Comparación débil: W/"x" y "x" cuentan como la misma versión
+    candidates = [tag.strip().removeprefix("W/") for tag in header_value.split(",")]
+    return etag in candidates
+
+
+def not_modified_since(header_value, mtime):
+    try:
+        since = parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return False
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+@app.api_route("/download/{file_id}", methods=["GET", "HEAD"])
+async def download_file(file_id: str, request: Request):
+    """Descargar archivo almacenado temporalmente (admite Range y GET condicional)"""
+    file_info = await run_in_threadpool(get_registered_file, file_id)
+    if file_info is None:
         raise HTTPException(status_code=404, detail="Archivo no encontrado o expirado")
     
-    file_info = file_registry[file_id]
-    
     # Verificar si el archivo ha expirado
     if datetime.now() > file_info['expires_at']:
         try:
             os.remove(file_info['path'])
         except:
             pass
-        del file_registry[file_id]
+        await run_in_threadpool(unregister_file, file_id)
         raise HTTPException(status_code=404, detail="Archivo expirado")
     
-    # Verificar que el archivo existe físicamente
-    if not os.path.exists(file_info['path']):
-        del file_registry[file_id]
+    # Abrir el archivo antes de preparar la respuesta: si el barrido lo borra
+    # después, el descriptor sigue siendo válido y el cuerpo cuadra con las cabeceras
+    try:
+        f = await run_in_threadpool(open, file_info['path'], 'rb')
+    except FileNotFoundError:
+        await run_in_threadpool(unregister_file, file_id)
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
-    
-    return FileResponse(
-        path=file_info['path'],
-        media_type='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        filename=file_info['original_filename']
+    try:
+        response = build_download_response(f, file_id, file_info, request)
+    except BaseException:
+        f.close()
+        raise
+    if not isinstance(response, RangeFileResponse):
+        f.close()
+    return response
+
+
+def build_download_response(f, file_id, file_info, request):
+    """Respuesta 200, 206 o 304 para el archivo ya abierto en f"""
+    stat = os.fstat(f.fileno())
+
+    # Los archivos almacenados no cambian nunca: id, tamaño y mtime identifican la versión
+    etag = '"' + hashlib.md5(f"{file_id}-{stat.st_size}-{stat.st_mtime}".encode()).hexdigest() + '"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes"
+    }
+
+    # 1. GET condicional: el cliente ya tiene esta versión
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif not_modified_since(request.headers.get("if-modified-since", ""), stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    filename = file_info['original_filename']
+    if quote(filename) != filename:
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+    else:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    headers["Content-Type"] = DOCX_MEDIA_TYPE
+
+    # 2. Range: reanudar una descarga interrumpida. Con If-Range solo si la versión coincide
+    status_code = 200
+    start, length = 0, stat.st_size
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag
+                         or not_modified_since(if_range, stat.st_mtime)):
+        byte_range = parse_range_header(range_header, stat.st_size)
+        if byte_range is not None:
+            start, length = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{start + length - 1}/{stat.st_size}"
+
+    headers["Content-Length"] = str(length)
+    return RangeFileResponse(
+        f, status_code, headers, start, length,
+        send_body=request.method != "HEAD"
     )
 
 @app.get("/")
@@ -232,8 +1736,9 @@ async def detailed_health_check():
         
         # 1. Verificar LibreOffice
         try:
-            result = subprocess.run(['libreoffice', '--version'], 
-                                  capture_output=True, text=True, timeout=10)
+            result = await run_in_threadpool(
+                subprocess.run, ['libreoffice', '--version'], capture_output=True, text=True, timeout=10
+            )
             health_info["checks"]["libreoffice"] = {
                 "status": "ok",
                 "version": result.stdout.strip(),
@@ -292,11 +1797,12 @@ async def detailed_health_check():
         
         # 4. Verificar archivos temporales
         try:
-            temp_files_count = len(file_registry)
+            temp_files_count = await run_in_threadpool(count_registered_files)
             health_info["checks"]["temp_files"] = {
                 "status": "ok",
                 "count": temp_files_count,
-                "max_recommended": 100
+                "max_recommended": 100,
+                "sweeper": file_sweeper.stats()
             }
         except Exception as e:
             health_info["checks"]["temp_files"] = {
@@ -304,7 +1810,44 @@ async def detailed_health_check():
                 "error": f"Error verificando archivos temporales: {str(e)}"
             }
         
-        # 5. Estado general
+        # 5. Verificar pool de LibreOffice
+        try:
+            pool_stats = libreoffice_pool.stats()
+            health_info["checks"]["libreoffice_pool"] = {
+                "status": "ok",
+                **pool_stats,
+                # Sin python3-uno cada conversión arranca LibreOffice en frío
+                "warning": uno is None or not all(instance["alive"] for instance in pool_stats["instances"])
+            }
+        except Exception as e:
+            health_info["checks"]["libreoffice_pool"] = {
+                "status": "error",
+                "error": f"Error verificando pool de LibreOffice: {str(e)}"
+            }
+        
+        # 6. Verificar caché de conversiones
+        try:
+            # Recorre el directorio de la caché: fuera del event loop
+            cache_stats = await run_in_threadpool(conversion_cache.stats)
+            health_info["checks"]["cache"] = {
+                "status": "ok",
+                **cache_stats
+            }
+        except Exception as e:
+            health_info["checks"]["cache"] = {
+                "status": "error",
+                "error": f"Error verificando caché: {str(e)}"
+            }
+        
+        # 7. Admisión de conversiones
+        admission_stats = admission.stats()
+        health_info["checks"]["admission"] = {
+            "status": "ok",
+            **admission_stats,
+            "warning": admission_stats["waiting"] > admission_stats["max_concurrent"]
+        }
+        
+        # 8. Estado general
         # Si algún check está en error o tiene warning, cambiar el estado general
         for check_name, check_data in health_info["checks"].items():
             if check_data.get("status") == "error":
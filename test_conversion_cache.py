@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para la caché de conversiones (common/cache.py): clave por
+hash del PDF, conversor y versión, aciertos y fallos, y expulsión LRU
+"""
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import ConversionCache
+
+PDF = b"%PDF-1.4\n" + b"contenido" * 100 + b"\n%%EOF\n"
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_key():
+    """La clave cambia con el contenido del PDF, el conversor o su versión"""
+    print("=== Prueba de la clave de caché ===")
+    sha = hashlib.sha256(PDF).hexdigest()
+    key = ConversionCache.make_key(sha, "pdf2docx", "0.5.8")
+    print(f"🔑 {key}")
+    assert key.startswith(sha)
+    assert key == ConversionCache.make_key(hashlib.sha256(bytes(PDF)).hexdigest(), "pdf2docx", "0.5.8")
+    assert key != ConversionCache.make_key(hashlib.sha256(PDF + b" ").hexdigest(), "pdf2docx", "0.5.8")
+    assert key != ConversionCache.make_key(sha, "text", "0.5.8")
+    assert key != ConversionCache.make_key(sha, "pdf2docx", "0.5.9")
+    print("✅ Clave por contenido, conversor y versión")
+
+
+def test_hit_and_miss():
+    """Un fallo no crea el destino; tras put la entrada se copia íntegra y cuenta como acierto"""
+    print("\n=== Prueba de aciertos y fallos ===")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ConversionCache(os.path.join(tmpdir, 'cache'), 1)
+        key = ConversionCache.make_key(hashlib.sha256(PDF).hexdigest(), "pdf2docx", "0.5.8")
+        dest_path = os.path.join(tmpdir, 'salida.docx')
+
+        assert not cache.get(key, dest_path)
+        assert not os.path.exists(dest_path)
+
+        src_path = os.path.join(tmpdir, 'convertido.docx')
+        write(src_path, b'PK\x03\x04 docx')
+        cache.put(key, src_path)
+        os.remove(src_path)
+        assert cache.get(key, dest_path)
+        assert read(dest_path) == b'PK\x03\x04 docx'
+        assert not [name for name in os.listdir(cache.cache_dir) if name.endswith('.part')]
+
+        stats = cache.stats()
+        print(f"📊 {stats}")
+        assert stats['hits'] == 1 and stats['misses'] == 1 and stats['hit_ratio'] == 0.5
+        assert stats['entries'] == 1
+    print("✅ Aciertos y fallos contados")
+
+
+def test_lru_eviction():
+    """Por encima de max_mb se expulsan las entradas usadas hace más tiempo"""
+    print("\n=== Prueba de expulsión LRU ===")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ConversionCache(os.path.join(tmpdir, 'cache'), 1)
+        src_path = os.path.join(tmpdir, 'convertido.docx')
+        write(src_path, b'x' * 400 * 1024)
+        for i, key in enumerate(('a', 'b')):
+            cache.put(key, src_path)
+            os.utime(cache._path(key), (time.time() - 100 + i, time.time() - 100 + i))
+
+        # Un acierto en 'a' la hace la más reciente: al pasar de 1 MB sale 'b'
+        assert cache.get('a', os.path.join(tmpdir, 'salida.docx'))
+        cache.put('c', src_path)
+        assert os.path.exists(cache._path('a')) and os.path.exists(cache._path('c'))
+        assert not os.path.exists(cache._path('b'))
+        assert cache.stats()['evictions'] == 1
+
+        # Un DOCX mayor que toda la caché no se guarda
+        write(src_path, b'x' * 2 * 1024 * 1024)
+        cache.put('enorme', src_path)
+        assert not os.path.exists(cache._path('enorme'))
+    print("✅ Se expulsa la entrada menos usada")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas de la caché de conversiones...\n")
+    test_key()
+    test_hit_and_miss()
+    test_lru_eviction()
+    print("\n✅ Todas las pruebas de la caché pasaron")
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el pool de conversión de api/convert.py (ConversionPool):
+una conversión que supera su timeout se mata y el pool sigue atendiendo
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from api.convert import ConversionPool, ConversionTimeout
+
+
+def write_pid_and_sleep(pid_path, seconds):
+    with open(pid_path, 'w') as f:
+        f.write(str(os.getpid()))
+    time.sleep(seconds)
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+HELD_LOCK = threading.Lock()
+
+
+def take_held_lock():
+    return HELD_LOCK.acquire(timeout=2)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_timeout_kills_process():
+    """Al vencer el timeout se mata el proceso hijo y se lanza ConversionTimeout"""
+    print("=== Prueba del timeout del pool ===")
+    pool = ConversionPool(workers=1, queue_max=1)
+
+    async def run(pid_path):
+        start = time.monotonic()
+        try:
+            await pool.run(write_pid_and_sleep, pid_path, 30, timeout=1)
+        except ConversionTimeout as e:
+            print(f"📊 {e} ({time.monotonic() - start:.2f}s)")
+        else:
+            raise AssertionError("la conversión no superó el timeout")
+        assert time.monotonic() - start < 5
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pid_path = os.path.join(tmpdir, 'pid')
+        asyncio.run(run(pid_path))
+        with open(pid_path) as f:
+            pid = int(f.read())
+    assert not process_alive(pid)
+    stats = pool.stats()
+    assert stats['timed_out'] == 1 and stats['failed'] == 1 and stats['running'] == 0
+    assert not pool.processes
+    print("✅ Proceso de la conversión eliminado")
+
+
+def test_pool_keeps_working_after_timeout():
+    """Tras un timeout el hueco se libera; los errores del hijo llegan como excepción"""
+    print("\n=== Prueba del pool tras un timeout ===")
+    pool = ConversionPool(workers=1, queue_max=1)
+
+    async def run():
+        try:
+            await pool.run(time.sleep, 30, timeout=0.5)
+        except ConversionTimeout:
+            pass
+        assert await pool.run(pow, 2, 10, timeout=10) == 1024
+        try:
+            await pool.run(fail, "PDF dañado", timeout=10)
+        except ConversionTimeout:
+            raise
+        except Exception as e:
+            assert str(e) == "PDF dañado"
+        else:
+            raise AssertionError("el error del hijo no llegó al padre")
+
+    asyncio.run(run())
+    stats = pool.stats()
+    print(f"📊 {stats}")
+    assert stats['completed'] == 1 and stats['failed'] == 2 and stats['timed_out'] == 1
+    print("✅ El pool sigue atendiendo conversiones")
+
+
+def test_child_does_not_inherit_locks():
+    """El hijo no es un fork de este proceso: un lock cogido aquí está libre en el hijo"""
+    print("\n=== Prueba de locks heredados ===")
+    pool = ConversionPool(workers=1, queue_max=1)
+    # Como un hilo del servidor que tiene un lock en el momento de lanzar la conversión
+    holder = threading.Thread(target=HELD_LOCK.acquire)
+    holder.start()
+    holder.join()
+    try:
+        acquired = asyncio.run(pool.run(take_held_lock, timeout=20))
+    finally:
+        HELD_LOCK.release()
+    print(f"📊 lock libre en el hijo: {acquired}")
+    assert acquired
+    print("✅ El hijo no hereda locks cogidos")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del pool de conversión...\n")
+    test_timeout_kills_process()
+    test_pool_keeps_working_after_timeout()
+    test_child_does_not_inherit_locks()
+    print("\n✅ Todas las pruebas del pool de conversión pasaron")
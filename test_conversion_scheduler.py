@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el planificador del pool de conversión de api/convert.py:
+carril según el coste estimado, orden por rango con envejecimiento y límite de
+huecos del carril largo
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from api.convert import ConversionPool, estimate_conversion_cost
+
+MB = 1024 * 1024
+
+
+class Waiting:
+    """Esperas en el pool lanzadas como tareas; se anota el orden en que obtienen hueco"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.order = []
+        self.tasks = {}
+
+    async def add(self, name, cost):
+        lane = self.pool.lane_for(cost)
+
+        async def acquire():
+            await self.pool._acquire(lane, cost)
+            self.order.append(name)
+
+        self.tasks[name] = (asyncio.create_task(acquire()), lane)
+        await asyncio.sleep(0)
+
+    def started(self, name):
+        return self.tasks[name][0].done()
+
+    async def release(self, name):
+        self.pool._release(self.tasks[name][1])
+        await asyncio.sleep(0)
+
+
+def test_lane_assignment():
+    """Los PDFs cortos van al carril rápido; los de muchas páginas al largo aunque pesen poco"""
+    print("=== Prueba de asignación de carril ===")
+    pool = ConversionPool(4, 10, short_max_cost=45, long_slots=2)
+    cases = [
+        (1 * MB, 3, 'pdf2docx', 'short'),
+        (1 * MB, 30, 'pdf2docx', 'short'),
+        (1 * MB, 300, 'pdf2docx', 'long'),
+        (1 * MB, 300, 'text', 'short'),
+        (3 * MB, 1, 'pdf2docx', 'long'),
+        (12 * MB, 1, 'text', 'short'),
+    ]
+    for size, pages, engine, lane in cases:
+        cost = estimate_conversion_cost(size, pages, engine)
+        print(f"📊 {size // MB}MB, {pages} páginas, {engine}: coste {cost:.0f}s, carril {pool.lane_for(cost)}")
+        assert pool.lane_for(cost) == lane
+    assert pool.lane_for(None) == 'short'
+    assert ConversionPool(2, 10, long_slots=5).long_slots == 2
+    print("✅ Carril asignado según el coste estimado")
+
+
+def test_short_jobs_overtake_long():
+    """Con el pool ocupado, un PDF corto que llega después entra antes que uno largo"""
+    print("\n=== Prueba de orden por coste ===")
+
+    async def run():
+        pool = ConversionPool(1, 10, short_max_cost=45, aging_rate=4)
+        waiting = Waiting(pool)
+        await waiting.add('ocupado', 10)
+        await waiting.add('largo', 400)
+        await waiting.add('medio', 40)
+        await waiting.add('corto', 5)
+        assert waiting.order == ['ocupado']
+        for name in ('ocupado', 'corto', 'medio'):
+            await waiting.release(name)
+        return waiting.order
+
+    order = asyncio.run(run())
+    print(f"📊 Orden: {order}")
+    assert order == ['ocupado', 'corto', 'medio', 'largo']
+    print("✅ Los cortos adelantan a los largos")
+
+
+def test_aging_lets_long_job_through():
+    """Un PDF largo que lleva esperando más de coste / aging_rate pasa delante de uno corto"""
+    print("\n=== Prueba de envejecimiento ===")
+
+    async def run():
+        # Coste 100 a 100 s/s: el largo compensa su coste tras 1 segundo de espera
+        pool = ConversionPool(1, 10, short_max_cost=45, aging_rate=100)
+        waiting = Waiting(pool)
+        await waiting.add('ocupado', 10)
+        await waiting.add('largo', 100)
+        await asyncio.sleep(1.2)
+        await waiting.add('corto', 0)
+        await waiting.release('ocupado')
+        await waiting.release('largo')
+        return waiting.order
+
+    order = asyncio.run(run())
+    print(f"📊 Orden: {order}")
+    assert order == ['ocupado', 'largo', 'corto']
+    print("✅ El largo acaba pasando delante")
+
+
+def test_long_lane_cap():
+    """Los PDFs largos no ocupan más de long_slots huecos; los cortos usan el resto"""
+    print("\n=== Prueba del límite del carril largo ===")
+
+    async def run():
+        pool = ConversionPool(3, 10, short_max_cost=45, long_slots=1)
+        waiting = Waiting(pool)
+        for name in ('largo1', 'largo2', 'largo3'):
+            await waiting.add(name, 400)
+        assert waiting.order == ['largo1']
+        assert pool.running == 1 and len(pool.waiters) == 2
+
+        await waiting.add('corto1', 5)
+        await waiting.add('corto2', 5)
+        assert waiting.order == ['largo1', 'corto1', 'corto2']
+        assert pool.stats()['lanes']['long'] == {'running': 1, 'queued': 2, 'slots': 1}
+
+        # Un hueco rápido libre no sirve a los largos; el largo libre sí
+        await waiting.release('corto1')
+        assert not waiting.started('largo2')
+        await waiting.release('largo1')
+        assert waiting.started('largo2') and not waiting.started('largo3')
+
+        # Una espera cancelada no se queda con el hueco
+        waiting.tasks['largo3'][0].cancel()
+        await asyncio.sleep(0)
+        await waiting.release('largo2')
+        assert pool.lane_running == {'short': 1, 'long': 0} and pool.waiters == []
+        return waiting.order
+
+    order = asyncio.run(run())
+    print(f"📊 Orden: {order}")
+    assert order == ['largo1', 'corto1', 'corto2', 'largo2']
+    print("✅ Carril largo limitado sin bloquear a los cortos")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del planificador del pool...\n")
+    test_lane_assignment()
+    test_short_jobs_overtake_long()
+    test_aging_lets_long_job_through()
+    test_long_lane_cap()
+    print("\n✅ Todas las pruebas del planificador pasaron")
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el modelo de tiempos de conversión de api/convert.py
+(ConversionTimeModel): tramos de tamaño sin historial, ventana de PDFs parecidos,
+límites del timeout y conversiones que agotan el timeout
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from api.convert import ConversionTimeModel, size_bucket_timeout
+
+MB = 1024 * 1024
+
+
+class TimeModel:
+    """Modelo con su historial en un directorio temporal: 5 muestras mínimas, ventana de 10"""
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        model = ConversionTimeModel(
+            os.path.join(self.tmpdir.name, 'times', 'conversion_times.db'),
+            percentile=0.95, margin=1.5, min_samples=5, window=10, min_timeout=15, max_timeout=600
+        )
+        model.init()
+        return model
+
+    def __exit__(self, *exc):
+        self.tmpdir.cleanup()
+
+
+def record_rate(model, seconds_per_page, pages=100, count=5, engine='pdf2docx', image_ratio=0.0):
+    for _ in range(count):
+        model.record(engine, 1 * MB, pages, image_ratio, seconds_per_page * pages)
+
+
+def test_bucket_fallback():
+    """Sin bastantes conversiones parecidas se usa el tramo de tamaño"""
+    print("=== Prueba de tramos sin historial ===")
+    with TimeModel() as model:
+        for size in (1 * MB, 3 * MB, 12 * MB):
+            prediction = model.predict('pdf2docx', size, 10, 0.0)
+            assert prediction == {"timeout": size_bucket_timeout(size)[0], "eta": None,
+                                  "samples": 0, "source": "buckets"}
+
+        record_rate(model, 1.0, pages=10, count=4)
+        prediction = model.predict('pdf2docx', 1 * MB, 10, 0.0)
+        print(f"📊 4 muestras: {prediction}")
+        assert prediction['source'] == 'buckets' and prediction['samples'] == 4
+
+        model.record('pdf2docx', 1 * MB, 10, 0.0, 10.0)
+        assert model.predict('pdf2docx', 1 * MB, 10, 0.0)['source'] == 'model'
+    print("✅ Tramos de tamaño hasta tener min_samples")
+
+
+def test_similar_pages_window():
+    """Solo cuentan el mismo motor y tipo de contenido, de la mitad al doble de páginas, y las más recientes"""
+    print("\n=== Prueba de conversiones parecidas ===")
+    with TimeModel() as model:
+        record_rate(model, 1.0, pages=100)
+
+        for pages in (50, 100, 201):
+            assert model.predict('pdf2docx', 1 * MB, pages, 0.0)['samples'] == 5
+        for pages in (49, 202):
+            assert model.predict('pdf2docx', 1 * MB, pages, 0.0)['source'] == 'buckets'
+        assert model.predict('text', 1 * MB, 100, 0.0)['source'] == 'buckets'
+        assert model.predict('pdf2docx', 1 * MB, 100, 0.8)['source'] == 'buckets'
+        assert model.predict('pdf2docx', 1 * MB, 100, 0.05)['source'] == 'model'
+
+        # Las 10 más recientes (ventana) sustituyen a las 5 lentas anteriores
+        record_rate(model, 3.0, pages=100, count=10)
+        prediction = model.predict('pdf2docx', 1 * MB, 100, 0.0)
+        print(f"📊 Tras 10 conversiones a 3 s/página: {prediction}")
+        assert prediction == {"timeout": 450, "eta": 300.0, "samples": 10, "source": "model"}
+
+        # Los segundos por página se escalan a las páginas del PDF
+        assert model.predict('pdf2docx', 1 * MB, 60, 0.0)['timeout'] == 270
+    print("✅ Ventana de PDFs parecidos respetada")
+
+
+def test_timeout_clamped():
+    """El timeout del modelo queda entre min_timeout (15 s) y max_timeout (600 s)"""
+    print("\n=== Prueba de límites del timeout ===")
+    with TimeModel() as model:
+        record_rate(model, 0.01, pages=100)
+        record_rate(model, 10.0, pages=400, count=5, engine='text')
+        fast = model.predict('pdf2docx', 1 * MB, 100, 0.0)
+        slow = model.predict('text', 1 * MB, 400, 0.0)
+        print(f"📊 Rápido: {fast['timeout']}s (ETA {fast['eta']}s), lento: {slow['timeout']}s (ETA {slow['eta']}s)")
+        assert fast['timeout'] == 15 and fast['eta'] == 1.0
+        assert slow['timeout'] == 600 and slow['eta'] == 4000.0
+    print("✅ Timeout acotado a 15..600 s")
+
+
+def test_timed_out_runs_raise_the_limit():
+    """Las conversiones que agotan el timeout cuentan con su timeout como duración y el límite sube"""
+    print("\n=== Prueba de conversiones que agotan el timeout ===")
+    with TimeModel() as model:
+        record_rate(model, 0.5, pages=100)
+        timeout = model.predict('pdf2docx', 1 * MB, 100, 0.0)['timeout']
+        assert timeout == 75
+
+        timeouts = [timeout]
+        for _ in range(3):
+            model.record('pdf2docx', 1 * MB, 100, 0.0, timeouts[-1], timed_out=True)
+            timeouts.append(model.predict('pdf2docx', 1 * MB, 100, 0.0)['timeout'])
+        print(f"📊 Timeouts sucesivos: {timeouts}")
+        assert timeouts == sorted(timeouts) and timeouts[-1] > timeouts[0]
+        assert timeouts[1] == 113
+
+        stats = model.stats()
+        assert stats['recorded'] == 8
+        assert stats['classes'] == {'pdf2docx/text': {'samples': 8, 'timed_out': 3}}
+    print("✅ Un tipo de PDF que no cabe va subiendo su límite")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del modelo de tiempos de conversión...\n")
+    test_bucket_fallback()
+    test_similar_pages_window()
+    test_timeout_clamped()
+    test_timed_out_runs_raise_the_limit()
+    print("\n✅ Todas las pruebas del modelo de tiempos pasaron")
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para la optimización del DOCX (common/docx_utils.py): el DOCX
+reempaquetado sigue siendo válido, los medios repetidos se guardan una vez y las
+imágenes se reducen a los ppp con que se muestran
+
+Requiere: pip install Pillow
+"""
+import os
+import sys
+import random
+import zipfile
+import tempfile
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image
+
+import common.docx_utils as docx_utils
+from common import optimize_docx
+
+EMU_PER_INCH = 914400
+
+
+def png_bytes(width, height, seed=0):
+    """PNG con ruido para que no se comprima casi nada"""
+    rng = random.Random(seed)
+    img = Image.frombytes('RGB', (width, height), bytes(rng.getrandbits(8) for _ in range(width * height * 3)))
+    output = BytesIO()
+    img.save(output, 'PNG')
+    return output.getvalue()
+
+
+def drawing(rel_id, width_in):
+    cx = int(width_in * EMU_PER_INCH)
+    return (
+        f'<w:p><w:r><w:drawing><wp:inline><wp:extent cx="{cx}" cy="{cx // 2}"/>'
+        f'<a:graphic><a:graphicData><pic:pic><pic:blipFill><a:blip r:embed="{rel_id}"/>'
+        f'</pic:blipFill></pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>'
+    )
+
+
+def build_docx(path, media, drawings):
+    """media: {nombre: bytes}; drawings: [(rId, nombre, ancho mostrado en pulgadas)]"""
+    overrides = ''.join(
+        f'<Override PartName="/word/media/{name}" ContentType="image/png"/>' for name in media
+    )
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        f'{overrides}</Types>'
+    )
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="word/document.xml"/></Relationships>'
+    )
+    document_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + ''.join(
+            f'<Relationship Id="{rel_id}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" '
+            f'Target="media/{name}"/>' for rel_id, name, _ in drawings
+        )
+        + '</Relationships>'
+    )
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+        + ''.join(drawing(rel_id, width_in) for rel_id, _, width_in in drawings)
+        + '</w:body></w:document>'
+    )
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('[Content_Types].xml', content_types)
+        zf.writestr('_rels/.rels', rels)
+        zf.writestr('word/document.xml', document)
+        zf.writestr('word/_rels/document.xml.rels', document_rels)
+        for name, data in media.items():
+            zf.writestr(f'word/media/{name}', data)
+    return document
+
+
+def image_targets(zf):
+    """Destino de cada relación de imagen de document.xml"""
+    rels = zf.read('word/_rels/document.xml.rels')
+    return {
+        attrs['Id']: 'word/' + attrs['Target']
+        for _, attrs in docx_utils._parse_relationships(rels) if attrs['Type'].endswith('/image')
+    }
+
+
+def test_round_trip_valid():
+    """El DOCX optimizado abre, conserva document.xml y todas sus relaciones apuntan a partes existentes"""
+    print("=== Prueba de DOCX reempaquetado válido ===")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'doc.docx')
+        document = build_docx(path, {'image1.png': png_bytes(300, 150)}, [('rId5', 'image1.png', 2)])
+        stats = optimize_docx(path)
+        print(f"📊 {stats['original_bytes']} -> {stats['optimized_bytes']} bytes")
+        assert stats['saved_bytes'] > 0
+        with zipfile.ZipFile(path) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist()[0] == '[Content_Types].xml'
+            assert zf.read('word/document.xml').decode() == document
+            names = set(zf.namelist())
+            assert set(image_targets(zf).values()) <= names
+            assert all(info.compress_type == zipfile.ZIP_DEFLATED for info in zf.infolist())
+    print("✅ DOCX válido tras optimizar")
+
+
+def test_media_deduplicated():
+    """Dos imágenes idénticas quedan en una sola parte y las relaciones apuntan a ella"""
+    print("\n=== Prueba de medios duplicados ===")
+    image = png_bytes(200, 100, seed=1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'doc.docx')
+        build_docx(
+            path, {'image1.png': image, 'image2.png': image, 'image3.png': png_bytes(200, 100, seed=2)},
+            [('rId5', 'image1.png', 3), ('rId6', 'image2.png', 3), ('rId7', 'image3.png', 3)]
+        )
+        stats = optimize_docx(path)
+        assert stats['media_deduplicated'] == 1
+        with zipfile.ZipFile(path) as zf:
+            names = set(zf.namelist())
+            assert 'word/media/image2.png' not in names
+            assert image_targets(zf) == {
+                'rId5': 'word/media/image1.png', 'rId6': 'word/media/image1.png', 'rId7': 'word/media/image3.png'
+            }
+            content_types = zf.read('[Content_Types].xml').decode()
+            assert '/word/media/image2.png' not in content_types
+            assert '/word/media/image1.png' in content_types
+    print("✅ Medio duplicado guardado una sola vez")
+
+
+def test_images_downsampled():
+    """Una imagen de 1200 px mostrada a 2 pulgadas se reduce a DOCX_IMAGE_TARGET_DPI; una pequeña no se toca"""
+    print("\n=== Prueba de reducción de imágenes ===")
+    saved = docx_utils.DOCX_IMAGE_TARGET_DPI
+    docx_utils.DOCX_IMAGE_TARGET_DPI = 150
+    small = png_bytes(100, 50, seed=3)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'doc.docx')
+            build_docx(
+                path, {'big.png': png_bytes(1200, 600, seed=4), 'small.png': small},
+                [('rId5', 'big.png', 2), ('rId6', 'small.png', 2)]
+            )
+            stats = optimize_docx(path)
+            assert stats['images_downsampled'] == 1
+            with zipfile.ZipFile(path) as zf:
+                with Image.open(BytesIO(zf.read('word/media/big.png'))) as img:
+                    print(f"📊 big.png: {img.size}")
+                    assert img.size == (300, 150) and img.format == 'PNG'
+                assert zf.read('word/media/small.png') == small
+    finally:
+        docx_utils.DOCX_IMAGE_TARGET_DPI = saved
+    print("✅ Imagen reducida a los ppp con que se muestra")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas de la optimización del DOCX...\n")
+    test_round_trip_valid()
+    test_media_deduplicated()
+    test_images_downsampled()
+    print("\n✅ Todas las pruebas de la optimización del DOCX pasaron")
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para las reservas (leases) de la cola de trabajos de api/convert.py
+"""
+import os
+import sys
+import time
+import sqlite3
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import api.convert as convert
+
+
+class JobStore:
+    """Cola de trabajos en un directorio temporal durante la prueba"""
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = convert.JOBS_DB_PATH, convert.JOBS_SPOOL_DIR
+        convert.JOBS_DB_PATH = os.path.join(self.tmpdir.name, 'jobs.db')
+        convert.JOBS_SPOOL_DIR = os.path.join(self.tmpdir.name, 'spool')
+        convert.init_job_store()
+        return self
+
+    def __exit__(self, *exc):
+        convert.JOBS_DB_PATH, convert.JOBS_SPOOL_DIR = self.saved
+        self.tmpdir.cleanup()
+
+    def enqueue(self):
+        job_id, partial_path = convert.new_spool_file()
+        with open(partial_path, 'wb') as f:
+            f.write(b'From: jose@example.com\r\n\r\nhola')
+        return convert.enqueue_email_job(job_id, partial_path)
+
+    def expire_lease(self, job_id):
+        with sqlite3.connect(convert.JOBS_DB_PATH) as conn:
+            conn.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ?", (time.time() - 1, job_id))
+
+    def status(self, job_id):
+        with sqlite3.connect(convert.JOBS_DB_PATH) as conn:
+            return conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+def test_expired_lease_changes_owner():
+    """Tras caducar la reserva otro worker la toma y el primero ya no puede cerrar el trabajo"""
+    print("=== Prueba de reserva caducada ===")
+    with JobStore() as store:
+        job_id = store.enqueue()
+        first = convert.claim_next_job()
+        assert first['id'] == job_id
+        assert convert.renew_job_lease(job_id, first['lease_owner'])
+
+        store.expire_lease(job_id)
+        second = convert.claim_next_job()
+        assert second['id'] == job_id and second['lease_owner'] != first['lease_owner']
+
+        assert not convert.renew_job_lease(job_id, first['lease_owner'])
+        assert not convert.complete_job(job_id, first['lease_owner'], "duplicado")
+        assert convert.fail_job(job_id, first['lease_owner'], first['attempts'], "error") == 'lost'
+        assert store.status(job_id) == 'running'
+
+        assert convert.complete_job(job_id, second['lease_owner'], "ok")
+        assert store.status(job_id) == 'done'
+    print("✅ Solo el dueño actual de la reserva cierra el trabajo")
+
+
+def test_lease_renewed_while_running():
+    """Un trabajo más largo que JOB_LEASE_SECONDS no vuelve a la cola mientras se renueve"""
+    print("\n=== Prueba de renovación de la reserva ===")
+    saved = convert.JOB_LEASE_SECONDS, convert.JOB_LEASE_RENEW_SECONDS
+    convert.JOB_LEASE_SECONDS, convert.JOB_LEASE_RENEW_SECONDS = 0.6, 0.1
+
+    async def run(store):
+        job_id = store.enqueue()
+        job = convert.claim_next_job()
+        processing = asyncio.create_task(asyncio.sleep(1.5))
+        keeper = asyncio.create_task(convert.keep_job_lease(job, processing))
+        await asyncio.sleep(1)
+        assert convert.claim_next_job() is None
+        await processing
+        await keeper
+        assert not job.get('lease_lost')
+        assert convert.complete_job(job_id, job['lease_owner'])
+
+    try:
+        with JobStore() as store:
+            asyncio.run(run(store))
+    finally:
+        convert.JOB_LEASE_SECONDS, convert.JOB_LEASE_RENEW_SECONDS = saved
+    print("✅ La reserva se renueva mientras el trabajo sigue en marcha")
+
+
+def test_lost_lease_cancels_processing():
+    """Si otro worker se queda con el trabajo, el procesamiento en curso se cancela"""
+    print("\n=== Prueba de reserva perdida ===")
+    saved = convert.JOB_LEASE_RENEW_SECONDS
+    convert.JOB_LEASE_RENEW_SECONDS = 0.05
+
+    async def run(store):
+        store.enqueue()
+        job = convert.claim_next_job()
+        store.expire_lease(job['id'])
+        assert convert.claim_next_job() is not None
+        processing = asyncio.create_task(asyncio.sleep(5))
+        await convert.keep_job_lease(job, processing)
+        assert job['lease_lost']
+        try:
+            await processing
+        except asyncio.CancelledError:
+            return
+        raise AssertionError("el procesamiento no se canceló")
+
+    try:
+        with JobStore() as store:
+            asyncio.run(run(store))
+    finally:
+        convert.JOB_LEASE_RENEW_SECONDS = saved
+    print("✅ Procesamiento cancelado al perder la reserva")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas de la cola de trabajos...\n")
+    test_expired_lease_changes_owner()
+    test_lease_renewed_while_running()
+    test_lost_lease_cancels_processing()
+    print("\n✅ Todas las pruebas de la cola de trabajos pasaron")
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el parseo MIME en streaming de api/convert.py
+(parse_email_streaming) y para el webhook /api/convert con y sin campo de email
+"""
+import os
+import sys
+import hashlib
+import sqlite3
+import tempfile
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi.testclient import TestClient
+
+import api.convert as convert
+from api.convert import parse_email_streaming
+
+PDF_A = b"%PDF-1.4\n" + bytes(range(256)) * 40 + b"\n%%EOF\n"
+PDF_B = b"%PDF-1.7\n" + b"stream\r\n.\r\n--no-boundary\r\n" * 50 + b"%%EOF"
+
+
+def pdf_part(msg, content, filename):
+    msg.add_attachment(content, maintype='application', subtype='pdf', filename=filename)
+
+
+def parse(msg):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        email_path = os.path.join(tmpdir, 'email.eml')
+        with open(email_path, 'wb') as f:
+            f.write(msg.as_bytes())
+        headers, attachments = parse_email_streaming(email_path, tmpdir)
+        found = {}
+        for attachment in attachments:
+            with open(attachment['path'], 'rb') as f:
+                data = f.read()
+            assert attachment['size'] == len(data)
+            assert attachment['sha256'] == hashlib.sha256(data).hexdigest()
+            found[attachment['filename']] = data
+        return headers, found
+
+
+def test_nested_multipart():
+    """Los PDFs dentro de multipart anidados se encuentran y se decodifican íntegros"""
+    print("=== Prueba de multipart anidados ===")
+    inner = EmailMessage()
+    inner.set_content("texto")
+    inner.add_alternative("<p>texto</p>", subtype='html')
+    pdf_part(inner, PDF_B, 'anidado.pdf')
+
+    msg = EmailMessage()
+    msg['From'] = 'José Pérez <jose@example.com>'
+    msg['Subject'] = 'word'
+    msg.set_content("hola")
+    pdf_part(msg, PDF_A, 'primero.pdf')
+    msg.attach(inner)
+
+    headers, found = parse(msg)
+    assert str(headers['From']) == 'José Pérez <jose@example.com>'
+    assert found == {'primero.pdf': PDF_A, 'anidado.pdf': PDF_B}
+    print("✅ PDFs de todos los niveles encontrados")
+
+
+def test_forwarded_rfc822():
+    """Un PDF dentro de un email reenviado como adjunto (message/rfc822) se encuentra"""
+    print("\n=== Prueba de email reenviado como adjunto ===")
+    forwarded = EmailMessage()
+    forwarded['From'] = 'otra@example.com'
+    forwarded['Subject'] = 'el informe'
+    forwarded.set_content("te paso el informe")
+    pdf_part(forwarded, PDF_A, 'reenviado.pdf')
+
+    msg = EmailMessage()
+    msg['From'] = 'jose@example.com'
+    msg['Subject'] = 'word'
+    msg.set_content("mira el adjunto")
+    msg.add_attachment(forwarded)
+    pdf_part(msg, PDF_B, 'directo.pdf')
+
+    headers, found = parse(msg)
+    assert str(headers['Subject']) == 'word'
+    assert found == {'reenviado.pdf': PDF_A, 'directo.pdf': PDF_B}
+    print("✅ PDF del email reenviado encontrado")
+
+
+def make_client(tmpdir):
+    """Cliente del webhook con la cola de trabajos en tmpdir y sin workers en marcha"""
+    convert.JOBS_DB_PATH = os.path.join(tmpdir, 'jobs.db')
+    convert.JOBS_SPOOL_DIR = os.path.join(tmpdir, 'spool')
+    convert.init_job_store()
+    return TestClient(convert.app)
+
+
+def pending_jobs():
+    with sqlite3.connect(convert.JOBS_DB_PATH) as conn:
+        return conn.execute("SELECT email_path FROM jobs WHERE status = 'pending'").fetchall()
+
+
+def test_webhook_missing_email_field():
+    """Sin campo de email el webhook responde 400, tanto en multipart como en urlencoded"""
+    print("\n=== Prueba del webhook sin campo de email ===")
+    saved = convert.JOBS_DB_PATH, convert.JOBS_SPOOL_DIR
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            client = make_client(tmpdir)
+            response = client.post('/api/convert', data={'to': 'bot@example.com'}, files={'x': (None, '1')})
+            print(f"📊 multipart: {response.status_code}")
+            assert response.status_code == 400
+            response = client.post('/api/convert', data={'to': 'bot@example.com'})
+            print(f"📊 urlencoded: {response.status_code}")
+            assert response.status_code == 400
+            assert pending_jobs() == []
+            assert os.listdir(convert.JOBS_SPOOL_DIR) == []
+        finally:
+            convert.JOBS_DB_PATH, convert.JOBS_SPOOL_DIR = saved
+    print("✅ 400 sin dejar ficheros en el spool")
+
+
+def test_webhook_urlencoded_email():
+    """Un email enviado como campo urlencoded se encola igual que por multipart"""
+    print("\n=== Prueba del webhook urlencoded ===")
+    msg = EmailMessage()
+    msg['From'] = 'jose@example.com'
+    msg['Subject'] = 'word'
+    msg.set_content("hola")
+    saved = convert.JOBS_DB_PATH, convert.JOBS_SPOOL_DIR
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            client = make_client(tmpdir)
+            response = client.post('/api/convert', data={'email': msg.as_string()})
+            assert response.status_code == 200
+            jobs = pending_jobs()
+            assert len(jobs) == 1
+            with open(jobs[0][0], 'rb') as f:
+                assert b'From: jose@example.com' in f.read()
+        finally:
+            convert.JOBS_DB_PATH, convert.JOBS_SPOOL_DIR = saved
+    print("✅ Email encolado desde un formulario urlencoded")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del parseo MIME...\n")
+    test_nested_multipart()
+    test_forwarded_rfc822()
+    test_webhook_missing_email_field()
+    test_webhook_urlencoded_email()
+    print("\n✅ Todas las pruebas del parseo MIME pasaron")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el email de respuesta generado por bloques en api/convert.py
+(iter_mime_message), enviándolo a un servidor SMTP local (aiosmtpd)
+
+Requiere: pip install -r requirements-dev.txt (aiosmtpd)
+"""
+import os
+import sys
+import email
+from email import policy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import api.convert as convert
+from api.convert import iter_mime_message
+from test_smtp_pool import CollectingHandler, free_port, start_server, make_pool
+
+
+def parse_reply(raw):
+    return email.message_from_bytes(raw, policy=policy.default)
+
+
+def test_non_ascii_display_name():
+    """Un remitente con acentos en el nombre recibe la respuesta con la cabecera To codificada"""
+    print("=== Prueba de remitente con nombre no ASCII ===")
+    chunks = b''.join(iter_mime_message(
+        'bot@example.com', 'José Pérez <jose@example.com>', 'Conversión lista', '<p>Hola José</p>'
+    ))
+    headers = chunks.split(b'\r\n\r\n', 1)[0]
+    assert headers.isascii()
+    msg = parse_reply(chunks)
+    print(f"📨 To: {msg['To']}")
+    assert msg['To'].addresses[0].display_name == 'José Pérez'
+    assert msg['To'].addresses[0].addr_spec == 'jose@example.com'
+    assert str(msg['Subject']) == 'Conversión lista'
+    print("✅ Cabeceras codificadas correctamente")
+
+
+def test_send_to_non_ascii_sender():
+    """El envío por el pool SMTP a un remitente con nombre no ASCII no falla"""
+    print("\n=== Prueba de envío a remitente no ASCII ===")
+    port = free_port()
+    handler = CollectingHandler()
+    controller = start_server(port, handler)
+    pool = make_pool(port)
+    to_email = '"Pérez, José" <jose@example.com>'
+    try:
+        pool.sendmail('bot@example.com', to_email, lambda: iter_mime_message(
+            'bot@example.com', to_email, 'Tu documento', '<p>Adjunto</p>',
+            [{'filename': 'informe añó.docx', 'content': b'PK\x03\x04 docx'}]
+        ))
+        assert len(handler.messages) == 1
+        envelope = handler.messages[0]
+        assert envelope.rcpt_tos == ['jose@example.com']
+        msg = parse_reply(envelope.content)
+        assert msg['To'].addresses[0].display_name == 'Pérez, José'
+        attachment = next(msg.iter_attachments())
+        assert attachment.get_filename() == 'informe añó.docx'
+        assert attachment.get_content() == b'PK\x03\x04 docx'
+        print("✅ Respuesta entregada con el nombre y el adjunto intactos")
+    finally:
+        pool.close_all()
+        controller.stop()
+
+
+def test_long_non_ascii_subject():
+    """Un asunto largo con acentos se pliega con CRLF y ninguna línea empieza por '.'"""
+    print("\n=== Prueba de asunto largo no ASCII ===")
+    subject = 'Conversión completada: ' + 'informe trimestral de facturación año 2024 ' * 4
+    raw = b''.join(iter_mime_message(
+        'bot@example.com', 'José Pérez <jose@example.com>', subject, '<p>Hola</p>',
+        [{'filename': 'a\r\n.b.docx', 'content': b'PK\x03\x04 docx'}]
+    ))
+    headers = raw.split(b'\r\n\r\n', 1)[0]
+    folds = headers.count(b'\r\n ')
+    print(f"📨 Subject plegado en {folds + 1} líneas")
+    assert folds > 0
+    assert b'\n' not in raw.replace(b'\r\n', b'')
+    assert b'\r' not in raw.replace(b'\r\n', b'')
+    assert not any(line.startswith(b'.') for line in raw.split(b'\r\n'))
+
+    msg = parse_reply(raw)
+    assert str(msg['Subject']) == subject
+    attachment = next(msg.iter_attachments())
+    assert attachment.get_filename() == 'a__.b.docx'
+    print("✅ Asunto plegado con CRLF y sin líneas que empiecen por '.'")
+
+
+def test_timeout_email_says_stopped():
+    """El aviso de timeout dice que la conversión se detuvo y propone el modo rápido o un PDF más pequeño"""
+    print("\n=== Prueba del email de timeout ===")
+    sent = []
+    saved = convert.send_email_with_gmail
+    convert.send_email_with_gmail = lambda to, subject, html: sent.append((subject, html)) or True
+    try:
+        assert convert.handle_conversion_timeout('informe.pdf', 'jose@example.com', 120)
+        assert convert.handle_conversion_timeout('informe.pdf', 'jose@example.com', 120, fast_mode=True)
+    finally:
+        convert.send_email_with_gmail = saved
+    (_, html), (_, fast_html) = sent
+    assert 'se ha detenido' in html and 'segundo plano' not in html
+    assert 'word rapido' in html and 'más pequeñas' in html
+    assert 'word rapido' not in fast_html and 'más pequeñas' in fast_html
+    print("✅ El email no promete un segundo aviso")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del email de respuesta...\n")
+    test_non_ascii_display_name()
+    test_send_to_non_ascii_sender()
+    test_long_non_ascii_subject()
+    test_timeout_email_says_stopped()
+    print("\n✅ Todas las pruebas del email de respuesta pasaron")
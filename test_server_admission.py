@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para la admisión de server/main.py (AdmissionController): bucket
+de tokens por clave compartido en SQLite, rechazo por espera máxima y devolución
+del token cuando no queda hueco a tiempo
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+from fastapi import HTTPException
+
+import main
+
+
+class RegistryDB:
+    """Registro de archivos (y buckets de admisión) en un directorio temporal"""
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = main.FILE_REGISTRY_DB_PATH
+        main.FILE_REGISTRY_DB_PATH = os.path.join(self.tmpdir.name, 'file_registry.db')
+        main.init_file_registry()
+        return self
+
+    def __exit__(self, *exc):
+        main.FILE_REGISTRY_DB_PATH = self.saved
+        self.tmpdir.cleanup()
+
+
+def tokens_left(controller, key):
+    with main.closing(main._registry_db()) as conn:
+        row = conn.execute(
+            "SELECT tokens FROM admission_buckets WHERE key_hash = ?", (controller._bucket_id(key),)
+        ).fetchone()
+    return row['tokens']
+
+
+async def admit_once(controller, key):
+    async with controller.admit(key):
+        pass
+
+
+def test_bucket_refill():
+    """Gastado el burst, la siguiente petición espera lo que tarda en generarse un token"""
+    print("=== Prueba de recarga del bucket ===")
+    with RegistryDB():
+        controller = main.AdmissionController(rate_per_minute=600, burst=2, max_concurrent=4, max_wait=5)
+
+        async def run():
+            start = time.monotonic()
+            await admit_once(controller, 'clave')
+            await admit_once(controller, 'clave')
+            assert time.monotonic() - start < 0.05
+            await admit_once(controller, 'clave')
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(run())
+        print(f"📊 tercera petición tras {elapsed:.2f}s (un token cada 0.1s)")
+        assert 0.08 <= elapsed < 0.5
+        assert controller.stats()['admitted'] == 3
+    print("✅ El bucket se recarga al ritmo configurado")
+
+
+def test_bucket_shared_between_workers():
+    """Dos controladores (como dos workers de uvicorn) gastan del mismo bucket"""
+    print("\n=== Prueba de bucket compartido ===")
+    with RegistryDB():
+        worker_a = main.AdmissionController(rate_per_minute=1, burst=2, max_concurrent=4, max_wait=1)
+        worker_b = main.AdmissionController(rate_per_minute=1, burst=2, max_concurrent=4, max_wait=1)
+
+        async def run():
+            await admit_once(worker_a, 'clave')
+            await admit_once(worker_b, 'clave')
+            try:
+                await admit_once(worker_a, 'clave')
+            except HTTPException as e:
+                return e
+            raise AssertionError("la tercera petición no se rechazó")
+
+        error = asyncio.run(run())
+        print(f"📊 {error.status_code}, Retry-After={error.headers['Retry-After']}")
+        assert error.status_code == 429
+        # Otra clave tiene su propio bucket
+        asyncio.run(admit_once(worker_b, 'otra'))
+    print("✅ El límite por clave es el mismo con varios workers")
+
+
+def test_max_wait_rejection():
+    """Si el siguiente token tarda más que max_wait se responde 429 sin reservarlo"""
+    print("\n=== Prueba de rechazo por espera máxima ===")
+    with RegistryDB():
+        controller = main.AdmissionController(rate_per_minute=6, burst=1, max_concurrent=4, max_wait=2)
+
+        async def run():
+            await admit_once(controller, 'clave')
+            before = tokens_left(controller, 'clave')
+            start = time.monotonic()
+            try:
+                await admit_once(controller, 'clave')
+            except HTTPException as e:
+                assert time.monotonic() - start < 0.5
+                assert tokens_left(controller, 'clave') == before
+                return e
+            raise AssertionError("la petición no se rechazó")
+
+        error = asyncio.run(run())
+        print(f"📊 {error.status_code}, Retry-After={error.headers['Retry-After']}")
+        assert error.status_code == 429
+        # Faltan ~10 s para el token y se aceptan 2 s de espera
+        assert 7 <= int(error.headers['Retry-After']) <= 9
+        assert controller.stats()['rejected'] == 1
+    print("✅ Rechazo inmediato con Retry-After")
+
+
+def test_token_refund_on_slot_timeout():
+    """Sin hueco libre dentro de max_wait se responde 429 y el token vuelve al bucket"""
+    print("\n=== Prueba de devolución del token ===")
+    with RegistryDB():
+        controller = main.AdmissionController(rate_per_minute=1, burst=3, max_concurrent=1, max_wait=0.2)
+
+        async def run():
+            release = asyncio.Event()
+
+            async def hold_slot():
+                async with controller.admit('otra'):
+                    await release.wait()
+
+            holder = asyncio.create_task(hold_slot())
+            await asyncio.sleep(0.05)
+            try:
+                await admit_once(controller, 'clave')
+            except HTTPException as e:
+                assert e.status_code == 429
+            else:
+                raise AssertionError("la petición no se rechazó")
+            print(f"📊 tokens tras el rechazo: {tokens_left(controller, 'clave'):.2f}")
+            assert tokens_left(controller, 'clave') > 2.99
+            release.set()
+            await holder
+            await admit_once(controller, 'clave')
+            assert controller.stats()['running'] == 0
+
+        asyncio.run(run())
+    print("✅ El token no usado se devuelve")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas de la admisión del servidor...\n")
+    test_bucket_refill()
+    test_bucket_shared_between_workers()
+    test_max_wait_rejection()
+    test_token_refund_on_slot_timeout()
+    print("\n✅ Todas las pruebas de la admisión pasaron")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para /download/{file_id} de server/main.py: rangos (simple,
+sufijo, abierto, no satisfacible, bytes=-0), If-Range, GET condicional con ETag y archivo
+abierto antes de enviar las cabeceras
+"""
+import os
+import sys
+import uuid
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import main
+
+CONTENT = bytes(range(256)) * 40  # 10240 bytes
+
+
+class StoredFile:
+    """Registro de archivos temporal con un DOCX almacenado"""
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = main.FILE_REGISTRY_DB_PATH
+        main.FILE_REGISTRY_DB_PATH = os.path.join(self.tmpdir.name, 'file_registry.db')
+        main.init_file_registry()
+        self.file_id = str(uuid.uuid4())
+        self.path = os.path.join(self.tmpdir.name, f"{self.file_id}_informe.docx")
+        with open(self.path, 'wb') as f:
+            f.write(CONTENT)
+        now = datetime.now()
+        main.register_file(self.file_id, self.path, 'informe.docx', len(CONTENT), now, now + timedelta(hours=1))
+        self.url = f"/download/{self.file_id}"
+        return self
+
+    def __exit__(self, *exc):
+        main.FILE_REGISTRY_DB_PATH = self.saved
+        self.tmpdir.cleanup()
+
+
+def get(url, **headers):
+    return TestClient(main.app).get(url, headers=headers)
+
+
+def test_ranges():
+    """Rango simple, sufijo y abierto devuelven 206 con el trozo y Content-Range correctos"""
+    print("=== Prueba de rangos ===")
+    with StoredFile() as stored:
+        response = get(stored.url)
+        assert response.status_code == 200 and response.content == CONTENT
+        assert response.headers['accept-ranges'] == 'bytes'
+
+        cases = [
+            ('bytes=0-99', 0, 100),
+            ('bytes=10000-', 10000, 240),
+            ('bytes=-500', 10240 - 500, 500),
+            ('bytes=-99999', 0, 10240),
+            ('bytes=10200-99999', 10200, 40),
+        ]
+        for header, start, length in cases:
+            response = get(stored.url, Range=header)
+            print(f"📊 {header}: {response.status_code} {response.headers.get('content-range')}")
+            assert response.status_code == 206
+            assert response.content == CONTENT[start:start + length]
+            assert response.headers['content-range'] == f"bytes {start}-{start + length - 1}/10240"
+            assert response.headers['content-length'] == str(length)
+    print("✅ Rangos servidos correctamente")
+
+
+def test_unsatisfiable_and_ignored_ranges():
+    """Rangos que empiezan fuera del archivo dan 416; los mal formados se ignoran (200)"""
+    print("\n=== Prueba de rangos no satisfacibles ===")
+    with StoredFile() as stored:
+        for header in ('bytes=10240-', 'bytes=99999-100000'):
+            response = get(stored.url, Range=header)
+            print(f"📊 {header}: {response.status_code}")
+            assert response.status_code == 416
+            assert response.headers['content-range'] == 'bytes */10240'
+        for header in ('bytes=5-1', 'bytes=-', 'bytes=a-b', 'bytes=0-1,5-6', 'items=0-1'):
+            response = get(stored.url, Range=header)
+            assert response.status_code == 200 and response.content == CONTENT, header
+    print("✅ 416 con Content-Range y rangos inválidos ignorados")
+
+
+def test_empty_suffix_range():
+    """bytes=-0 no selecciona ningún byte: 416, no el archivo entero ni un 206 vacío"""
+    print("\n=== Prueba de bytes=-0 ===")
+    with StoredFile() as stored:
+        for header in ('bytes=-0', 'bytes=-00', 'bytes= -0 '):
+            response = get(stored.url, Range=header)
+            print(f"📊 {header!r}: {response.status_code} {response.headers.get('content-range')}")
+            assert response.status_code == 416
+            assert response.headers['content-range'] == 'bytes */10240'
+        # Números con signo no son rangos válidos y se ignoran
+        for header in ('bytes=+1-5', 'bytes=-+5', 'bytes=1-+5'):
+            response = get(stored.url, Range=header)
+            assert response.status_code == 200 and response.content == CONTENT, header
+        assert main.parse_range_header('bytes=-1', 10240) == (10239, 1)
+    print("✅ bytes=-0 no es satisfacible")
+
+
+def test_conditional_requests():
+    """If-None-Match con el ETag da 304; If-Range solo aplica el rango si la versión coincide"""
+    print("\n=== Prueba de peticiones condicionales ===")
+    with StoredFile() as stored:
+        etag = get(stored.url).headers['etag']
+        response = get(stored.url, **{'If-None-Match': etag})
+        print(f"📊 If-None-Match: {response.status_code}")
+        assert response.status_code == 304 and response.content == b''
+        assert get(stored.url, **{'If-None-Match': f'W/{etag}'}).status_code == 304
+        assert get(stored.url, **{'If-None-Match': '"otra"'}).status_code == 200
+
+        response = get(stored.url, Range='bytes=0-9', **{'If-Range': etag})
+        assert response.status_code == 206 and response.content == CONTENT[:10]
+        response = get(stored.url, Range='bytes=0-9', **{'If-Range': '"otra-version"'})
+        print(f"📊 If-Range distinto: {response.status_code}")
+        assert response.status_code == 200 and response.content == CONTENT
+
+        response = TestClient(main.app).head(stored.url)
+        assert response.status_code == 200 and response.content == b''
+        assert response.headers['content-length'] == '10240'
+    print("✅ GET condicional e If-Range correctos")
+
+
+def test_file_opened_before_headers():
+    """Si el archivo se borra después de preparar la respuesta, el cuerpo se envía completo"""
+    print("\n=== Prueba de archivo borrado durante la descarga ===")
+    with StoredFile() as stored:
+        scope = {'type': 'http', 'method': 'GET', 'path': stored.url, 'headers': [], 'query_string': b''}
+
+        async def run():
+            response = await main.download_file(stored.file_id, Request(scope))
+            os.remove(stored.path)
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            await response({'type': 'http', 'extensions': {}}, None, send)
+            return response, messages
+
+        response, messages = asyncio.run(run())
+        assert messages[0]['status'] == 200
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        assert body == CONTENT
+        assert response.file.closed
+    print("✅ Descarga completa aunque el archivo se borre a mitad")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas de descargas del servidor...\n")
+    test_ranges()
+    test_unsatisfiable_and_ignored_ranges()
+    test_empty_suffix_range()
+    test_conditional_requests()
+    test_file_opened_before_headers()
+    print("\n✅ Todas las pruebas de descargas pasaron")
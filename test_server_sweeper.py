@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el barrido de archivos expirados de server/main.py
+(ExpirySweeper): solo borra lo vencido, por lotes, y calcula la próxima espera
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+import main
+
+
+class RegistryDB:
+    """Registro de archivos en un directorio temporal"""
+
+    def __enter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.saved = main.FILE_REGISTRY_DB_PATH
+        main.FILE_REGISTRY_DB_PATH = os.path.join(self.tmpdir.name, 'file_registry.db')
+        main.init_file_registry()
+        return self
+
+    def __exit__(self, *exc):
+        main.FILE_REGISTRY_DB_PATH = self.saved
+        self.tmpdir.cleanup()
+
+    def store(self, expires_in, size=1024):
+        file_id = str(uuid.uuid4())
+        path = os.path.join(self.tmpdir.name, f"{file_id}.docx")
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        now = datetime.now()
+        main.register_file(file_id, path, 'informe.docx', size, now, now + timedelta(seconds=expires_in))
+        return path
+
+
+def test_sweep_removes_only_expired():
+    """Se borran los ficheros vencidos y sus entradas, por lotes; los vigentes no se tocan"""
+    print("=== Prueba del barrido de expirados ===")
+    with RegistryDB() as registry:
+        expired = [registry.store(-60) for _ in range(7)]
+        alive = [registry.store(3600) for _ in range(2)]
+        os.remove(expired[0])  # Un fichero que ya no existe no detiene el barrido
+
+        sweeper = main.ExpirySweeper(interval=60, batch_size=3)
+        removed = sweeper.sweep()
+        stats = sweeper.stats()
+        print(f"📊 {stats}")
+        assert removed == 7
+        assert not any(os.path.exists(path) for path in expired)
+        assert all(os.path.exists(path) for path in alive)
+        assert main.count_registered_files() == 2
+        assert stats['files_removed'] == 7 and stats['bytes_reclaimed'] == 6 * 1024
+        assert sweeper.sweep() == 0
+    print("✅ Solo se borran los archivos vencidos")
+
+
+def test_sleeps_until_next_expiry():
+    """Entre barridos se espera a la próxima expiración, como mucho el intervalo"""
+    print("\n=== Prueba de la espera entre barridos ===")
+    with RegistryDB() as registry:
+        sweeper = main.ExpirySweeper(interval=60, batch_size=100)
+        assert sweeper.seconds_until_next_expiry() == 60
+        registry.store(3600)
+        assert sweeper.seconds_until_next_expiry() == 60
+        registry.store(5)
+        assert 3 < sweeper.seconds_until_next_expiry() <= 5
+    print("✅ Espera hasta la próxima expiración")
+
+
+def test_background_task():
+    """La tarea de fondo barre al arrancar y se para limpiamente"""
+    print("\n=== Prueba de la tarea de fondo ===")
+
+    async def run(path):
+        sweeper = main.ExpirySweeper(interval=60, batch_size=100)
+        sweeper.start()
+        for _ in range(50):
+            if not os.path.exists(path):
+                break
+            await asyncio.sleep(0.05)
+        assert sweeper.stats()['running']
+        await sweeper.stop()
+        assert not sweeper.stats()['running']
+
+    with RegistryDB() as registry:
+        path = registry.store(-1)
+        start = time.monotonic()
+        asyncio.run(run(path))
+        assert not os.path.exists(path) and time.monotonic() - start < 3
+    print("✅ Tarea de fondo arrancada y parada")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del barrido de archivos expirados...\n")
+    test_sweep_removes_only_expired()
+    test_sleeps_until_next_expiry()
+    test_background_task()
+    print("\n✅ Todas las pruebas del barrido pasaron")
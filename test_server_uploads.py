@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para las subidas de server/main.py: el multipart se lee en
+streaming y RejectOversizedUploads corta las subidas demasiado grandes aunque
+no traigan Content-Length
+"""
+import os
+import sys
+import asyncio
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server'))
+
+from fastapi.testclient import TestClient
+
+import main
+
+HEADERS = {'X-API-Key': main.API_KEY, 'api-key': main.API_KEY}
+BOUNDARY = 'limite-de-prueba'
+
+
+def multipart_chunks(filename, total_mb):
+    """Cuerpo multipart con un campo 'file' de total_mb MB, en bloques de 1 MB"""
+    yield (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: application/pdf\r\n\r\n%PDF-1.4\n'
+    ).encode()
+    for _ in range(total_mb):
+        yield b'0' * (1024 * 1024)
+    yield f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+
+async def call_app(path, chunks, content_length=None):
+    """Llama a la app ASGI directamente y devuelve (estado, bloques del cuerpo leídos)"""
+    headers = [
+        (b'content-type', f'multipart/form-data; boundary={BOUNDARY}'.encode()),
+        (b'x-api-key', main.API_KEY.encode()),
+        (b'api-key', main.API_KEY.encode()),
+    ]
+    if content_length is not None:
+        headers.append((b'content-length', str(content_length).encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'fast=true',
+        'root_path': '', 'headers': headers, 'client': ('127.0.0.1', 1234), 'server': ('testserver', 80)
+    }
+    chunks = list(chunks)
+    consumed = 0
+    status = {}
+
+    async def receive():
+        nonlocal consumed
+        if consumed < len(chunks):
+            consumed += 1
+            return {'type': 'http.request', 'body': chunks[consumed - 1], 'more_body': consumed < len(chunks)}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+
+    await main.app(scope, receive, send)
+    return status.get('code'), consumed
+
+
+def with_upload_limit(mb, test):
+    saved = main.MAX_UPLOAD_SIZE_MB
+    main.MAX_UPLOAD_SIZE_MB = mb
+    try:
+        return test()
+    finally:
+        main.MAX_UPLOAD_SIZE_MB = saved
+
+
+def test_chunked_upload_cut_midstream():
+    """Sin Content-Length la subida se corta en cuanto supera el máximo, sin leerla entera"""
+    print("=== Prueba de subida chunked demasiado grande ===")
+    for path in main.UPLOAD_PATHS:
+        status, consumed = with_upload_limit(2, lambda: asyncio.run(
+            call_app(path, multipart_chunks('grande.pdf', 20))
+        ))
+        print(f"📊 {path}: {status}, {consumed} bloques leídos de 22")
+        assert status == 413
+        assert consumed <= 4
+    print("✅ 413 sin recibir el cuerpo completo")
+
+
+def test_content_length_rejected_before_body():
+    """Con un Content-Length excesivo se responde 413 sin leer ningún bloque"""
+    print("\n=== Prueba de Content-Length excesivo ===")
+    status, consumed = with_upload_limit(2, lambda: asyncio.run(
+        call_app('/convert', multipart_chunks('grande.pdf', 20), content_length=20 * 1024 * 1024)
+    ))
+    print(f"📊 {status}, {consumed} bloques leídos")
+    assert status == 413 and consumed == 0
+    print("✅ Rechazada antes de leer el cuerpo")
+
+
+def test_upload_field_validation():
+    """Sin campo 'file' o con un archivo que no es PDF se responde 400"""
+    print("\n=== Prueba de validación del formulario ===")
+    client = TestClient(main.app)
+    response = client.post('/convert', files={'otro': ('doc.pdf', b'%PDF-1.4', 'application/pdf')}, headers=HEADERS)
+    print(f"📊 sin campo file: {response.status_code}")
+    assert response.status_code == 400
+    response = client.post('/convert', files={'file': ('doc.txt', b'hola', 'text/plain')}, headers=HEADERS)
+    print(f"📊 no PDF: {response.status_code}")
+    assert response.status_code == 400
+    response = client.post('/convert', data={'file': 'hola'}, headers=HEADERS)
+    print(f"📊 urlencoded: {response.status_code}")
+    assert response.status_code == 400
+    print("✅ Formularios no válidos rechazados")
+
+
+def test_streamed_upload_saved_intact():
+    """El PDF llega a disco íntegro y con su SHA-256, sin pasar por UploadFile"""
+    print("\n=== Prueba de guardado en streaming ===")
+    content = b'%PDF-1.4\n' + bytes(range(256)) * 4096 + b'\r\n--casi-un-boundary\r\n%%EOF'
+    body = (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="nota"\r\n\r\nhola\r\n'
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="informe.pdf"\r\n'
+        f'Content-Type: application/pdf\r\n\r\n'
+    ).encode() + content + f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+    class FakeRequest:
+        headers = {'content-type': f'multipart/form-data; boundary={BOUNDARY}'}
+
+        async def stream(self):
+            for i in range(0, len(body), 7000):
+                yield body[i:i + 7000]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dest = os.path.join(tmpdir, 'upload')
+        filename, size, sha256 = asyncio.run(main.save_upload_streaming(FakeRequest(), dest))
+        with open(dest, 'rb') as f:
+            assert f.read() == content
+    assert filename == 'informe.pdf'
+    assert size == len(content)
+    assert sha256 == hashlib.sha256(content).hexdigest()
+    print("✅ PDF guardado íntegro")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas de subidas del servidor...\n")
+    test_chunked_upload_cut_midstream()
+    test_content_length_rejected_before_body()
+    test_upload_field_validation()
+    test_streamed_upload_saved_intact()
+    print("\n✅ Todas las pruebas de subidas pasaron")
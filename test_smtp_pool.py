@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el pool de conexiones SMTP de api/convert.py
+usando un servidor SMTP local (aiosmtpd) en lugar de Gmail
+
+Requiere: pip install -r requirements-dev.txt (aiosmtpd)
+"""
+import os
+import sys
+import time
+import socket
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiosmtpd.controller import Controller
+
+from api.convert import SMTPConnectionPool
+
+
+class CollectingHandler:
+    """Guarda los mensajes recibidos y cuenta las conexiones abiertas"""
+
+    def __init__(self, delay=0):
+        self.messages = []
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        if self.delay:
+            time.sleep(self.delay)
+        self.messages.append(envelope)
+        with self.lock:
+            self.active -= 1
+        return '250 OK'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, handler):
+    controller = Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    return controller
+
+
+def make_pool(port, **kwargs):
+    return SMTPConnectionPool('127.0.0.1', port, starttls=False, **kwargs)
+
+
+def test_reuses_connections():
+    """Varios envíos seguidos usan una sola conexión"""
+    print("=== Prueba de reutilización de conexiones ===")
+    port = free_port()
+    handler = CollectingHandler()
+    controller = start_server(port, handler)
+    pool = make_pool(port)
+    try:
+        for i in range(5):
+            pool.sendmail('bot@example.com', 'user@example.com', f'Subject: prueba {i}\r\n\r\nhola')
+        stats = pool.stats()
+        print(f"📊 {stats}")
+        assert len(handler.messages) == 5
+        assert stats['opened'] == 1
+        assert stats['reused'] == 4
+        print("✅ Conexión reutilizada en todos los envíos")
+    finally:
+        pool.close_all()
+        controller.stop()
+
+
+def test_concurrency_cap():
+    """Nunca hay más conexiones abiertas que max_connections"""
+    print("\n=== Prueba del límite de conexiones ===")
+    port = free_port()
+    handler = CollectingHandler(delay=0.2)
+    controller = start_server(port, handler)
+    pool = make_pool(port, max_connections=2)
+    try:
+        threads = [
+            threading.Thread(target=pool.sendmail,
+                             args=('bot@example.com', 'user@example.com', f'Subject: {i}\r\n\r\nhola'))
+            for i in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        print(f"📊 {stats}")
+        assert len(handler.messages) == 6
+        assert stats['opened'] <= 2
+        print("✅ Límite de conexiones respetado")
+    finally:
+        pool.close_all()
+        controller.stop()
+
+
+def test_reconnect_after_server_restart():
+    """Si el servidor cierra las conexiones, el siguiente envío reconecta"""
+    print("\n=== Prueba de reconexión ===")
+    port = free_port()
+    handler = CollectingHandler()
+    controller = start_server(port, handler)
+    pool = make_pool(port)
+    try:
+        pool.sendmail('bot@example.com', 'user@example.com', 'Subject: antes\r\n\r\nhola')
+        controller.stop()
+        controller = start_server(port, handler)
+        pool.sendmail('bot@example.com', 'user@example.com', 'Subject: despues\r\n\r\nhola')
+        stats = pool.stats()
+        print(f"📊 {stats}")
+        assert len(handler.messages) == 2
+        assert stats['opened'] == 2
+        assert stats['failed'] == 0
+        print("✅ Reconexión transparente tras reinicio del servidor")
+    finally:
+        pool.close_all()
+        controller.stop()
+
+
+def test_noop_health_check():
+    """Las conexiones ociosas se comprueban con NOOP antes de reutilizarlas"""
+    print("\n=== Prueba de comprobación NOOP ===")
+    port = free_port()
+    handler = CollectingHandler()
+    controller = start_server(port, handler)
+    pool = make_pool(port, noop_after=0)
+    try:
+        pool.sendmail('bot@example.com', 'user@example.com', 'Subject: uno\r\n\r\nhola')
+        controller.stop()
+        controller = start_server(port, handler)
+        # El NOOP detecta la conexión muerta antes de enviar, sin llegar a reintentar
+        pool.sendmail('bot@example.com', 'user@example.com', 'Subject: dos\r\n\r\nhola')
+        stats = pool.stats()
+        print(f"📊 {stats}")
+        assert len(handler.messages) == 2
+        assert stats['reconnects'] == 0
+        assert stats['opened'] == 2
+        print("✅ Conexión muerta descartada por NOOP")
+    finally:
+        pool.close_all()
+        controller.stop()
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del pool SMTP contra aiosmtpd...\n")
+    test_reuses_connections()
+    test_concurrency_cap()
+    test_reconnect_after_server_restart()
+    test_noop_health_check()
+    print("\n✅ Todas las pruebas del pool SMTP pasaron")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el modo rápido de solo texto: el DOCX que escribe
+convert_pdf_to_docx_text_only y cuándo lo elige choose_route en api/convert.py
+"""
+import os
+import sys
+import zipfile
+import tempfile
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fitz
+
+import api.convert as convert
+from common import convert_pdf_to_docx_text_only
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+def make_pdf(path):
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    page.insert_text((72, 72), "Informe trimestral", fontname="hebo", fontsize=18)
+    page.insert_text((72, 120), "Ventas <netas> & costes", fontname="helv", fontsize=11)
+    doc.new_page(width=612, height=792).insert_text((72, 72), "Segunda página", fontname="helv", fontsize=11)
+    doc.save(path)
+    doc.close()
+
+
+def test_text_only_docx():
+    """El DOCX es válido, conserva el texto, la negrita y el tamaño, y separa las páginas"""
+    print("=== Prueba del DOCX de solo texto ===")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pdf_path = os.path.join(tmpdir, 'informe.pdf')
+        docx_path = os.path.join(tmpdir, 'informe.docx')
+        make_pdf(pdf_path)
+        assert convert_pdf_to_docx_text_only(pdf_path, docx_path) == 2
+        with zipfile.ZipFile(docx_path) as zf:
+            assert {'[Content_Types].xml', '_rels/.rels', 'word/document.xml'} <= set(zf.namelist())
+            document = ET.fromstring(zf.read('word/document.xml'))
+
+    body = document.find(f'{W}body')
+    paragraphs = [''.join(t.text for t in p.iter(f'{W}t')) for p in body.iter(f'{W}p')]
+    print(f"📄 {paragraphs}")
+    assert [text for text in paragraphs if text] == ["Informe trimestral", "Ventas <netas> & costes", "Segunda página"]
+    assert len(body.findall(f'.//{W}br[@{W}type="page"]')) == 1
+
+    title_run = next(r for r in body.iter(f'{W}r') if r.findtext(f'{W}t') == "Informe trimestral")
+    assert title_run.find(f'{W}rPr/{W}b') is not None
+    assert title_run.find(f'{W}rPr/{W}sz').get(f'{W}val') == '36'
+    page_size = body.find(f'{W}sectPr/{W}pgSz')
+    assert (page_size.get(f'{W}w'), page_size.get(f'{W}h')) == ('12240', '15840')
+    print("✅ DOCX de solo texto correcto")
+
+
+def test_route_choice():
+    """'word rapido' elige el modo texto salvo que el PDF no tenga texto; TRIAGE_AUTO_FAST lo elige solo"""
+    print("\n=== Prueba de la elección del modo rápido ===")
+    text_pdf = {'route': 'pdf2docx', 'text_pages': 3, 'text_only': True}
+    scanned_pdf = {'route': 'pdf2docx', 'text_pages': 0, 'text_only': False}
+    rejected_pdf = {'route': 'reject', 'text_pages': 0, 'text_only': False}
+
+    saved = convert.TRIAGE_AUTO_FAST
+    try:
+        convert.TRIAGE_AUTO_FAST = False
+        assert convert.choose_route(text_pdf, True) == 'text'
+        assert convert.choose_route(text_pdf, False) == 'pdf2docx'
+        assert convert.choose_route(scanned_pdf, True) == 'pdf2docx'
+        assert convert.choose_route(rejected_pdf, True) == 'reject'
+        convert.TRIAGE_AUTO_FAST = True
+        assert convert.choose_route(text_pdf, False) == 'text'
+        assert convert.choose_route(scanned_pdf, False) == 'pdf2docx'
+    finally:
+        convert.TRIAGE_AUTO_FAST = saved
+    assert any(keyword in "word rapido" for keyword in convert.FAST_MODE_KEYWORDS)
+    print("✅ Modo rápido elegido solo cuando sirve")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del modo rápido de solo texto...\n")
+    test_text_only_docx()
+    test_route_choice()
+    print("\n✅ Todas las pruebas del modo rápido pasaron")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Script de prueba para el triaje de PDFs en un proceso aparte (api/convert.py y
+server/main.py): un PDF que cuelga o revienta a PyMuPDF se rechaza dentro del
+plazo sin afectar al proceso principal
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+import fitz
+
+import api.convert as convert
+import main
+
+
+def make_pdf(path, pages=2):
+    doc = fitz.open()
+    for i in range(pages):
+        doc.new_page().insert_text((72, 72), f"Página {i + 1}")
+    doc.save(path)
+    doc.close()
+
+
+def hang(pdf_path):
+    time.sleep(30)
+
+
+def crash(pdf_path):
+    os._exit(11)
+
+
+HELD_LOCK = threading.Lock()
+
+
+def triage_with_lock(pdf_path):
+    if not HELD_LOCK.acquire(timeout=2):
+        raise RuntimeError("lock heredado del proceso padre")
+    return main.triage_pdf(pdf_path)
+
+
+class Patched:
+    """Sustituye un atributo de un módulo durante la prueba"""
+
+    def __init__(self, module, name, value):
+        self.module, self.name, self.value = module, name, value
+
+    def __enter__(self):
+        self.saved = getattr(self.module, self.name)
+        setattr(self.module, self.name, self.value)
+
+    def __exit__(self, *exc):
+        setattr(self.module, self.name, self.saved)
+
+
+def test_server_triage_deadline():
+    """Servidor: triaje normal, colgado (se mata al vencer el plazo) y proceso que revienta"""
+    print("=== Prueba del plazo del triaje en el servidor ===")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pdf_path = os.path.join(tmpdir, 'doc.pdf')
+        make_pdf(pdf_path)
+        info = main.triage_pdf_with_deadline(pdf_path, 10)
+        assert info['route'] == 'libreoffice' and info['pages'] == 2
+
+        with Patched(main, 'triage_pdf', hang):
+            start = time.monotonic()
+            info = main.triage_pdf_with_deadline(pdf_path, 0.5)
+            elapsed = time.monotonic() - start
+        print(f"📊 colgado: {info['route']} en {elapsed:.2f}s - {info['reason']}")
+        assert info['route'] == 'reject' and elapsed < 3
+
+        with Patched(main, 'triage_pdf', crash):
+            info = main.triage_pdf_with_deadline(pdf_path, 10)
+        print(f"📊 revienta: {info['route']} - {info.get('error')}")
+        assert info['route'] == 'reject' and 'código 11' in info['error']
+    print("✅ El servidor rechaza el PDF sin esperar a PyMuPDF")
+
+
+def test_server_triage_does_not_inherit_locks():
+    """Servidor: el proceso del triaje no hereda los locks cogidos por hilos del worker"""
+    print("\n=== Prueba de locks heredados en el triaje ===")
+    holder = threading.Thread(target=HELD_LOCK.acquire)
+    holder.start()
+    holder.join()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pdf_path = os.path.join(tmpdir, 'doc.pdf')
+            make_pdf(pdf_path)
+            with Patched(main, 'triage_pdf', triage_with_lock):
+                info = main.triage_pdf_with_deadline(pdf_path, 20)
+    finally:
+        HELD_LOCK.release()
+    print(f"📊 {info['route']} - {info.get('error')}")
+    assert info['route'] == 'libreoffice' and info['pages'] == 2
+    print("✅ El triaje no hereda locks cogidos")
+
+
+def test_api_triage_in_pool():
+    """API: el triaje corre en el pool de conversión y se mata al pasar TRIAGE_TIMEOUT_SECONDS"""
+    print("\n=== Prueba del plazo del triaje en la API ===")
+    pool = convert.ConversionPool(workers=1, queue_max=2)
+
+    async def run(pdf_path):
+        # Con el plazo normal: en estas pruebas el forkserver puede no tener
+        # precargado api.convert y el hijo tarda en importarlo
+        info = await convert.run_triage(pdf_path)
+        assert info['route'] == 'pdf2docx' and info['pages'] == 2
+        with Patched(convert, 'triage_pdf', hang), Patched(convert, 'TRIAGE_TIMEOUT_SECONDS', 0.5):
+            start = time.monotonic()
+            info = await convert.run_triage(pdf_path)
+            elapsed = time.monotonic() - start
+        print(f"📊 colgado: {info['route']} en {elapsed:.2f}s - {info['reason']}")
+        assert info['route'] == 'reject' and elapsed < 3
+        assert not info['text_only'] and not info['scanned']
+        with Patched(convert, 'triage_pdf', crash):
+            info = await convert.run_triage(pdf_path)
+        print(f"📊 revienta: {info['route']} - {info.get('error')}")
+        assert info['route'] == 'reject' and 'código 11' in info['error']
+        assert pool.stats()['running'] == 0 and not pool.processes
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pdf_path = os.path.join(tmpdir, 'doc.pdf')
+        make_pdf(pdf_path)
+        with Patched(convert, 'conversion_pool', pool):
+            asyncio.run(run(pdf_path))
+    print("✅ La API rechaza el PDF y el pool queda libre")
+
+
+if __name__ == "__main__":
+    print("Iniciando pruebas del plazo del triaje...\n")
+    test_server_triage_deadline()
+    test_server_triage_does_not_inherit_locks()
+    test_api_triage_in_pool()
+    print("\n✅ Todas las pruebas del plazo del triaje pasaron")